@@ -0,0 +1,298 @@
+import asyncio
+import heapq
+import itertools
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+#***********************************
+# Admission control for chat turns
+#***********************************
+# Each chat turn fans out into embedding, vector and model calls, so turns are
+# admitted here before any upstream work starts:
+#   1. a per-client token bucket rejects clients that send too fast,
+#   2. a global limit caps the number of turns in flight,
+#   3. turns over the limit wait in a bounded priority queue, and are shed with
+#      a fast "busy, retry" answer when the queue is full or the wait too long.
+# A shed turn gives its client's token back: only turns that run count toward
+# the client's rate.
+# admit() blocks a thread while queued; aadmit() is the asyncio equivalent and
+# shares the same slots and queue.
+
+PRIORITY_EMERGENCY = 0
+PRIORITY_SURVIVOR = 1
+PRIORITY_NORMAL = 2
+
+EMERGENCY_PATTERN = re.compile(
+    r"\b(911|emergency|trapped|injur\w*|bleeding|unconscious|can'?t breathe|"
+    r"evacuat\w*|fire (is )?(near|close)|flood\w* (in|into)|rescue|help me|urgent)\b",
+    re.IGNORECASE,
+)
+
+
+def classify_priority(user_input, user_type=None):
+    """
+    Classifies a message for queueing.
+
+    Args:
+        user_input (str): The user's message.
+        user_type (str): Selected persona, e.g. "Survivor/Caregiver", or None.
+
+    Returns:
+        int: PRIORITY_EMERGENCY, PRIORITY_SURVIVOR or PRIORITY_NORMAL (lower is served first).
+    """
+    survivor = user_type == "Survivor/Caregiver"
+    if EMERGENCY_PATTERN.search(user_input or ""):
+        # Emergencies from survivors/caregivers (or users who haven't picked a role yet) go first
+        return PRIORITY_EMERGENCY if survivor or user_type is None else PRIORITY_SURVIVOR
+    return PRIORITY_SURVIVOR if survivor else PRIORITY_NORMAL
+
+
+class Rejected(Exception):
+    """Raised when a turn is not admitted."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"request rejected: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_take(self):
+        """Takes a token if one is available; returns the seconds to wait otherwise (0 on success)."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def give_back(self):
+        """Returns a token taken for a request that was not served."""
+        self.tokens = min(self.capacity, self.tokens + 1.0)
+
+
+class ClientRateLimiter:
+    """Per-client token buckets, bounded to the most recently seen clients."""
+
+    def __init__(self, rate_per_minute=10, burst=5, max_clients=10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, client_key):
+        """Returns 0 if the client may proceed, else the seconds until it may retry."""
+        with self._lock:
+            bucket = self._buckets.get(client_key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[client_key] = bucket
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client_key)
+            return bucket.try_take()
+
+    def refund(self, client_key):
+        """Gives back the token check() took, e.g. when the turn was shed."""
+        with self._lock:
+            bucket = self._buckets.get(client_key)
+            if bucket is not None:
+                bucket.give_back()
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "wake", "client_key", "admitted", "evicted")
+
+    def __init__(self, priority, seq, wake, client_key=None):
+        self.priority = priority
+        self.seq = seq
+        self.wake = wake
+        self.client_key = client_key
+        self.admitted = False
+        self.evicted = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    """
+    Global in-flight limit with a bounded priority wait queue.
+
+    When a turn finishes its slot is handed directly to the highest-priority
+    waiter. When the queue is full, an emergency turn displaces the newest
+    lowest-priority waiter instead of being shed itself.
+    """
+
+    def __init__(self, max_concurrent=8, max_queue=32, max_wait=5.0, rate_limiter=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.rate_limiter = rate_limiter
+        self.in_flight = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.max_queue_depth = 0
+        self.shed = {"rate_limited": 0, "queue_full": 0, "timeout": 0, "displaced": 0}
+
+    def _queue_depth(self):
+        return sum(1 for w in self._queue if not (w.admitted or w.evicted))
+
+    def _displace_for(self, priority):
+        """Evicts the newest waiter with a lower priority than `priority`. Caller holds the lock."""
+        candidates = [w for w in self._queue if not (w.admitted or w.evicted) and w.priority > priority]
+        if not candidates:
+            return False
+        victim = max(candidates, key=lambda w: (w.priority, w.seq))
+        victim.evicted = True
+        victim.wake()
+        return True
+
+    def _refund(self, client_key):
+        if self.rate_limiter is not None and client_key is not None:
+            self.rate_limiter.refund(client_key)
+
+    def _enter(self, priority, client_key, wake):
+        """
+        Admits the turn immediately (returns None) or queues it (returns its _Waiter).
+
+        Raises:
+            Rejected: Rate limited, or the queue is full.
+        """
+        if self.rate_limiter is not None and client_key is not None:
+            retry_after = self.rate_limiter.check(client_key)
+            if retry_after:
+                with self._lock:
+                    self.shed["rate_limited"] += 1
+                raise Rejected("rate_limited", retry_after)
+        try:
+            return self._enqueue(priority, client_key, wake)
+        except Rejected:
+            self._refund(client_key)
+            raise
+
+    def _enqueue(self, priority, client_key, wake):
+        """Takes a slot or a place in the queue; raises Rejected when the queue is full."""
+        with self._lock:
+            if self.in_flight < self.max_concurrent and not self._queue_depth():
+                self.in_flight += 1
+                self.admitted += 1
+                return None
+
+            if self._queue_depth() >= self.max_queue and not (
+                    priority == PRIORITY_EMERGENCY and self._displace_for(priority)):
+                self.shed["queue_full"] += 1
+                raise Rejected("queue_full", self.max_wait)
+
+            waiter = _Waiter(priority, next(self._seq), wake, client_key)
+            heapq.heappush(self._queue, waiter)
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._queue_depth())
+            return waiter
+
+    def _finish_wait(self, waiter):
+        """Settles a waiter once it was woken or its wait ran out."""
+        with self._lock:
+            if waiter.admitted:
+                self.admitted += 1
+                return
+            if waiter.evicted:
+                self.shed["displaced"] += 1
+                reason = "displaced"
+            else:
+                # Timed out: mark it so _release() skips it
+                waiter.evicted = True
+                self.shed["timeout"] += 1
+                reason = "timeout"
+        self._refund(waiter.client_key)
+        raise Rejected(reason, self.max_wait)
+
+    def _release(self):
+        with self._lock:
+            while self._queue:
+                waiter = heapq.heappop(self._queue)
+                if waiter.admitted or waiter.evicted:
+                    continue
+                # Hand the slot over without decrementing in_flight
+                waiter.admitted = True
+                waiter.wake()
+                return
+            self.in_flight -= 1
+
+    @contextmanager
+    def admit(self, priority=PRIORITY_NORMAL, client_key=None):
+        """
+        Holds an in-flight slot for the enclosed block.
+
+        Raises:
+            Rejected: The client is rate limited or the turn was shed.
+        """
+        event = threading.Event()
+        waiter = self._enter(priority, client_key, event.set)
+        if waiter is not None:
+            event.wait(self.max_wait)
+            self._finish_wait(waiter)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def aadmit(self, priority=PRIORITY_NORMAL, client_key=None):
+        """
+        admit() for coroutines: waits in the queue without holding a thread.
+
+        Raises:
+            Rejected: The client is rate limited or the turn was shed.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = self._enter(priority, client_key, lambda: loop.call_soon_threadsafe(event.set))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(event.wait(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                # Gave up while queued: leave the queue, or pass on a slot handed over meanwhile
+                with self._lock:
+                    handed_over = waiter.admitted
+                    waiter.evicted = True
+                if handed_over:
+                    self._release()
+                raise
+            self._finish_wait(waiter)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_concurrent": self.max_concurrent,
+                "queue_depth": self._queue_depth(),
+                "max_queue_depth": self.max_queue_depth,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "shed": dict(self.shed),
+                "shed_total": sum(self.shed.values()),
+            }
@@ -8,13 +8,32 @@ from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 import openai
 from openai import OpenAI
-from flask import Flask, render_template, request, send_from_directory
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from flask import Flask, jsonify, make_response, render_template, request, send_from_directory
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
 import re
 from pydantic import BaseModel, Field
 from typing import Literal
 from pinecone.grpc import PineconeGRPC as Pinecone
 import os
+import atexit
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+from admission import AdmissionController, ClientRateLimiter, Rejected, classify_priority
+from coalescing import SingleFlight
+from compact_vector_store import load_compact_store
+from geo_index import KM_PER_MILE, GeoIndex
+from model_router import ModelRouter, previous_reply
+from prefetch import Prefetcher, ToolResultCache, detect_location
+from conversation_store import DEFAULT_DB_PATH, ConversationStore
+from conversations import Conversation, ConversationRegistry
+from static_assets import (IMMUTABLE_MAX_AGE, ORIGINAL_MAX_AGE, AssetManifest, build_path)
+from resilience import (UpstreamUnavailable, attempt_timeout, call_upstream, current_deadline,
+                        request_deadline, resilience_stats, resilient_get)
+from token_accounting import PromptTooLarge, TokenAccountant
+from tracing import (append_value, record_retrieval, record_shared, record_tool_call, record_value, stage,
+                     start_turn, sub_turn)
 
 class GetCurrentAirQuality(BaseModel):
     latitude: float = Field(..., description="The latitude of the location, e.g., 37.7749")
@@ -37,18 +56,108 @@ pc = Pinecone(api_key=pinecone_api_key)
 index_name = 'cstugpt-dc'  # Your Pinecone index name
 embed_model = "text-embedding-3-small"  # Embedding model
 
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Retries are handled by the resilience layer, so the SDK's own retries are disabled
+client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+
+# End-to-end time budget for one chat turn, in seconds
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', '25'))
+
+# Local copy of the knowledge base, used when Pinecone is unavailable
+local_store = load_compact_store()
+# Identifies the knowledge base contents; part of the request coalescing key
+KB_VERSION = os.getenv('KB_VERSION') or (local_store.header['created'] if local_store else index_name)
+
+# Picks the model and output limit per completion (MODEL_ROUTES_FILE overrides the routes)
+model_router = ModelRouter.from_env()
+
+# Shares one pipeline run between identical first questions (same role, no earlier
+# questions in the conversation) in flight at the same time
+relief_flights = SingleFlight()
+
+# Durable conversation log, written in batches by a background thread (CONVERSATION_DB='' disables it)
+CONVERSATION_DB = os.getenv('CONVERSATION_DB', DEFAULT_DB_PATH)
+conversation_store = ConversationStore(CONVERSATION_DB) if CONVERSATION_DB else None
+if conversation_store is not None:
+    # Commit the turns still queued for the writer when the process exits
+    atexit.register(conversation_store.close)
+CONVERSATION_COOKIE = 'dc_conversation'
+CONVERSATION_COOKIE_MAX_AGE = 30 * 24 * 3600
+
+# Local shelter/resource sites and zip centroids (data/geo), reloaded when the files change
+geo_index = GeoIndex(os.getenv('GEO_DATA_DIR', 'data/geo'))
+SHELTER_RESULTS = 5
+
+# Admission control: per-client rate limit, global in-flight limit and a bounded wait queue
+admission = AdmissionController(
+    max_concurrent=int(os.getenv('MAX_CONCURRENT_TURNS', '8')),
+    max_queue=int(os.getenv('MAX_QUEUED_TURNS', '32')),
+    max_wait=float(os.getenv('MAX_QUEUE_WAIT_SECONDS', '5')),
+    rate_limiter=ClientRateLimiter(
+        rate_per_minute=float(os.getenv('CLIENT_RATE_PER_MINUTE', '10')),
+        burst=int(os.getenv('CLIENT_BURST', '5')),
+    ),
+)
+# Reverse proxies in front of the app whose X-Forwarded-For entries are trusted (0: none)
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '0'))
+
+def forwarded_client_address(remote_addr, forwarded_for):
+    """The client's address as ProxyFix reads it: TRUSTED_PROXIES entries from the end of X-Forwarded-For."""
+    if not TRUSTED_PROXIES or not forwarded_for:
+        return remote_addr
+    addresses = [address.strip() for address in forwarded_for.split(',')]
+    return addresses[-TRUSTED_PROXIES] if len(addresses) >= TRUSTED_PROXIES else remote_addr
+
+def rate_limit_key(conversation_cookie, client_address):
+    """
+    Rate limit bucket of a request: its conversation, so users behind one NAT or proxy
+    don't share a bucket, or its address until the browser has a conversation cookie.
+    """
+    if conversation_cookie:
+        return 'conversation:' + conversation_cookie
+    return 'address:' + client_address if client_address else None
 
 # Flask app setup
 app = Flask(__name__)
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
+# Content-hashed assets produced by build_assets.py (falls back to the originals)
+asset_manifest = AssetManifest()
+app.jinja_env.globals.update(
+    asset_url=asset_manifest.url,
+    asset_image_tag=lambda *args, **kwargs: Markup(asset_manifest.image_tag(*args, **kwargs)),
+    asset_webp_url=asset_manifest.largest_variant_url,
+)
+
+def send_immutable(directory, filename, **kwargs):
+    """Serves a content-hashed file that browsers may cache forever."""
+    response = send_from_directory(directory, filename, max_age=IMMUTABLE_MAX_AGE, **kwargs)
+    response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return response
 
 @app.route('/images/<path:filename>')
 def images(filename):
-    return send_from_directory('images', filename)
+    if asset_manifest.is_hashed(filename):
+        return send_immutable(build_path('images'), filename)
+    # ETag and Last-Modified let the browser revalidate with a 304
+    return send_from_directory('images', filename, max_age=ORIGINAL_MAX_AGE)
 
 @app.route('/css/<path:filename>')
 def css(filename):
-    return send_from_directory('css', filename)
+    if not asset_manifest.is_hashed(filename):
+        return send_from_directory('css', filename, max_age=ORIGINAL_MAX_AGE)
+
+    # Serve the precompressed copy the client accepts, if the build made one
+    css_dir = build_path('css')
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and os.path.exists(os.path.join(css_dir, filename + suffix)):
+            response = send_immutable(css_dir, filename + suffix, mimetype='text/css')
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_immutable(css_dir, filename)
+    response.vary.add('Accept-Encoding')
+    return response
 
 #***********************************
 # User define functions
@@ -129,7 +238,8 @@ def send_email(to, subject, body):
             html_content=BODY_HTML
         )
         sg = SendGridAPIClient(SENDGRID_API_KEY)
-        response = sg.send(message)
+        # Sending is not idempotent, so it is never retried
+        response = call_upstream("sendgrid", sg.send, message, idempotent=False)
 
         if response.status_code in (200, 202):
             print(f"Email sent! Status Code: {response.status_code}")
@@ -155,16 +265,19 @@ def get_current_weather(latitude, longitude):
         dict: Weather data including temperature in Celsius and Fahrenheit, wind speed, and humidity.
     """
     try:
-        # Open-Meteo API endpoint with required parameters
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current_weather=true"
-        
-        # Make the GET request
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        
-        # Parse the JSON response
-        data = response.json()
-        
+        # Make the GET request (raises for HTTP errors)
+        response = resilient_get("open-meteo", weather_url(latitude, longitude))
+        return weather_from_data(response.json(), latitude, longitude)
+    except (requests.RequestException, UpstreamUnavailable) as e:
+        return {"error": f"Failed to fetch weather data: {str(e)}"}
+
+def weather_url(latitude, longitude):
+    # Open-Meteo API endpoint with required parameters
+    return f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current_weather=true"
+
+def weather_from_data(data, latitude, longitude):
+    """Extracts the tool result from an Open-Meteo response."""
+    try:
         # Extract relevant weather information
         if "current_weather" in data:
             current_weather = data["current_weather"]
@@ -180,60 +293,42 @@ def get_current_weather(latitude, longitude):
             }
         else:
             return {"error": "Current weather data not available"}
-    except requests.RequestException as e:
-        return {"error": f"Failed to fetch weather data: {str(e)}"}
     except KeyError:
         return {"error": "Unexpected response format"}
     
-def get_shelter_info(zipcode):
+def get_shelter_info(zipcode=None, latitude=None, longitude=None, radius_miles=25):
     """
-    Fetches shelter-related information near a given latitude and longitude using FEMA's Open API data.
+    Looks up the shelters and resource sites nearest to a zip code or coordinates in the local geo index.
 
     Args:
-        zipcode (int): Zipcode of the location.
+        zipcode (str): Zip code of the location, used when coordinates are not given.
+        latitude (float): Latitude of the location.
+        longitude (float): Longitude of the location.
+        radius_miles (float): Only sites within this distance are returned.
 
     Returns:
-        dict: Information about nearby shelters, including location, capacity, and disaster type.
+        dict: Up to SHELTER_RESULTS nearby sites with their distance, plus the Red Cross
+        search link for the zip code.
     """
-    try:
-        # Step 1: Fetch disaster-related data from Red Cross Open API
-        arc_url = "https://resources.redcross.org/search_results/{zipcode}?widget=redcrossdisasterresources&ref=DCSclient"
-        arc_params = {
-            "zipcode": zipcode,
-        }
-
-        arc_params_response = requests.get(arc_url, params=arc_params)
-        arc_params_response.raise_for_status()
-
-        # Parse FEMA response
-        fema_data = arc_params_response.json()
-
-        # Step 2: Process FEMA disaster-related data
-        shelters = []
-
-        for disaster in fema_data.get("data", []):
-            # Filter for disaster types that generally require shelters
-            disaster_info = {
-                "disaster_id": disaster.get("disasterNumber"),
-                "disaster_name": disaster.get("incidentType"),
-                "disaster_state": disaster.get("state"),
-                "disaster_date": disaster.get("declarationDate"),
-                "incident_begin_date": disaster.get("incidentBeginDate"),
-                "incident_end_date": disaster.get("incidentEndDate"),
-                "shelter_needed": disaster.get("incidentType") in ["Hurricane", "Flood", "Tornado", "Wildfire"],  # Example filter
-                "affected_area": disaster.get("incidentBeginDate")
-            }
-
-            shelters.append(disaster_info)
-
-        return {
-            "zipcode": zipcode,
-        }
-        
-    except requests.RequestException as e:
-        return {"error": f"Failed to fetch shelter or disaster data: {str(e)}"}
-    except KeyError:
-        return {"error": "Unexpected response format"}
+    redcross_url = f"https://resources.redcross.org/search_results/{zipcode}" if zipcode else \
+        "https://resources.redcross.org/search_results"
+
+    if latitude is None or longitude is None:
+        location = geo_index.zip_location(zipcode) if zipcode else None
+        if location is None:
+            return {"error": "Unknown location; ask the user for their zip code or coordinates.",
+                    "redcross_search": redcross_url}
+        latitude, longitude = location
+
+    sites = geo_index.nearest(latitude, longitude, n=SHELTER_RESULTS, max_km=radius_miles * KM_PER_MILE)
+    for site in sites:
+        site["distance_miles"] = round(site.pop("distance_km") / KM_PER_MILE, 1)
+
+    result = {"zipcode": zipcode, "latitude": latitude, "longitude": longitude,
+              "sites": sites, "redcross_search": redcross_url}
+    if not sites:
+        result["note"] = f"No sites in the local data within {radius_miles} miles."
+    return result
 
 def get_current_airquality(latitude, longitude, date, distance = 25, format = 'application/json'):
     """
@@ -291,15 +386,19 @@ def get_current_airquality(latitude, longitude, date, distance = 25, format = 'a
 </ForecastByLatLonList>
     """
     try:
-        # Open-Meteo API endpoint with required parameters
-        url = f"https://www.airnowapi.org/aq/forecast/latLong/?format={format}&latitude={latitude}&longitude={longitude}&date={date}&distance={distance}&API_KEY=D79713AA-E89D-47F5-9F30-AA857EB839A7"
+        # Make the GET request (raises for HTTP errors)
+        response = resilient_get("airnow", airquality_url(latitude, longitude, date, distance, format))
+        return airquality_from_data(response.json())
+    except (requests.RequestException, UpstreamUnavailable) as e:
+        return {"error": f"Failed to fetch air quality data: {str(e)}"}
 
-        # Make the GET request
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for HTTP errors
+def airquality_url(latitude, longitude, date, distance=25, format='application/json'):
+    # AirNow API endpoint with required parameters
+    return f"https://www.airnowapi.org/aq/forecast/latLong/?format={format}&latitude={latitude}&longitude={longitude}&date={date}&distance={distance}&API_KEY=D79713AA-E89D-47F5-9F30-AA857EB839A7"
 
-        # Parse the JSON response
-        data = response.json()
+def airquality_from_data(data):
+    """Extracts the tool result from an AirNow forecast response."""
+    try:
         #print(data)
 
         if data:
@@ -324,8 +423,6 @@ def get_current_airquality(latitude, longitude, date, distance = 25, format = 'a
           return response_text
         else:
           return {"error": "No data available"}
-    except requests.RequestException as e:
-        return {"error": f"Failed to fetch air quality data: {str(e)}"}
     except KeyError:
         return {"error": "Unexpected response format"}
     
@@ -383,14 +480,94 @@ tools = [
         }
     }, 
     openai.pydantic_function_tool(GetCurrentAirQuality),
+    {
+        "type": "function",
+        "function": {
+            "name": "get_shelter_info",
+            "description": "Find the nearest shelters and disaster resource sites to a zip code or latitude/longitude.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "zipcode": {
+                        "type": ["string", "null"],
+                        "description": "The 5-digit zip code of the location, e.g., 94103",
+                    },
+                    "latitude": {
+                        "type": ["number", "null"],
+                        "description": "The latitude of the location, e.g., 37.7749",
+                    },
+                    "longitude": {
+                        "type": ["number", "null"],
+                        "description": "The longitude of the location, e.g., -122.4194",
+                    },
+                    "radius_miles": {
+                        "type": "number",
+                        "description": "Search radius in miles, e.g., 25",
+                    }
+                },
+                "required": ["zipcode", "latitude", "longitude", "radius_miles"],
+                "additionalProperties": False
+            },
+            "strict": True
+        }
+    },
 ]
 
 available_functions = {
     "GetCurrentAirQuality": get_current_airquality,
     "get_current_weather": get_current_weather,
     "send_email": send_email,
+    "get_shelter_info": get_shelter_info,
+}
+
+# Without local sites the shelter tool could only answer "nothing found", so the
+# model isn't offered it until data/geo has sites
+tools_without_shelters = [tool for tool in tools if tool["function"]["name"] != "get_shelter_info"]
+
+def offered_tools():
+    """The tool definitions to send with a prompt: every tool, less get_shelter_info while the geo index has no sites."""
+    geo_index.maybe_reload()
+    return tools if len(geo_index) else tools_without_shelters
 
+# Read-only tools whose results are cached (seconds to live); send_email is never cached
+TOOL_CACHE_TTLS = {
+    "get_current_weather": 600,
+    "GetCurrentAirQuality": 1800,
+    "get_shelter_info": 300,
 }
+tool_cache = ToolResultCache(TOOL_CACHE_TTLS)
+# Warms tool_cache in the background as soon as a user's location is known
+tool_prefetcher = Prefetcher(tool_cache, max_workers=int(os.getenv('PREFETCH_WORKERS', '4')))
+
+def prefetch_location_tools(user_input):
+    """
+    Starts the weather, air quality and shelter lookups for a location mentioned
+    in the user's message, with the same arguments the model would use.
+    """
+    # A bare 5-digit number only counts as a zip code if the geo data knows it
+    location = detect_location(user_input, is_known_zip=lambda zipcode: geo_index.zip_location(zipcode) is not None)
+    if location is None:
+        return
+    has_sites = len(geo_index) > 0
+    zipcode = location.get("zipcode")
+    if zipcode:
+        if has_sites:
+            tool_prefetcher.prefetch("get_shelter_info", {"zipcode": zipcode, "latitude": None,
+                                     "longitude": None, "radius_miles": 25}, get_shelter_info)
+        coordinates = geo_index.zip_location(zipcode)
+        if coordinates is None:
+            return
+        latitude, longitude = coordinates
+    else:
+        latitude, longitude = location["latitude"], location["longitude"]
+        if has_sites:
+            tool_prefetcher.prefetch("get_shelter_info", {"zipcode": None, "latitude": latitude,
+                                     "longitude": longitude, "radius_miles": 25}, get_shelter_info)
+
+    tool_prefetcher.prefetch("get_current_weather", {"latitude": latitude, "longitude": longitude},
+                             get_current_weather)
+    tool_prefetcher.prefetch("GetCurrentAirQuality", {"latitude": latitude, "longitude": longitude,
+                             "date": datetime.date.today().strftime("%Y-%m-%d")}, get_current_airquality)
 #***********************************
 # Helper functions
 #***********************************
@@ -405,24 +582,29 @@ def process_message_content(content):
     # Pattern for parenthetical image references (i.e. (images/some_image.jpg))
     pattern3 = r'\(images/([^)]+)\)'
 
-    # Replace <image> tags with <img> tags
+    def image_name(path):
+        # <image> tags in the resources may or may not include the images/ prefix
+        path = path.strip()
+        return path[len('images/'):] if path.startswith('images/') else path
+
+    # Replace <image> tags with <img> tags (in a <picture> with the built variants)
     content = re.sub(
         pattern1, 
-        r'<img src="/images/\1" alt="Resource Image" class="chat-image" />', 
+        lambda m: asset_manifest.image_tag(image_name(m.group(1)), "Resource Image"),
         content
     )
 
     # Replace Markdown-style image references with <img> tags
     content = re.sub(
         pattern2,
-        lambda m: f'<img src="/{m.group(2)}" alt="{m.group(1)}" class="chat-image" />',
+        lambda m: asset_manifest.image_tag(image_name(m.group(2)), m.group(1)),
         content
     )
 
     # Replace parenthetical image references with <img> tags
     content = re.sub(
         pattern3, 
-        r'<img src="/images/\1" alt="Resource Image" class="chat-image" />', 
+        lambda m: asset_manifest.image_tag(m.group(1), "Resource Image"),
         content
     )
 
@@ -534,6 +716,7 @@ provider_resources = get_addition_resources('data/user_type_resources/provider.t
 public_resources = get_addition_resources('data/user_type_resources/concerned_public.txt')
 relief_org_resources = get_addition_resources('data/user_type_resources/relief_organiztion.txt')
 
+# Every conversation's context starts with this static developer prompt
 chatContext = [
     {'role': 'developer', 'content': f"""
 Objective: You are a smart, friendly virtual assistant tasked with assisting individuals affected by disasters, with context-aware responses based on the user's type.
@@ -580,6 +763,27 @@ Your primary goal is to assist and empower users by delivering reliable, context
     },
 ]
 
+# Counts every prompt by source before it is sent and refuses runaway prompts.
+# The static developer prompt and tool schemas are tokenized once, here.
+token_accountant = TokenAccountant(GPT_MODEL, max_prompt_tokens=int(os.getenv('MAX_PROMPT_TOKENS', '30000')))
+token_accountant.register_static(chatContext[0]['content'])
+token_accountant.register_tools(tools)
+token_accountant.register_tools(tools_without_shelters)
+
+BUSY_MESSAGE = "Busy, please retry shortly."
+
+PROMPT_TOO_LARGE_MESSAGE = """
+I'm sorry, that message is too long for me to process. Please try a shorter question.
+"""
+
+TOO_MUCH_INFORMATION_MESSAGE = """
+I'm sorry, I found more information for that question than I can process at once. Please ask about one thing at a time.
+"""
+
+def prompt_too_large_reply(error):
+    """The apology for a refused turn: the user's message itself, or what retrieval and tools added to it."""
+    return PROMPT_TOO_LARGE_MESSAGE if error.category == "user" else TOO_MUCH_INFORMATION_MESSAGE
+
 # Pinecone Functions
 def query_pinecone(user_input, namespace='dc', top_k=3):
     """
@@ -591,66 +795,134 @@ def query_pinecone(user_input, namespace='dc', top_k=3):
         top_k (int): Number of results to return.
     
     Returns:
-        list: List of relevant text chunks from Pinecone.
+        list: List of relevant text chunks from Pinecone. Falls back to the local
+        compact store when Pinecone is unavailable, and to no chunks at all when
+        the embedding cannot be computed.
     """
     # Generate embedding for the user input
-    res = client.embeddings.create(input=user_input, model=embed_model)
+    try:
+        with stage('embedding'):
+            res = call_upstream("openai-embeddings", lambda: client.embeddings.create(
+                input=user_input, model=embed_model, timeout=attempt_timeout(5)))
+    except UpstreamUnavailable as e:
+        print(f"Skipping retrieval: {e}")
+        return []
     embed = res.data[0].embedding
     
     # Query Pinecone
     index = pc.Index(index_name)
-    query_response = index.query(
-        vector=embed,
-        top_k=top_k,
-        include_metadata=True,
-        namespace=namespace
-    )
+    try:
+        with stage('retrieval'):
+            query_response = call_upstream("pinecone", lambda: index.query(
+                vector=embed,
+                top_k=top_k,
+                include_metadata=True,
+                namespace=namespace,
+                timeout=attempt_timeout(5)
+            ))
+    except UpstreamUnavailable as e:
+        if local_store is None:
+            print(f"Skipping retrieval: {e}")
+            return []
+        print(f"Using local vector store: {e}")
+        with stage('retrieval_local'):
+            results = local_store.search(embed, top_k=top_k)
+        record_retrieval([record_id for record_id, _, _ in results])
+        return [text for _, _, text in results]
     
     # Extract relevant text chunks
+    record_retrieval([match.id for match in query_response.matches])
     relevant_chunks = [match.metadata['text'] for match in query_response.matches]
     return relevant_chunks
 
 
 
-# Store conversation history (global variable for simplicity)
-chat_history = []
+# Conversations in memory (MAX_CONVERSATIONS), keyed by the conversation cookie
+MAX_CONVERSATIONS = int(os.getenv('MAX_CONVERSATIONS', '1000'))
 
-@retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(3))
-def chat_completion_request(messages, temperature=0, tools=None, tool_choice=None, model=GPT_MODEL):
-    try:
-        response = client.chat.completions.create(
+# Recent successful answers, served when the model is unavailable
+ANSWER_CACHE_SIZE = 256
+answer_cache = OrderedDict()
+
+DEGRADED_MODE_MESSAGE = """
+I'm having trouble reaching my knowledge services right now, so I can't give you a detailed answer.
+<br><br>
+If you are facing an emergency, please call <b>911</b> immediately.
+<br>
+To find a shelter near you, visit <a href="https://resources.redcross.org/search_results" target="_blank" class="chat-link">Red Cross Disaster Resources</a>
+and enter your zip code.
+<br><br>
+Please try your question again in a few minutes.
+"""
+
+def normalize_question(user_input):
+    """Normalizes a question for cache lookups."""
+    return " ".join(user_input.lower().split())
+
+def remember_answer(user_input, processed_response):
+    answer_cache[normalize_question(user_input)] = processed_response
+    answer_cache.move_to_end(normalize_question(user_input))
+    while len(answer_cache) > ANSWER_CACHE_SIZE:
+        answer_cache.popitem(last=False)
+
+def chat_completion_request(messages, temperature=0, tools=None, tool_choice=None, model=GPT_MODEL,
+                            max_tokens=None):
+    """
+    Chat completion through the resilience layer. Successful call latencies feed the model router.
+
+    Raises:
+        PromptTooLarge: The current turn alone is over a token limit; nothing was sent.
+        UpstreamUnavailable: The model could not be reached within the request deadline.
+    """
+    # Long conversations lose their oldest history here rather than being refused
+    messages, prompt_tokens = token_accountant.fit(messages, tools)
+    append_value('prompt_tokens', prompt_tokens)
+    print(f"Prompt tokens for {model}: {prompt_tokens}")
+    with stage('completion'):
+        started = time.monotonic()
+        response = call_upstream("openai", lambda: client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
             tools=tools,
             tool_choice=tool_choice,
-        )
+            max_tokens=max_tokens,
+            timeout=attempt_timeout(),
+        ))
+        model_router.observe(model, time.monotonic() - started)
+        token_accountant.record_usage(prompt_tokens, getattr(response, 'usage', None))
         return response
-    except Exception as e:
-        print("Unable to generate ChatCompletion response")
-        print(f"Exception: {e}")
-        return e
     
-def chat_complete_messages(messages, temperature=0):
+def chat_complete_messages(messages, temperature=0, model=GPT_MODEL, max_tokens=None):
     try:
-        response = client.chat.completions.create(
-            model=GPT_MODEL,
-            messages=messages,
-            temperature=temperature,
-        )
+        response = chat_completion_request(messages, temperature=temperature, model=model,
+                                           max_tokens=max_tokens)
         return response.choices[0].message.content
     except Exception as e:
         print(f"Error with OpenAI API: {e}")
         return "Sorry, there was an issue processing your request."
 
-def get_initial_greeting():
+# The greeting doesn't depend on the conversation, so it is generated once and shared
+initial_greeting = None
+initial_greeting_lock = threading.Lock()
+
+def generate_greeting():
+    global initial_greeting
+    with initial_greeting_lock:
+        if initial_greeting is None:
+            # Get bot's initial greeting
+            route = model_router.route(None, purpose="persona")
+            response = chat_completion_request([
+                {'role': 'system', 'content': chatContext[0]['content']},
+                {'role': 'user', 'content': 'Provide a compassionate and informative initial greeting for a disaster relief chatbot.'}
+            ], 0, model=route.model, max_tokens=route.max_tokens)
+            initial_greeting = response.choices[0].message.content
+        return initial_greeting
+
+def get_initial_greeting(conversation):
     timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
     try:
-        # Get bot's initial greeting
-        greeting = chat_complete_messages([
-            {'role': 'system', 'content': chatContext[0]['content']},
-            {'role': 'user', 'content': 'Provide a compassionate and informative initial greeting for a disaster relief chatbot.'}
-        ], 0)
+        greeting = generate_greeting()
         
         # Append user type selection prompt to the greeting with better formatting
         user_type_prompt = """
@@ -673,8 +945,8 @@ def get_initial_greeting():
         full_greeting = greeting + user_type_prompt
         
         # Add greeting to chat history and context
-        chat_history.append((full_greeting, "bot", timestamp))
-        chatContext.append({'role': 'assistant', 'content': full_greeting})
+        conversation.chat_history.append((full_greeting, "bot", timestamp))
+        conversation.context.append({'role': 'assistant', 'content': full_greeting})
         
         return full_greeting
     except Exception as e:
@@ -696,76 +968,217 @@ def get_initial_greeting():
         <br><br>
         Please respond with the number that corresponds to your role, or feel free to ask any question directly.
         """
-        chat_history.append((error_message, "bot", timestamp))
+        conversation.chat_history.append((error_message, "bot", timestamp))
         return error_message
         
-def get_disaster_relief_response(user_input):
+ReliefAnswer = namedtuple('ReliefAnswer', ['content', 'context_messages', 'used_tools'])
+
+def tool_call_arguments(tool_call):
+    """Returns the function name and arguments of a tool call, with the arguments we fill in ourselves."""
+    function_name = tool_call.function.name
+    function_args = json.loads(tool_call.function.arguments)
+    if function_name == 'GetCurrentAirQuality':
+        function_args['date'] = datetime.date.today().strftime("%Y-%m-%d")
+    return function_name, function_args
+
+def tool_result_message(tool_call, function_name, function_args, function_response):
+    record_tool_call(function_name, function_args, function_response)
+    return {
+        "role": "tool",
+        "tool_call_id": tool_call.id,
+        "content": json.dumps(function_response),
+    }
+
+def generate_relief_answer(messages, user_input):
+    """
+    Runs retrieval, the completion and any tool calls for one turn.
+
+    Args:
+        messages (list): Conversation so far, ending with the user's message. Not modified.
+        user_input (str): The user's message.
+
+    Returns:
+        ReliefAnswer: The model's reply, the messages to append to the context, and
+        whether any tools were called.
+    """
+    messages = list(messages)
+    context_messages = []
+    route = model_router.route(user_input, previous_reply=previous_reply(messages))
+    record_value('route', route.name)
+    route_tools = offered_tools() if route.tools else None
+    route_tool_choice = "auto" if route.tools else None
+
+    # Step 1: Query Pinecone for relevant information
+    relevant_chunks = query_pinecone(user_input)
+    pinecone_context = "\n\nAdditional Information:\n" + "\n".join(relevant_chunks)
+    
+    # Step 2: Add Pinecone context to the chat context
+    context_messages.append({'role': 'system', 'content': pinecone_context})
+    messages.append(context_messages[-1])
+    
+    # Step 3: Get bot response
+    response_message = chat_completion_request(messages, temperature=0, tools=route_tools, tool_choice=route_tool_choice,
+                                               model=route.model, max_tokens=route.max_tokens)
+    assistant_message = response_message.choices[0].message
+    response_message_content = assistant_message.content
+    
+    tool_calls = assistant_message.tool_calls
+    
+    if tool_calls:
+        # Handle tool calls: run them all, then ask the model once with every result
+        context_messages.append(assistant_message)
+        for tool_call in tool_calls:
+            function_name, function_args = tool_call_arguments(tool_call)
+            function_to_call = available_functions[function_name]
+            
+            with stage('tool:' + function_name):
+                if function_name in TOOL_CACHE_TTLS:
+                    function_response = tool_cache.call(function_name, function_args, function_to_call)
+                else:
+                    function_response = function_to_call(**function_args)
+            context_messages.append(tool_result_message(tool_call, function_name, function_args, function_response))
+
+        messages.extend(context_messages[1:])
+        response_message = chat_completion_request(messages, temperature=0, tools=route_tools,
+                                                   tool_choice=route_tool_choice, model=route.model,
+                                                   max_tokens=route.max_tokens)
+        response_message_content = response_message.choices[0].message.content
+
+    return ReliefAnswer(response_message_content, context_messages, bool(tool_calls))
+
+def stateless_messages(conversation, user_input):
+    """
+    Builds the prompt for a turn whose answer can't depend on earlier questions.
+
+    That holds until the conversation's first question has been answered. The prompt
+    is then the static context, greeting, role selection and this question, regardless
+    of other questions still in flight.
+
+    Returns:
+        list or None: The messages, or None if the turn depends on the conversation.
+    """
+    if conversation.answered_questions:
+        return None
+    base = [m for m in conversation.context
+            if isinstance(m, dict) and m.get('role') != 'tool'
+            and (m.get('role') != 'user' or m['content'].strip() in ('1', '2', '3', '4'))]
+    return base + [{'role': 'user', 'content': user_input}]
+
+ReliefTurn = namedtuple('ReliefTurn', ['conversation', 'user_input', 'user_message', 'history_entry', 'timestamp'])
+
+def begin_relief_turn(conversation, user_input):
+    """Adds the user's message to the history and context and starts location prefetches."""
     timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
     
     # Add user message to chat history and context
-    chat_history.append((user_input, "user", timestamp))
-    chatContext.append({'role': 'user', 'content': user_input})
+    history_entry = (user_input, "user", timestamp)
+    conversation.chat_history.append(history_entry)
+    user_message = {'role': 'user', 'content': user_input}
+    conversation.context.append(user_message)
+    prefetch_location_tools(user_input)
+    return ReliefTurn(conversation, user_input, user_message, history_entry, timestamp)
+
+def relief_flight_key(conversation, user_input):
+    # Identical first questions in flight at the same time share one answer
+    return (normalize_question(user_input), conversation.user_type, KB_VERSION)
+
+def relief_flight_timeout():
+    """Seconds a coalesced turn may wait for the identical one in flight: the rest of its deadline."""
+    deadline = current_deadline()
+    return deadline.remaining() if deadline is not None else None
+
+def traced_relief_answer(messages, user_input):
+    """generate_relief_answer() with the trace it recorded, which followers of a coalesced turn copy."""
+    with sub_turn() as trace:
+        return generate_relief_answer(messages, user_input), trace
+
+def finish_relief_turn(turn, answer):
+    """Records a ReliefAnswer in the context and history and returns the formatted reply."""
+    conversation = turn.conversation
+    conversation.context.extend(answer.context_messages)
+    response_message_content = answer.content
+    record_value('raw_reply', response_message_content)
+
+    # Step 4: Format and return the response
+    formatted_response = process_text_message_content(response_message_content)
+    processed_response = process_message_content(formatted_response)
+    
+    conversation.context.append({'role': 'assistant', 'content': f"{response_message_content}"})
+    # History no prompt could carry is dropped, so the stored context stops growing
+    conversation.context[:] = token_accountant.bound_history(conversation.context)
+    conversation.chat_history.append((processed_response, "bot", turn.timestamp))
+    remember_answer(turn.user_input, processed_response)
+    conversation.answered_questions += 1
+    
+    return processed_response
+
+def abandon_relief_turn(turn, reply=None):
+    """
+    Drops the user's message from the context so it doesn't affect later turns.
+    Records `reply` in the history, or without a reply drops the message there too.
+    """
+    conversation = turn.conversation
+    conversation.context[:] = [m for m in conversation.context if m is not turn.user_message]
+    if reply is None:
+        conversation.chat_history[:] = [entry for entry in conversation.chat_history
+                                        if entry is not turn.history_entry]
+    else:
+        conversation.chat_history.append((reply, "bot", turn.timestamp))
+    return reply
+
+def degraded_relief_reply(turn, error):
+    # Degraded mode: serve a cached answer for the same question, or a static one
+    print(f"Model unavailable, answering in degraded mode: {error}")
+    degraded_response = answer_cache.get(normalize_question(turn.user_input), DEGRADED_MODE_MESSAGE)
+    turn.conversation.context.append({'role': 'assistant', 'content': degraded_response})
+    turn.conversation.chat_history.append((degraded_response, "bot", turn.timestamp))
+    return degraded_response
+
+def get_disaster_relief_response(conversation, user_input):
+    turn = begin_relief_turn(conversation, user_input)
 
     try:
-        # Step 1: Query Pinecone for relevant information
-        relevant_chunks = query_pinecone(user_input)
-        pinecone_context = "\n\nAdditional Information:\n" + "\n".join(relevant_chunks)
-        
-        # Step 2: Add Pinecone context to the chat context
-        chatContext.append({'role': 'system', 'content': pinecone_context})
-        
-        # Step 3: Get bot response
-        response_message = chat_completion_request(chatContext, temperature=0, tools=tools, tool_choice="auto")
-        assistant_message = response_message.choices[0].message
-        response_message_content = assistant_message.content
-        
-        tool_calls = assistant_message.tool_calls
-        
-        if tool_calls:
-            # Handle tool calls (existing logic)
-            chatContext.append(assistant_message)
-            for tool_call in tool_calls:
-                function_name = tool_call.function.name
-                function_to_call = available_functions[function_name]
-                function_args = json.loads(tool_call.function.arguments)
-                
-                if function_name == 'GetCurrentAirQuality':
-                    function_args['date'] = datetime.date.today().strftime("%Y-%m-%d")
-                
-                function_response = function_to_call(**function_args)
-                function_response_str = json.dumps(function_response)
-                
-                chatContext.append(
-                    {
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": function_response_str,
-                    }
-                )
-                response_message = chat_completion_request(chatContext, temperature=0, tools=tools, tool_choice="auto")
-                response_message_content = response_message.choices[0].message.content
+        messages = stateless_messages(conversation, user_input)
+        if messages is not None:
+            (answer, leader_trace), shared = relief_flights.do(relief_flight_key(conversation, user_input),
+                                                               lambda: traced_relief_answer(messages, user_input),
+                                                               timeout=relief_flight_timeout())
+            if shared and answer.used_tools:
+                # Tool calls can have side effects (e.g. email), so don't reuse them
+                relief_flights.record_bypass(follower=True)
+                shared = False
+                answer = generate_relief_answer(messages, user_input)
+            elif shared:
+                # The leader's retrieval ids, tool calls and stage timings produced this answer
+                record_shared(leader_trace)
+            record_value('coalesced', shared)
+        else:
+            relief_flights.record_bypass()
+            answer = generate_relief_answer(conversation.context, user_input)
 
-        # Step 4: Format and return the response
-        formatted_response = process_text_message_content(response_message_content)
-        processed_response = process_message_content(formatted_response)
-        
-        chatContext.append({'role': 'assistant', 'content': f"{response_message_content}"})
-        chat_history.append((processed_response, "bot", timestamp))
-        
-        return processed_response
+        return finish_relief_turn(turn, answer)
+
+    except PromptTooLarge as e:
+        # Nothing was sent; drop the message so it isn't part of later prompts
+        print(f"Refusing oversized prompt: {e}")
+        return abandon_relief_turn(turn, prompt_too_large_reply(e))
+
+    except (UpstreamUnavailable, TimeoutError) as e:
+        # TimeoutError: the identical question this turn was waiting on outlived the deadline
+        return degraded_relief_reply(turn, e)
         
     except Exception as e:
         print(f"Error processing response: {e}")
         return f"I apologize, but I encountered an error while processing your request. Please try again."
          
     
-def process_user_type_selection(user_input):
+def process_user_type_selection(conversation, user_input):
     """Process user type selection and generate appropriate response"""
     timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
     
     # Add user message to chat history and context
-    chat_history.append((user_input, "user", timestamp))
-    chatContext.append({'role': 'user', 'content': user_input})
+    conversation.chat_history.append((user_input, "user", timestamp))
+    conversation.context.append({'role': 'user', 'content': user_input})
     
     user_type_map = {
         '1': 'Survivor/Caregiver',
@@ -790,14 +1203,16 @@ def process_user_type_selection(user_input):
         <br>
         &emsp;4. Relief Organization
         """
-        chat_history.append((error_message, "bot", timestamp))
+        conversation.chat_history.append((error_message, "bot", timestamp))
         return error_message
     
     # Get the selected user type
     user_type = user_type_map[user_input]
+    conversation.user_type = user_type
     
     # Generate context-specific guidance
     try:
+        route = model_router.route(user_input, purpose="persona")
         user_type_guidance = chat_complete_messages([{
             'role': 'system', 'content': f"""
             You are a disaster relief chatbot. Provide specific, compassionate guidance for a {user_type} in a disaster situation.
@@ -810,7 +1225,7 @@ def process_user_type_selection(user_input):
             """
         }, {
             'role': 'user', 'content': f'First, state the selected user type. Generate a detailed, supportive initial guidance for a {user_type} during a disaster relief effort.'
-        }], 0)
+        }], 0, model=route.model, max_tokens=route.max_tokens)
 
         # Apply the same formatting logic as in get_disaster_relief_response
         formatted_response = process_text_message_content(user_type_guidance)
@@ -819,13 +1234,11 @@ def process_user_type_selection(user_input):
         processed_response = process_message_content(formatted_response)
         
         # Append to chat history
-        chat_history.append((processed_response, "bot", timestamp))
+        conversation.chat_history.append((processed_response, "bot", timestamp))
         
         # Update context to reflect user type
-        chatContext.append({
-            'role': 'system', 
-            'content': f'The user is identified as a {user_type}. Tailor all subsequent responses to their specific needs and context.'
-        })
+        conversation.persona_index = len(conversation.context)
+        conversation.context.append(persona_message(user_type))
         
         return processed_response
     except Exception as e:
@@ -837,31 +1250,139 @@ def process_user_type_selection(user_input):
         <br>
         What specific assistance do you need right now?
         """
-        chat_history.append((fallback_message, "bot", timestamp))
+        conversation.chat_history.append((fallback_message, "bot", timestamp))
         return fallback_message
     
+def persona_message(user_type):
+    """The system message telling the model which role the user selected."""
+    return {
+        'role': 'system',
+        'content': f'The user is identified as a {user_type}. Tailor all subsequent responses to their specific needs and context.'
+    }
+
+def rehydrate_conversation(conversation):
+    """
+    Restores a conversation's history and context from the conversation log, e.g. after a restart.
+
+    Returns:
+        bool: True if the conversation was found and restored.
+    """
+    if conversation_store is None:
+        return False
+
+    turns = conversation_store.load_conversation(conversation.id)
+    for turn in turns:
+        conversation.chat_history.append((turn['content'], turn['role'], turn['created_at']))
+        role = 'assistant' if turn['role'] == 'bot' else 'user'
+        conversation.context.append({'role': role, 'content': turn['raw_content'] or turn['content']})
+        if turn['role'] == 'user' and turn['content'].strip() not in ('1', '2', '3', '4'):
+            conversation.answered_questions += 1
+        if turn['user_type'] and turn['user_type'] != conversation.user_type:
+            # The role was selected at this turn, so the model was told about it here
+            conversation.user_type = turn['user_type']
+            conversation.persona_index = len(conversation.context)
+            conversation.context.append(persona_message(conversation.user_type))
+
+    return bool(turns)
+
+def load_conversation(conversation_id):
+    """Creates the in-memory state of a conversation, restored from the log if it has one."""
+    conversation = Conversation(conversation_id, chatContext)
+    rehydrate_conversation(conversation)
+    return conversation
+
+conversations = ConversationRegistry(load_conversation, max_conversations=MAX_CONVERSATIONS)
+
+def log_turn(conversation, role, content, trace=None):
+    """Queues a turn for the conversation log; never blocks on disk."""
+    if conversation_store is None:
+        return
+    if trace is None:
+        conversation_store.record_turn(conversation.id, role, content, user_type=conversation.user_type)
+        return
+    conversation_store.record_turn(
+        conversation.id, role, content,
+        raw_content=trace.values.get('raw_reply'),
+        user_type=conversation.user_type,
+        tool_calls=trace.tool_calls,
+        retrieval_ids=trace.retrieval_ids,
+        timings=trace.timings_ms(),
+        prompt_tokens=trace.values.get('prompt_tokens'),
+    )
+
+def ensure_greeting(conversation):
+    # Send initial greeting if chat history is empty (a restored conversation already has one)
+    if not conversation.chat_history:
+        # The greeting is a model call too, so it gets the same time budget as a turn
+        with request_deadline(REQUEST_DEADLINE_SECONDS):
+            greeting = get_initial_greeting(conversation)
+        log_turn(conversation, "bot", greeting)
+
+def is_role_selection(conversation, user_input):
+    """True when the user is answering the role question with a number."""
+    chat_history = conversation.chat_history
+    return bool(chat_history) and "tell me your role" in chat_history[-1][0].lower() \
+        and user_input.strip() in ['1', '2', '3', '4']
+
+def rejected_response_parts(rejected):
+    """Status code and headers for a turn that was not admitted."""
+    # Shed fast so the client can retry instead of waiting on a saturated server
+    status = 429 if rejected.reason == "rate_limited" else 503
+    return status, {'Retry-After': str(max(1, int(rejected.retry_after + 0.5)))}
+
+def server_timing_header(trace):
+    # Per-stage timings for browser dev tools and the load tester
+    return ", ".join(
+        f"{re.sub(r'[^A-Za-z0-9_-]', '_', name)};dur={ms}" for name, ms in trace.timings_ms().items())
+
 @app.route("/", methods=["GET", "POST"])
 def index():
-    # Send initial greeting if chat history is empty
-    if not chat_history:
-        get_initial_greeting()
+    conversation_id = request.cookies.get(CONVERSATION_COOKIE) or uuid.uuid4().hex
+    conversation = conversations.get(conversation_id)
+    ensure_greeting(conversation)
 
     if request.method == "POST":
         user_input = request.form["user_input"]
         
-        # Check if this is a user type selection
-        if chat_history and "tell me your role" in chat_history[-1][0].lower() and user_input.strip() in ['1', '2', '3', '4']:
-            response = process_user_type_selection(user_input)
-        else:
-            # Regular message processing
-            response = get_disaster_relief_response(user_input)
-        
-        # If it's an AJAX request, return the full page
-        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return render_template("index.html", chat_history=chat_history)
+        try:
+            client_key = rate_limit_key(request.cookies.get(CONVERSATION_COOKIE), request.remote_addr)
+            with admission.admit(classify_priority(user_input, conversation.user_type), client_key), \
+                    request_deadline(REQUEST_DEADLINE_SECONDS), start_turn() as trace:
+                # Check if this is a user type selection
+                if is_role_selection(conversation, user_input):
+                    reply = process_user_type_selection(conversation, user_input)
+                else:
+                    # Regular message processing
+                    reply = get_disaster_relief_response(conversation, user_input)
+        except Rejected as e:
+            status, headers = rejected_response_parts(e)
+            return BUSY_MESSAGE, status, headers
+
+        log_turn(conversation, "user", user_input)
+        log_turn(conversation, "bot", reply, trace)
 
     # Render the chat interface and pass the history to the template
-    return render_template("index.html", chat_history=chat_history)
+    response = make_response(render_template("index.html", chat_history=conversation.chat_history))
+    if request.method == "POST":
+        response.headers['Server-Timing'] = server_timing_header(trace)
+    if request.cookies.get(CONVERSATION_COOKIE) != conversation_id:
+        response.set_cookie(CONVERSATION_COOKIE, conversation_id, max_age=CONVERSATION_COOKIE_MAX_AGE,
+                            httponly=True, samesite='Lax')
+    return response
+
+@app.route("/stats")
+def stats():
+    """Operational counters: admission queue and shedding, upstream breakers, caches."""
+    return jsonify({
+        "admission": admission.stats(),
+        "upstreams": resilience_stats(),
+        "coalescing": relief_flights.stats(),
+        "conversation_log": conversation_store.stats() if conversation_store else None,
+        "conversations": conversations.stats(),
+        "tool_prefetch": tool_prefetcher.stats(),
+        "model_routing": model_router.stats(),
+        "prompt_tokens": token_accountant.stats(),
+    })
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import uuid
+from contextlib import asynccontextmanager, suppress
+
+# One event loop serves many turns at once, so admit more of them than the
+# threaded Flask server does (explicit settings still win)
+os.environ.setdefault('MAX_CONCURRENT_TURNS', '256')
+os.environ.setdefault('MAX_QUEUED_TURNS', '1024')
+
+import uvicorn
+from asgiref.wsgi import WsgiToAsgi
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, PlainTextResponse, Response
+from starlette.routing import Mount, Route
+
+import app as chat_app
+import async_pipeline
+from admission import Rejected, classify_priority
+from resilience import request_deadline
+from tracing import start_turn
+
+#***********************************
+# ASGI entry point
+#***********************************
+# Chat messages (POST /) are answered by the asyncio pipeline; everything else
+# (the page itself, images, css, /stats) is served by the Flask app mounted
+# underneath. If the client disconnects mid-turn the turn is cancelled,
+# including its upstream calls.
+#
+# Usage: python asgi.py            (or: uvicorn asgi:app --port 5000)
+
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def wait_for_disconnect(request):
+    # The body has been read, so the next ASGI message can only be the disconnect
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def until_disconnected(request, coro):
+    """
+    Awaits coro, cancelling it if the client disconnects first.
+
+    Raises:
+        ClientDisconnected: The client went away; coro was cancelled.
+    """
+    work = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not work.done():
+            work.cancel()
+    if work in done:
+        return work.result()
+    # Let the pipeline finish cleaning up before answering
+    with suppress(asyncio.CancelledError):
+        await work
+    raise ClientDisconnected()
+
+
+def render_chat(conversation):
+    # The Flask app's Jinja environment, with the same asset helpers
+    return chat_app.app.jinja_env.get_template("index.html").render(chat_history=conversation.chat_history)
+
+
+async def chat(request):
+    conversation_id = request.cookies.get(chat_app.CONVERSATION_COOKIE) or uuid.uuid4().hex
+    # Restoring a conversation reads the log, and a new one needs the greeting
+    conversation = await asyncio.to_thread(chat_app.conversations.get, conversation_id)
+    if not conversation.chat_history:
+        await asyncio.to_thread(chat_app.ensure_greeting, conversation)
+
+    form = await request.form()
+    user_input = form["user_input"]
+    client_address = chat_app.forwarded_client_address(request.client.host if request.client else None,
+                                                       request.headers.get('x-forwarded-for'))
+    client_key = chat_app.rate_limit_key(request.cookies.get(chat_app.CONVERSATION_COOKIE), client_address)
+
+    try:
+        async with chat_app.admission.aadmit(classify_priority(user_input, conversation.user_type), client_key):
+            with request_deadline(chat_app.REQUEST_DEADLINE_SECONDS), start_turn() as trace:
+                reply = await until_disconnected(request, async_pipeline.achat_turn(conversation, user_input))
+    except Rejected as e:
+        status, headers = chat_app.rejected_response_parts(e)
+        return PlainTextResponse(chat_app.BUSY_MESSAGE, status, headers)
+    except ClientDisconnected:
+        print("Client disconnected; turn cancelled")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+
+    chat_app.log_turn(conversation, "user", user_input)
+    chat_app.log_turn(conversation, "bot", reply, trace)
+
+    response = HTMLResponse(render_chat(conversation), headers={'Server-Timing': chat_app.server_timing_header(trace)})
+    if request.cookies.get(chat_app.CONVERSATION_COOKIE) != conversation_id:
+        response.set_cookie(chat_app.CONVERSATION_COOKIE, conversation_id,
+                            max_age=chat_app.CONVERSATION_COOKIE_MAX_AGE, httponly=True, samesite='lax')
+    return response
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await async_pipeline.start()
+    try:
+        yield
+    finally:
+        await async_pipeline.close()
+
+
+app = Starlette(
+    routes=[
+        Route("/", chat, methods=["POST"]),
+        Mount("/", WsgiToAsgi(chat_app.app)),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=os.getenv('HOST', '127.0.0.1'), port=int(os.getenv('PORT', '5000')))
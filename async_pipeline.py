@@ -0,0 +1,274 @@
+import asyncio
+import os
+
+import aiohttp
+from openai import AsyncOpenAI
+
+import app as chat_app
+from app import (ReliefAnswer, airquality_from_data, airquality_url, tool_call_arguments, tool_result_message,
+                 weather_from_data, weather_url)
+from model_router import previous_reply
+from resilience import UpstreamUnavailable, acall_upstream, aresilient_get_json, attempt_timeout
+from token_accounting import PromptTooLarge
+from tracing import append_value, record_retrieval, record_shared, record_value, stage, sub_turn
+
+#***********************************
+# Asyncio chat pipeline
+#***********************************
+# The same turn as app.get_disaster_relief_response(), without holding a thread
+# through its I/O waits: the embedding and completions use AsyncOpenAI, the
+# weather and air quality tools use aiohttp, and the Pinecone gRPC query, which
+# has no asyncio client, runs in the default thread pool.
+#
+# Retrieval overlaps choosing the tool list, and all tool calls of a
+# completion run concurrently, followed by a single follow-up completion that
+# sees every result. Geo index lookups, which can reload the index, run in
+# threads so a reload never stalls the event loop. Conversations, routing,
+# caches, token limits and the resilience policy are shared with the Flask app.
+#
+# Cancelling a turn (e.g. when the client disconnects) cancels the upstream
+# calls in flight and removes the unanswered message from the conversation.
+
+aclient = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+
+# Created by start() on the serving event loop
+http_session = None
+
+
+async def start():
+    global http_session
+    http_session = aiohttp.ClientSession()
+
+
+async def close():
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+
+#***********************************
+# Upstream calls
+#***********************************
+async def achat_completion_request(messages, temperature=0, tools=None, tool_choice=None, model=chat_app.GPT_MODEL,
+                                   max_tokens=None):
+    """
+    Async chat_completion_request(): same token limits, routing feedback and resilience policy.
+
+    Raises:
+        PromptTooLarge: The current turn alone is over a token limit; nothing was sent.
+        UpstreamUnavailable: The model could not be reached within the request deadline.
+    """
+    messages, prompt_tokens = chat_app.token_accountant.fit(messages, tools)
+    append_value('prompt_tokens', prompt_tokens)
+    print(f"Prompt tokens for {model}: {prompt_tokens}")
+    with stage('completion'):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        response = await acall_upstream("openai", lambda: aclient.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            tools=tools,
+            tool_choice=tool_choice,
+            max_tokens=max_tokens,
+            timeout=attempt_timeout(),
+        ))
+        chat_app.model_router.observe(model, loop.time() - started)
+        chat_app.token_accountant.record_usage(prompt_tokens, getattr(response, 'usage', None))
+        return response
+
+
+async def aquery_knowledge_base(user_input, namespace='dc', top_k=3):
+    """
+    Async query_pinecone(): relevant text chunks, falling back to the local store, then to none.
+    """
+    try:
+        with stage('embedding'):
+            res = await acall_upstream("openai-embeddings", lambda: aclient.embeddings.create(
+                input=user_input, model=chat_app.embed_model, timeout=attempt_timeout(5)))
+    except UpstreamUnavailable as e:
+        print(f"Skipping retrieval: {e}")
+        return []
+    embed = res.data[0].embedding
+
+    index = chat_app.pc.Index(chat_app.index_name)
+    try:
+        with stage('retrieval'):
+            query_response = await acall_upstream("pinecone", lambda: asyncio.to_thread(
+                index.query,
+                vector=embed,
+                top_k=top_k,
+                include_metadata=True,
+                namespace=namespace,
+                timeout=attempt_timeout(5),
+            ))
+    except UpstreamUnavailable as e:
+        if chat_app.local_store is None:
+            print(f"Skipping retrieval: {e}")
+            return []
+        print(f"Using local vector store: {e}")
+        with stage('retrieval_local'):
+            results = await asyncio.to_thread(chat_app.local_store.search, embed, top_k=top_k)
+        record_retrieval([record_id for record_id, _, _ in results])
+        return [text for _, _, text in results]
+
+    record_retrieval([match.id for match in query_response.matches])
+    return [match.metadata['text'] for match in query_response.matches]
+
+
+#***********************************
+# Tools
+#***********************************
+async def aget_current_weather(latitude, longitude):
+    try:
+        data = await aresilient_get_json(http_session, "open-meteo", weather_url(latitude, longitude))
+        return weather_from_data(data, latitude, longitude)
+    except (aiohttp.ClientError, UpstreamUnavailable) as e:
+        return {"error": f"Failed to fetch weather data: {str(e)}"}
+
+
+async def aget_current_airquality(latitude, longitude, date, distance=25, format='application/json'):
+    try:
+        data = await aresilient_get_json(http_session, "airnow",
+                                         airquality_url(latitude, longitude, date, distance, format))
+        return airquality_from_data(data)
+    except (aiohttp.ClientError, UpstreamUnavailable) as e:
+        return {"error": f"Failed to fetch air quality data: {str(e)}"}
+
+
+async def aget_shelter_info(**kwargs):
+    # A lookup can trigger a hot reload of the geo index, which rebuilds the KD-tree
+    return await asyncio.to_thread(chat_app.get_shelter_info, **kwargs)
+
+
+async def asend_email(**kwargs):
+    # SendGrid's client is synchronous
+    return await asyncio.to_thread(chat_app.send_email, **kwargs)
+
+
+async def aoffered_tools():
+    """chat_app.offered_tools() off the event loop: it may reload the geo index."""
+    return await asyncio.to_thread(chat_app.offered_tools)
+
+
+async_functions = {
+    "GetCurrentAirQuality": aget_current_airquality,
+    "get_current_weather": aget_current_weather,
+    "send_email": asend_email,
+    "get_shelter_info": aget_shelter_info,
+}
+
+
+async def arun_tool_call(tool_call):
+    """Runs one tool call (from the tool cache when possible) and returns its tool message."""
+    function_name, function_args = tool_call_arguments(tool_call)
+    function_to_call = async_functions[function_name]
+    with stage('tool:' + function_name):
+        if function_name in chat_app.TOOL_CACHE_TTLS:
+            function_response = await chat_app.tool_cache.acall(function_name, function_args, function_to_call)
+        else:
+            function_response = await function_to_call(**function_args)
+    return tool_result_message(tool_call, function_name, function_args, function_response)
+
+
+#***********************************
+# Turn
+#***********************************
+async def agenerate_relief_answer(messages, user_input):
+    """
+    Async generate_relief_answer().
+
+    Returns:
+        ReliefAnswer: The model's reply, the messages to append to the context, and
+        whether any tools were called.
+    """
+    messages = list(messages)
+    route = chat_app.model_router.route(user_input, previous_reply=previous_reply(messages))
+    record_value('route', route.name)
+    route_tool_choice = "auto" if route.tools else None
+
+    # Retrieval and the tool list are independent: picking the tools checks the
+    # geo index for changes and may rebuild it, so it runs in a thread meanwhile
+    relevant_chunks, route_tools = await asyncio.gather(
+        aquery_knowledge_base(user_input),
+        aoffered_tools() if route.tools else asyncio.sleep(0, None))
+    context_messages = [{'role': 'system',
+                         'content': "\n\nAdditional Information:\n" + "\n".join(relevant_chunks)}]
+    messages.append(context_messages[-1])
+
+    response_message = await achat_completion_request(messages, temperature=0, tools=route_tools,
+                                                      tool_choice=route_tool_choice, model=route.model,
+                                                      max_tokens=route.max_tokens)
+    assistant_message = response_message.choices[0].message
+    response_message_content = assistant_message.content
+    tool_calls = assistant_message.tool_calls
+
+    if tool_calls:
+        # All tool calls run concurrently, then the model sees every result at once
+        context_messages.append(assistant_message)
+        context_messages.extend(await asyncio.gather(*(arun_tool_call(tool_call) for tool_call in tool_calls)))
+        messages.extend(context_messages[1:])
+        response_message = await achat_completion_request(messages, temperature=0, tools=route_tools,
+                                                          tool_choice=route_tool_choice, model=route.model,
+                                                          max_tokens=route.max_tokens)
+        response_message_content = response_message.choices[0].message.content
+
+    return ReliefAnswer(response_message_content, context_messages, bool(tool_calls))
+
+
+async def atraced_relief_answer(messages, user_input):
+    """Async chat_app.traced_relief_answer()."""
+    with sub_turn() as trace:
+        return await agenerate_relief_answer(messages, user_input), trace
+
+
+async def aget_disaster_relief_response(conversation, user_input):
+    """Async get_disaster_relief_response()."""
+    turn = chat_app.begin_relief_turn(conversation, user_input)
+
+    try:
+        messages = chat_app.stateless_messages(conversation, user_input)
+        if messages is not None:
+            (answer, leader_trace), shared = await chat_app.relief_flights.ado(
+                chat_app.relief_flight_key(conversation, user_input),
+                lambda: atraced_relief_answer(messages, user_input),
+                timeout=chat_app.relief_flight_timeout())
+            if shared and answer.used_tools:
+                # Tool calls can have side effects (e.g. email), so don't reuse them
+                chat_app.relief_flights.record_bypass(follower=True)
+                shared = False
+                answer = await agenerate_relief_answer(messages, user_input)
+            elif shared:
+                # The leader's retrieval ids, tool calls and stage timings produced this answer
+                record_shared(leader_trace)
+            record_value('coalesced', shared)
+        else:
+            chat_app.relief_flights.record_bypass()
+            answer = await agenerate_relief_answer(conversation.context, user_input)
+
+        return chat_app.finish_relief_turn(turn, answer)
+
+    except asyncio.CancelledError:
+        # The client went away; forget the unanswered message
+        chat_app.abandon_relief_turn(turn)
+        raise
+
+    except PromptTooLarge as e:
+        print(f"Refusing oversized prompt: {e}")
+        return chat_app.abandon_relief_turn(turn, chat_app.prompt_too_large_reply(e))
+
+    except (UpstreamUnavailable, TimeoutError) as e:
+        return chat_app.degraded_relief_reply(turn, e)
+
+    except Exception as e:
+        print(f"Error processing response: {e}")
+        return f"I apologize, but I encountered an error while processing your request. Please try again."
+
+
+async def achat_turn(conversation, user_input):
+    """Answers one POSTed message: a role selection or a relief question."""
+    if chat_app.is_role_selection(conversation, user_input):
+        # Once per conversation; the persona prompt path stays synchronous
+        return await asyncio.to_thread(chat_app.process_user_type_selection, conversation, user_input)
+    return await aget_disaster_relief_response(conversation, user_input)
@@ -0,0 +1,205 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+
+from PIL import Image, ImageSequence
+
+from static_assets import BUILD_DIR, MANIFEST_FILE
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always produced
+    brotli = None
+
+#***********************************
+# Static asset build
+#***********************************
+# Produces content-hashed, recompressed and resized copies of images/ and css/
+# in static_build/, plus static_build/manifest.json which app.py uses to link
+# them. Hashed files never change, so they are served with immutable caching.
+#
+# Usage: python build_assets.py
+
+SOURCE_IMAGES = 'images'
+SOURCE_CSS = 'css'
+
+# Responsive widths for the WebP/AVIF variants (plus the original width)
+RESPONSIVE_WIDTHS = [320, 640, 960, 1600]
+JPEG_QUALITY = 82
+WEBP_QUALITY = 78
+AVIF_QUALITY = 55
+
+Image.init()
+AVIF_SUPPORTED = '.avif' in Image.registered_extensions()
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:10]
+
+
+def write_hashed(out_dir, name, data):
+    """
+    Writes data under a content-hashed file name.
+
+    Args:
+        out_dir (str): Destination directory.
+        name (str): Original file name, e.g. "logo.png" or "logo.640w.webp".
+        data (bytes): File content.
+
+    Returns:
+        str: The hashed file name, e.g. "logo.3f2a1b9c0d.png".
+    """
+    stem, ext = os.path.splitext(name)
+    hashed_name = f"{stem}.{content_hash(data)}{ext}"
+    with open(os.path.join(out_dir, hashed_name), 'wb') as file:
+        file.write(data)
+    return hashed_name
+
+
+def encode_image(image, fmt, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def recompress_original(path, image):
+    """Recompresses an image in its own format, keeping the original bytes if that is smaller."""
+    with open(path, 'rb') as file:
+        original = file.read()
+
+    fmt = image.format
+    if fmt == 'JPEG':
+        candidate = encode_image(image.convert('RGB'), 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif fmt == 'PNG':
+        candidate = encode_image(image, 'PNG', optimize=True)
+    else:
+        # GIF and anything else is copied as-is (animations are preserved in the WebP variant)
+        candidate = original
+
+    return candidate if len(candidate) < len(original) else original
+
+
+def build_image_variants(image, stem, out_dir):
+    """
+    Builds resized WebP (and AVIF when Pillow supports it) variants of an image.
+
+    Returns:
+        list: {"file", "width", "type"} dicts, smallest first.
+    """
+    variants = []
+    width, height = image.size
+    animated = getattr(image, 'n_frames', 1) > 1
+    widths = sorted({w for w in RESPONSIVE_WIDTHS if w < width} | {width})
+
+    for target in widths:
+        target_height = max(1, round(height * target / width))
+
+        if animated:
+            # Keep every frame for animated GIFs; only WebP can carry them
+            frames = [frame.convert('RGBA').resize((target, target_height), Image.LANCZOS)
+                      for frame in ImageSequence.Iterator(image)]
+            data = encode_image(frames[0], 'WEBP', save_all=True, append_images=frames[1:],
+                                quality=WEBP_QUALITY, loop=image.info.get('loop', 0),
+                                duration=image.info.get('duration', 100))
+            variants.append({'file': write_hashed(out_dir, f"{stem}.{target}w.webp", data),
+                             'width': target, 'type': 'image/webp'})
+            continue
+
+        mode = 'RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB'
+        resized = image.convert(mode).resize((target, target_height), Image.LANCZOS)
+
+        data = encode_image(resized, 'WEBP', quality=WEBP_QUALITY, method=6)
+        variants.append({'file': write_hashed(out_dir, f"{stem}.{target}w.webp", data),
+                         'width': target, 'type': 'image/webp'})
+
+        if AVIF_SUPPORTED:
+            data = encode_image(resized, 'AVIF', quality=AVIF_QUALITY)
+            variants.append({'file': write_hashed(out_dir, f"{stem}.{target}w.avif", data),
+                             'width': target, 'type': 'image/avif'})
+
+    return variants
+
+
+def build_images(manifest):
+    out_dir = os.path.join(BUILD_DIR, 'images')
+    os.makedirs(out_dir)
+
+    for name in sorted(os.listdir(SOURCE_IMAGES)):
+        path = os.path.join(SOURCE_IMAGES, name)
+        try:
+            image = Image.open(path)
+        except (OSError, Image.UnidentifiedImageError):
+            print(f"Skipping {path}: not an image")
+            continue
+
+        with image:
+            stem, _ = os.path.splitext(name)
+            original = recompress_original(path, image)
+            entry = {
+                'file': write_hashed(out_dir, name, original),
+                'width': image.size[0],
+                'height': image.size[1],
+                'type': Image.MIME.get(image.format, 'application/octet-stream'),
+                'variants': build_image_variants(image, stem, out_dir),
+            }
+
+        manifest['images'][name] = entry
+        smallest = min([len(original)] + [os.path.getsize(os.path.join(out_dir, v['file']))
+                                          for v in entry['variants']])
+        print(f"{name}: {os.path.getsize(path)} -> {smallest} bytes (smallest variant)")
+
+
+def rewrite_css_urls(css, images):
+    """Points url(...) references to images at their hashed copies."""
+    def replace(match):
+        name = os.path.basename(match.group(2))
+        if name in images:
+            return f"url({match.group(1)}/images/{images[name]['file']}{match.group(1)})"
+        return match.group(0)
+
+    return re.sub(r"""url\((['"]?)([^'")]*images/[^'")]+)\1\)""", replace, css)
+
+
+def build_css(manifest):
+    out_dir = os.path.join(BUILD_DIR, 'css')
+    os.makedirs(out_dir)
+
+    for name in sorted(os.listdir(SOURCE_CSS)):
+        if not name.endswith('.css'):
+            continue
+        with open(os.path.join(SOURCE_CSS, name), 'r', encoding='utf-8') as file:
+            css = rewrite_css_urls(file.read(), manifest['images'])
+
+        data = css.encode('utf-8')
+        hashed_name = write_hashed(out_dir, name, data)
+        # Precompressed siblings are served when the client accepts them
+        with open(os.path.join(out_dir, hashed_name + '.gz'), 'wb') as file:
+            file.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(os.path.join(out_dir, hashed_name + '.br'), 'wb') as file:
+                file.write(brotli.compress(data, quality=11))
+
+        manifest['css'][name] = {'file': hashed_name, 'gzip': True, 'br': brotli is not None}
+        print(f"{name}: {len(data)} bytes -> {hashed_name}")
+
+
+def build_assets():
+    if os.path.exists(BUILD_DIR):
+        shutil.rmtree(BUILD_DIR)
+    os.makedirs(BUILD_DIR)
+
+    manifest = {'images': {}, 'css': {}}
+    build_images(manifest)
+    build_css(manifest)
+
+    with open(MANIFEST_FILE, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    print(f"Wrote {MANIFEST_FILE}")
+
+
+if __name__ == "__main__":
+    build_assets()
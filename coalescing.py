@@ -0,0 +1,161 @@
+import asyncio
+import threading
+
+#***********************************
+# Request coalescing (single flight)
+#***********************************
+# Concurrent calls with the same key share one execution: the first caller
+# (the leader) runs the function, later callers (followers) wait for it and
+# receive the same result or exception. A follower waits at most `timeout`
+# seconds (the rest of its request deadline) before giving up with TimeoutError.
+#
+# ado() does the same for coroutines. The shared work runs as its own task and
+# is cancelled only when every caller waiting on it has been cancelled or timed out.
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _AsyncCall:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 1
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls that share a key."""
+
+    def __init__(self):
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.bypassed = 0
+        self.timed_out = 0
+
+    def do(self, key, fn, timeout=None):
+        """
+        Runs fn() once per key among concurrent callers.
+
+        Args:
+            key (hashable): Identity of the work, e.g. normalized question and persona.
+            fn (callable): The work to run if no identical call is in flight.
+            timeout (float): Seconds a follower waits for the leader; None waits indefinitely.
+
+        Returns:
+            tuple: (result, shared) where shared is True if the result came from another caller.
+
+        Raises:
+            TimeoutError: This caller was a follower and the leader didn't finish in time.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.followers += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            if not call.done.wait(timeout):
+                with self._lock:
+                    self.timed_out += 1
+                raise TimeoutError(f"no result from the identical call in flight after {timeout:.1f}s")
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # Later callers start a fresh flight instead of reusing this result
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result, False
+
+    async def ado(self, key, coro_fn, timeout=None):
+        """
+        Awaits coro_fn() once per key among concurrent coroutines on this event loop.
+
+        Returns:
+            tuple: (result, shared) as for do().
+
+        Raises:
+            TimeoutError: The shared work didn't finish within `timeout` seconds.
+        """
+        call = self._async_calls.get(key)
+        if call is not None:
+            shared = True
+            call.waiters += 1
+            with self._lock:
+                self.followers += 1
+        else:
+            shared = False
+            call = _AsyncCall(asyncio.ensure_future(coro_fn()))
+            self._async_calls[key] = call
+
+            def forget(_):
+                if self._async_calls.get(key) is call:
+                    del self._async_calls[key]
+
+            call.task.add_done_callback(forget)
+            with self._lock:
+                self.leaders += 1
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(call.task), timeout), shared
+        except asyncio.CancelledError:
+            self._stop_waiting(call)
+            raise
+        except TimeoutError:
+            # Unless the shared work itself raised it, this caller ran out of time
+            if not call.task.done():
+                with self._lock:
+                    self.timed_out += 1
+                self._stop_waiting(call)
+            raise
+
+    @staticmethod
+    def _stop_waiting(call):
+        call.waiters -= 1
+        if call.waiters == 0:
+            call.task.cancel()
+
+    def record_bypass(self, follower=False):
+        """
+        Counts a call that was not eligible for coalescing. follower=True recounts a
+        follower that could not use the shared result, so each call is counted once.
+        """
+        with self._lock:
+            if follower:
+                self.followers -= 1
+            self.bypassed += 1
+
+    def stats(self):
+        with self._lock:
+            coalescable = self.leaders + self.followers
+            return {
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "bypassed": self.bypassed,
+                "timed_out": self.timed_out,
+                "in_flight": len(self._calls) + len(self._async_calls),
+                "coalescing_ratio": self.followers / coalescable if coalescable else 0.0,
+            }
@@ -0,0 +1,301 @@
+import json
+import mmap
+import os
+import shutil
+import time
+
+import numpy as np
+
+#***********************************
+# Compact on-disk vector store
+#***********************************
+# Layout of a store directory:
+#   header.json       - format, embedding model, dimension, count, dtypes
+#   vectors.bin       - count x dim int8 (or float16) codes, row major
+#   scales.bin        - count float32 per-vector scale factors
+#   originals.bin     - count x dim full-precision unit vectors (float32 or
+#                       float16), read only to re-score search candidates
+#   text.bin          - utf-8 chunk texts back to back
+#   text_offsets.bin  - count + 1 uint64 offsets into text.bin
+#   ids.bin           - utf-8 record ids back to back
+#   ids_offsets.bin   - count + 1 uint64 offsets into ids.bin
+#
+# Everything except the header is memory-mapped on load, so opening a store
+# costs a few page faults instead of parsing JSON for every chunk.
+
+STORE_FORMAT = "dc-compact-v1"
+SUPPORTED_DTYPES = ("int8", "float16")
+RESCORE_DTYPES = ("float32", "float16")
+DEFAULT_STORE_PATH = "data/vector_store"
+
+
+def quantize_vector(vector, dtype="int8"):
+    """
+    Normalizes a vector and quantizes it for storage.
+
+    Args:
+        vector (list or np.ndarray): Raw embedding values.
+        dtype (str): "int8" or "float16".
+
+    Returns:
+        tuple: (codes, scale) where codes * scale approximates the unit vector.
+    """
+    vec = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    if norm > 0:
+        vec = vec / norm
+
+    if dtype == "float16":
+        return vec.astype(np.float16), 1.0
+
+    peak = float(np.max(np.abs(vec))) if vec.size else 0.0
+    scale = peak / 127.0 if peak > 0 else 1.0
+    codes = np.clip(np.rint(vec / scale), -127, 127).astype(np.int8)
+    return codes, scale
+
+
+class CompactStoreWriter:
+    """
+    Streams embeddings and texts into a compact store directory.
+
+    Records are appended as they arrive, so the writer never holds more than
+    one vector in memory. The store is written to a temporary directory and
+    swapped into place on close().
+
+    Alongside the quantized codes the writer keeps the normalized vectors in
+    rescore_dtype, which search reads only for its shortlisted candidates.
+    """
+
+    def __init__(self, path, model, dim, dtype="int8", metric="cosine", rescore_dtype="float32"):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported dtype {dtype!r}, expected one of {SUPPORTED_DTYPES}")
+        if rescore_dtype not in RESCORE_DTYPES:
+            raise ValueError(f"Unsupported rescore dtype {rescore_dtype!r}, expected one of {RESCORE_DTYPES}")
+
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.model = model
+        self.dim = dim
+        self.dtype = dtype
+        self.rescore_dtype = rescore_dtype
+        self.metric = metric
+        self.count = 0
+
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        self._vectors = open(os.path.join(self.tmp_path, "vectors.bin"), "wb")
+        self._scales = open(os.path.join(self.tmp_path, "scales.bin"), "wb")
+        self._originals = open(os.path.join(self.tmp_path, "originals.bin"), "wb")
+        self._text = open(os.path.join(self.tmp_path, "text.bin"), "wb")
+        self._ids = open(os.path.join(self.tmp_path, "ids.bin"), "wb")
+        self._text_offsets = [0]
+        self._id_offsets = [0]
+
+    def add(self, record_id, vector, text):
+        """Appends one record to the store."""
+        if len(vector) != self.dim:
+            raise ValueError(f"Expected a {self.dim}-d vector, got {len(vector)}")
+
+        codes, scale = quantize_vector(vector, self.dtype)
+        self._vectors.write(codes.tobytes())
+        self._scales.write(np.float32(scale).tobytes())
+        original = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(original))
+        if norm > 0:
+            original = original / norm
+        self._originals.write(original.astype(self.rescore_dtype).tobytes())
+
+        text_bytes = text.encode("utf-8")
+        self._text.write(text_bytes)
+        self._text_offsets.append(self._text_offsets[-1] + len(text_bytes))
+
+        id_bytes = str(record_id).encode("utf-8")
+        self._ids.write(id_bytes)
+        self._id_offsets.append(self._id_offsets[-1] + len(id_bytes))
+
+        self.count += 1
+
+    def close(self):
+        """Flushes the offset tables and header and publishes the store."""
+        for handle in (self._vectors, self._scales, self._originals, self._text, self._ids):
+            handle.close()
+
+        np.asarray(self._text_offsets, dtype=np.uint64).tofile(
+            os.path.join(self.tmp_path, "text_offsets.bin"))
+        np.asarray(self._id_offsets, dtype=np.uint64).tofile(
+            os.path.join(self.tmp_path, "ids_offsets.bin"))
+
+        header = {
+            "format": STORE_FORMAT,
+            "model": self.model,
+            "dim": self.dim,
+            "count": self.count,
+            "dtype": self.dtype,
+            "rescore_dtype": self.rescore_dtype,
+            "metric": self.metric,
+            "created": time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        with open(os.path.join(self.tmp_path, "header.json"), "w", encoding="utf-8") as file:
+            json.dump(header, file, indent=2)
+
+        # Swap the finished store into place
+        if os.path.exists(self.path):
+            old_path = self.path + ".old"
+            if os.path.exists(old_path):
+                shutil.rmtree(old_path)
+            os.replace(self.path, old_path)
+            os.replace(self.tmp_path, self.path)
+            shutil.rmtree(old_path)
+        else:
+            os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for handle in (self._vectors, self._scales, self._originals, self._text, self._ids):
+                handle.close()
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+        return False
+
+
+class _Blob:
+    """Memory-mapped byte blob addressed through an offset table."""
+
+    def __init__(self, data_path, offsets_path):
+        self.offsets = np.memmap(offsets_path, dtype=np.uint64, mode="r")
+        self._file = open(data_path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        # mmap cannot map an empty file
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __getitem__(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self._data[start:end].decode("utf-8")
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+
+class CompactVectorStore:
+    """
+    Read side of a compact store.
+
+    Search runs in two passes: an approximate pass over the quantized codes
+    picks top_k * oversample candidates, then those candidates are re-scored
+    exactly against the full-precision vectors in originals.bin. Stores
+    written before originals.bin existed fall back to the approximate scores.
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        with open(os.path.join(path, "header.json"), "r", encoding="utf-8") as file:
+            self.header = json.load(file)
+
+        if self.header.get("format") != STORE_FORMAT:
+            raise ValueError(f"Unknown store format: {self.header.get('format')}")
+
+        self.path = path
+        self.model = self.header["model"]
+        self.dim = self.header["dim"]
+        self.count = self.header["count"]
+        self.dtype = self.header["dtype"]
+        self.rescore_dtype = self.header.get("rescore_dtype")
+
+        self.originals = None
+        if self.count:
+            self.vectors = np.memmap(os.path.join(path, "vectors.bin"), dtype=np.dtype(self.dtype),
+                                     mode="r", shape=(self.count, self.dim))
+            self.scales = np.memmap(os.path.join(path, "scales.bin"), dtype=np.float32,
+                                    mode="r", shape=(self.count,))
+            if self.rescore_dtype:
+                self.originals = np.memmap(os.path.join(path, "originals.bin"),
+                                           dtype=np.dtype(self.rescore_dtype), mode="r",
+                                           shape=(self.count, self.dim))
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.dtype(self.dtype))
+            self.scales = np.zeros((0,), dtype=np.float32)
+
+        self.texts = _Blob(os.path.join(path, "text.bin"), os.path.join(path, "text_offsets.bin"))
+        self.ids = _Blob(os.path.join(path, "ids.bin"), os.path.join(path, "ids_offsets.bin"))
+
+    def __len__(self):
+        return self.count
+
+    def _approximate_scores(self, query, block_size):
+        """Scores every stored vector against a unit-length float32 query using the codes."""
+        scores = np.empty(self.count, dtype=np.float32)
+        # Work in blocks so the float32 widening never touches the whole matrix at once
+        for start in range(0, self.count, block_size):
+            end = min(start + block_size, self.count)
+            block = np.asarray(self.vectors[start:end], dtype=np.float32)
+            scores[start:end] = block @ query
+        if self.dtype == "int8":
+            scores *= self.scales
+        return scores
+
+    def search(self, query_vector, top_k=3, oversample=8, block_size=4096):
+        """
+        Finds the records closest to a query embedding.
+
+        Args:
+            query_vector (list or np.ndarray): Query embedding, same model as the store.
+            top_k (int): Number of results to return.
+            oversample (int): Candidates kept from the approximate pass per result.
+            block_size (int): Rows scored per block in the approximate pass.
+
+        Returns:
+            list: (id, score, text) tuples ordered by descending cosine similarity.
+        """
+        if not self.count:
+            return []
+
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = float(np.linalg.norm(query))
+        if norm > 0:
+            query = query / norm
+
+        approx = self._approximate_scores(query, block_size)
+
+        n_candidates = min(self.count, max(top_k, top_k * oversample))
+        if n_candidates < self.count:
+            candidates = np.argpartition(-approx, n_candidates - 1)[:n_candidates]
+        else:
+            candidates = np.arange(self.count)
+
+        if self.originals is not None:
+            candidates.sort()  # sequential reads from the memory map
+            # Exact re-score against the full-precision vectors
+            scores = np.asarray(self.originals[candidates], dtype=np.float32) @ query
+        else:
+            scores = approx[candidates]
+
+        order = np.argsort(-scores)[:top_k]
+        return [(self.ids[int(candidates[i])], float(scores[i]), self.texts[int(candidates[i])])
+                for i in order]
+
+    def close(self):
+        self.texts.close()
+        self.ids.close()
+
+
+def load_compact_store(path=DEFAULT_STORE_PATH):
+    """
+    Opens a compact store if one has been built.
+
+    Returns:
+        CompactVectorStore or None: The store, or None when the path has no store.
+    """
+    if not os.path.exists(os.path.join(path, "header.json")):
+        return None
+    try:
+        return CompactVectorStore(path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Unable to load compact vector store at {path}: {e}")
+        return None
@@ -0,0 +1,247 @@
+import argparse
+import json
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+#***********************************
+# Durable conversation log
+#***********************************
+# Turns are written to SQLite (WAL mode) by a background thread. Request
+# threads only put a row on a bounded in-process queue, so logging never waits
+# on the disk; the writer drains the queue and commits rows in batches.
+# If the queue stays full for longer than `put_timeout` the turn is dropped and
+# counted rather than stalling the chat. close() (registered with atexit by the
+# app) commits whatever is still queued before the process exits.
+#
+# Usage: python conversation_store.py export conversations.jsonl [--db data/conversations.db]
+
+DEFAULT_DB_PATH = 'data/conversations.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    raw_content TEXT,
+    user_type TEXT,
+    created_at TEXT NOT NULL,
+    tool_calls TEXT,
+    retrieval_ids TEXT,
+    timings TEXT,
+    prompt_tokens TEXT
+);
+CREATE INDEX IF NOT EXISTS turns_conversation ON turns (conversation_id, id);
+"""
+
+_COLUMNS = ("conversation_id", "role", "content", "raw_content", "user_type",
+            "created_at", "tool_calls", "retrieval_ids", "timings", "prompt_tokens")
+_JSON_COLUMNS = ("tool_calls", "retrieval_ids", "timings", "prompt_tokens")
+
+_STOP = object()
+
+
+def connect(db_path):
+    connection = sqlite3.connect(db_path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # WAL makes NORMAL durable against application crashes at a fraction of FULL's fsyncs
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    # Databases created before prompt token accounting lack the column
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(turns)")}
+    if "prompt_tokens" not in columns:
+        connection.execute("ALTER TABLE turns ADD COLUMN prompt_tokens TEXT")
+    return connection
+
+
+def _row_to_turn(row):
+    turn = dict(zip(("id",) + _COLUMNS, row))
+    for column in _JSON_COLUMNS:
+        if turn[column] is not None:
+            turn[column] = json.loads(turn[column])
+    return turn
+
+
+class ConversationStore:
+    """
+    Batched asynchronous writer plus read helpers for the conversation log.
+
+    Args:
+        db_path (str): SQLite database file.
+        max_queue (int): Turns that may wait for the writer before callers block.
+        batch_size (int): Maximum turns committed in one transaction.
+        put_timeout (float): Seconds a caller waits on a full queue before dropping the turn.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, max_queue=10000, batch_size=200, put_timeout=0.05):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._read_lock = threading.Lock()
+        self._reader = connect(db_path)
+        # Guards the counters, which request threads and the writer both update
+        self._stats_lock = threading.Lock()
+        self._closed = False
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self._writer = threading.Thread(target=self._write_loop, name="conversation-writer", daemon=True)
+        self._writer.start()
+
+    def record_turn(self, conversation_id, role, content, raw_content=None, user_type=None,
+                    tool_calls=None, retrieval_ids=None, timings=None, prompt_tokens=None):
+        """
+        Queues a turn for writing.
+
+        Returns:
+            bool: False if the turn was dropped (the queue stayed full or the store is closed).
+        """
+        if self._closed:
+            self._count_dropped(1)
+            return False
+        row = (
+            conversation_id, role, content, raw_content, user_type,
+            time.strftime('%Y-%m-%d %H:%M:%S'),
+            json.dumps(tool_calls, default=str) if tool_calls else None,
+            json.dumps(retrieval_ids) if retrieval_ids else None,
+            json.dumps(timings) if timings else None,
+            json.dumps(prompt_tokens) if prompt_tokens else None,
+        )
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self._count_dropped(1)
+            return False
+
+    def _count_dropped(self, n):
+        with self._stats_lock:
+            self.dropped += n
+
+    def _write_loop(self):
+        connection = connect(self.db_path)
+        insert = f"INSERT INTO turns ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' for _ in _COLUMNS)})"
+
+        while True:
+            # Block for the first row, then take whatever else is already waiting
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = any(row is _STOP for row in batch)
+            rows = [row for row in batch if row is not _STOP]
+            try:
+                if rows:
+                    with connection:
+                        connection.executemany(insert, rows)
+                    with self._stats_lock:
+                        self.written += len(rows)
+                        self.batches += 1
+            except sqlite3.Error as e:
+                print(f"Unable to write {len(rows)} conversation turns: {e}")
+                self._count_dropped(len(rows))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if stop:
+                connection.close()
+                return
+
+    def flush(self):
+        """Waits until every queued turn has been committed."""
+        self._queue.join()
+
+    def close(self):
+        """Commits the queued turns and stops the writer; later turns are dropped. Safe to call twice."""
+        with self._stats_lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._reader.close()
+
+    def load_conversation(self, conversation_id):
+        """
+        Returns the turns of one conversation in order, for rehydrating a session.
+
+        Returns:
+            list: Turn dicts with JSON columns decoded.
+        """
+        with self._read_lock:
+            rows = self._reader.execute(
+                f"SELECT id, {', '.join(_COLUMNS)} FROM turns WHERE conversation_id = ? ORDER BY id",
+                (conversation_id,)).fetchall()
+        return [_row_to_turn(row) for row in rows]
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "written": self.written,
+                "dropped": self.dropped,
+                "batches": self.batches,
+            }
+
+
+def iter_turns(db_path=DEFAULT_DB_PATH, conversation_id=None, fetch_size=500):
+    """
+    Streams turns from the log ordered by conversation, without loading them all.
+
+    Yields:
+        dict: One turn at a time.
+    """
+    connection = connect(db_path)
+    try:
+        sql = f"SELECT id, {', '.join(_COLUMNS)} FROM turns"
+        params = ()
+        if conversation_id is not None:
+            sql += " WHERE conversation_id = ?"
+            params = (conversation_id,)
+        cursor = connection.execute(sql + " ORDER BY conversation_id, id", params)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield _row_to_turn(row)
+    finally:
+        connection.close()
+
+
+def export_jsonl(out_file, db_path=DEFAULT_DB_PATH, conversation_id=None):
+    """Writes one JSON object per turn; returns the number of turns written."""
+    count = 0
+    for turn in iter_turns(db_path, conversation_id):
+        out_file.write(json.dumps(turn, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DisasterConnect conversation log tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="stream conversations to JSONL")
+    export.add_argument("output", help="output file, or - for stdout")
+    export.add_argument("--db", default=DEFAULT_DB_PATH, help="conversation database")
+    export.add_argument("--conversation", help="export a single conversation id")
+    args = parser.parse_args(argv)
+
+    if args.output == "-":
+        count = export_jsonl(sys.stdout, args.db, args.conversation)
+    else:
+        with open(args.output, "w", encoding="utf-8") as out_file:
+            count = export_jsonl(out_file, args.db, args.conversation)
+    print(f"Exported {count} turns", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import threading
+from collections import OrderedDict
+
+#***********************************
+# Per-browser conversation state
+#***********************************
+# Every browser has its own conversation, identified by the conversation cookie:
+# the messages shown on the page, the messages the model sees, the role the
+# user picked and how many questions have been answered. Nothing from one
+# conversation is visible to another.
+#
+# Conversations live in a bounded LRU. One that is evicted (or lost in a
+# restart) is rebuilt from the conversation log when its browser comes back.
+
+
+class Conversation:
+    """
+    One browser's conversation.
+
+    Args:
+        conversation_id (str): Value of the conversation cookie.
+        context (list): Messages every conversation starts with (the static prompt).
+    """
+
+    def __init__(self, conversation_id, context):
+        self.id = conversation_id
+        # (message, sender, timestamp) tuples rendered by the page
+        self.chat_history = []
+        # Messages sent to the model
+        self.context = list(context)
+        # Role selected by the user, e.g. "Survivor/Caregiver"
+        self.user_type = None
+        # Position in context of the system message naming that role
+        self.persona_index = None
+        # Free-form questions answered so far
+        self.answered_questions = 0
+
+
+class ConversationRegistry:
+    """
+    Conversations by id, most recently used last.
+
+    Args:
+        create (callable): Builds the Conversation for an id that isn't in memory,
+            e.g. by restoring it from the conversation log.
+        max_conversations (int): Conversations kept in memory.
+    """
+
+    def __init__(self, create, max_conversations=1000):
+        self._create = create
+        self.max_conversations = max_conversations
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    def get(self, conversation_id):
+        """Returns the conversation for an id, creating it on first use."""
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is not None:
+                self._conversations.move_to_end(conversation_id)
+                return conversation
+
+        # May read the conversation log, so it runs outside the lock
+        conversation = self._create(conversation_id)
+
+        with self._lock:
+            # Another request for the same id may have won the race
+            existing = self._conversations.get(conversation_id)
+            if existing is not None:
+                self._conversations.move_to_end(conversation_id)
+                return existing
+            self._conversations[conversation_id] = conversation
+            self.created += 1
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+                self.evicted += 1
+            return conversation
+
+    def __len__(self):
+        with self._lock:
+            return len(self._conversations)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": len(self._conversations),
+                "created": self.created,
+                "evicted": self.evicted,
+            }
@@ -3,9 +3,13 @@ from openai import OpenAI
 import json
 from pinecone.grpc import PineconeGRPC as Pinecone
 from pinecone import ServerlessSpec
+from compact_vector_store import CompactStoreWriter, DEFAULT_STORE_PATH
+from ingest import IngestManifest, run_ingest
+from resilience import call_upstream
 
 import time
 import os
+import sys
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -18,6 +22,13 @@ pc = Pinecone(api_key=pinecone_api_key)
 # Create your own vector database index name
 index_name = 'cstugpt-dc'
 embed_model = "text-embedding-3-small"
+embed_dimension = 1536
+# Local compact copy of the knowledge base (int8 or float16 vectors)
+compact_store_path = DEFAULT_STORE_PATH
+compact_store_dtype = 'int8'
+compact_store_rescore_dtype = 'float32'
+# Record ids written per source file, so re-runs delete records that are no longer produced
+ingest_manifest_path = 'data/ingest_manifest.json'
 
 
 def pinecone_create_vector_database(index_name):
@@ -29,7 +40,7 @@ def pinecone_create_vector_database(index_name):
         if index_name not in existing_indexes:
             pc.create_index(
                 name=index_name,
-                dimension=1536,
+                dimension=embed_dimension,
                 metric="cosine",
                 spec=ServerlessSpec(
                     cloud='aws', 
@@ -49,40 +60,44 @@ def pinecone_create_vector_database(index_name):
             print(f"An error occurred: {e}")
             raise
 
-pinecone_create_vector_database(index_name)
+def embed_texts(texts):
+    """Embeds a batch of texts with one API call."""
+    res = call_upstream("openai-embeddings", lambda: client.embeddings.create(input=texts, model=embed_model))
+    return [item.embedding for item in res.data]
 
-def read_and_chunk_file(file_path, chunk_size=500):
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            text = file.read()
-        
-        # Split the text into chunks of `chunk_size` characters
-        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
-        return chunks
-    
-    except UnicodeDecodeError as e:
-        print(f"Error decoding the file {file_path}. Please check the file encoding.")
-        raise
+def pinecone_upsert_vectors(vectors, index_name, namespace):
+    index = pc.Index(index_name)
+    call_upstream("pinecone", lambda: index.upsert(vectors=vectors, namespace=namespace))
 
-def pinecone_upsert_chunk(text, rec_count, index_name, namespace):
+def pinecone_delete_vectors(ids, index_name, namespace):
     index = pc.Index(index_name)
-    res = client.embeddings.create(input=text, model=embed_model)
+    call_upstream("pinecone", lambda: index.delete(ids=ids, namespace=namespace))
 
-    embed = res.data[0].embedding
-    print("Embeds length:", len(embed))
-    
-    count = rec_count
-    # Meta data preparation
-    metadata = {'text': text}
-    
-    index.upsert(vectors=[{"id": namespace + '_' + str(count), "metadata": metadata, "values": embed}], 
-                 namespace=namespace)
+def pinecone_list_ids(prefix, index_name, namespace):
+    """All record ids in the namespace that start with prefix."""
+    index = pc.Index(index_name)
+    pages = call_upstream("pinecone", lambda: list(index.list(prefix=prefix, namespace=namespace)))
+    return [record_id for page in pages for record_id in page]
+
+if __name__ == "__main__":
+    pinecone_create_vector_database(index_name)
 
-# Read and chunk the file
-file_path = 'data/additional_resources.txt'
-chunks = read_and_chunk_file(file_path)
+    # Files and directories of txt/markdown/HTML to ingest
+    source_paths = sys.argv[1:] or ['data/additional_resources.txt']
+    namespace = 'dc'
 
-# Upsert each chunk into Pinecone
-namespace = 'dc'
-for i, chunk in enumerate(chunks):
-    pinecone_upsert_chunk(chunk, i + 1, index_name, namespace)
\ No newline at end of file
+    with CompactStoreWriter(compact_store_path, embed_model, embed_dimension, dtype=compact_store_dtype,
+                            rescore_dtype=compact_store_rescore_dtype) as store:
+        counts = run_ingest(
+            source_paths,
+            embed_batch=embed_texts,
+            upsert_batch=lambda vectors: pinecone_upsert_vectors(vectors, index_name, namespace),
+            namespace=namespace,
+            store_writer=store,
+            manifest=IngestManifest(ingest_manifest_path),
+            delete_batch=lambda ids: pinecone_delete_vectors(ids, index_name, namespace),
+            list_ids=lambda prefix: pinecone_list_ids(prefix, index_name, namespace),
+        )
+    print(f"Upserted {counts['upserted']} chunks with {counts['embedding_calls']} embedding calls, "
+          f"dropped {counts['dropped']} near-duplicate paragraphs, deleted {counts['deleted']} stale records")
+    print(f"Wrote compact store at {compact_store_path}")
@@ -0,0 +1,359 @@
+import argparse
+import csv
+import json
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+#***********************************
+# Offline geospatial index
+#***********************************
+# Loads shelter/resource sites from CSV and GeoJSON files in data/geo/ and a
+# zip-code centroid table, and answers nearest-N and within-radius queries
+# from an in-memory KD-tree. Points are stored as 3-d unit vectors, so straight
+# line (chord) distance orders points exactly like great-circle distance and
+# the tree works everywhere on the globe.
+#
+# Expected files in data/geo/:
+#   zip_centroids.csv  - zip,latitude,longitude
+#   *.csv              - one site per row with latitude/longitude columns
+#                        (lat/lng/lon also accepted); other columns are kept
+#   *.geojson          - FeatureCollection of Point features with properties
+#
+# The index reloads itself when any of these files change.
+#
+# Benchmark: python geo_index.py --bench 100000
+
+DEFAULT_GEO_DIR = 'data/geo'
+ZIP_CENTROIDS_FILE = 'zip_centroids.csv'
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_MILE = 1.609344
+LEAF_SIZE = 64
+
+_LAT_COLUMNS = ('latitude', 'lat', 'y')
+_LON_COLUMNS = ('longitude', 'lon', 'lng', 'long', 'x')
+
+
+def to_unit_vectors(latitudes, longitudes):
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_to_km(chord):
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.asarray(chord) / 2.0))
+
+
+def km_to_chord(km):
+    return 2.0 * math.sin(min(math.pi, km / EARTH_RADIUS_KM) / 2.0)
+
+
+class KDTree:
+    """
+    Static KD-tree over 3-d points.
+
+    Points are reordered so every leaf is a contiguous slice, which keeps leaf
+    scans vectorized. Nodes are stored in flat lists rather than objects.
+    """
+
+    def __init__(self, points, leaf_size=LEAF_SIZE):
+        self.leaf_size = leaf_size
+        self.order = np.arange(len(points))
+        self.points = np.asarray(points, dtype=np.float64)
+        # Per node: start, end, split dimension (-1 for leaves), split value, left, right
+        self.start, self.end, self.dim, self.split, self.left, self.right = [], [], [], [], [], []
+        if len(points):
+            self._build(0, len(points))
+        self.points = self.points[self.order]
+
+    def _new_node(self, start, end):
+        for column, value in ((self.start, start), (self.end, end), (self.dim, -1),
+                              (self.split, 0.0), (self.left, -1), (self.right, -1)):
+            column.append(value)
+        return len(self.start) - 1
+
+    def _build(self, start, end):
+        node = self._new_node(start, end)
+        if end - start <= self.leaf_size:
+            return node
+
+        indices = self.order[start:end]
+        coords = self.points[indices]
+        dim = int(np.argmax(coords.max(axis=0) - coords.min(axis=0)))
+        mid = (end - start) // 2
+        partition = np.argpartition(coords[:, dim], mid)
+        self.order[start:end] = indices[partition]
+
+        self.dim[node] = dim
+        self.split[node] = float(self.points[self.order[start + mid], dim])
+        self.left[node] = self._build(start, start + mid)
+        self.right[node] = self._build(start + mid, end)
+        return node
+
+    def nearest(self, query, n):
+        """Returns (squared chord distances, point positions) of the n nearest points, closest first."""
+        best_d2 = np.empty(0)
+        best_pos = np.empty(0, dtype=np.int64)
+        worst = np.inf
+        # (node, lower bound on squared distance to anything inside it)
+        stack = [(0, 0.0)] if self.start else []
+        while stack:
+            node, bound = stack.pop()
+            # The bound is checked when popped, by which time nearer leaves have tightened `worst`
+            if bound >= worst:
+                continue
+            dim = self.dim[node]
+            if dim < 0:
+                start, end = self.start[node], self.end[node]
+                diff = self.points[start:end] - query
+                d2 = np.einsum('ij,ij->i', diff, diff)
+                closer = np.nonzero(d2 < worst)[0]
+                if len(closer):
+                    # Merge the leaf's candidates into the running best n
+                    best_d2 = np.concatenate((best_d2, d2[closer]))
+                    best_pos = np.concatenate((best_pos, closer + start))
+                    if len(best_d2) > n:
+                        keep = np.argpartition(best_d2, n - 1)[:n]
+                        best_d2, best_pos = best_d2[keep], best_pos[keep]
+                    if len(best_d2) == n:
+                        worst = best_d2.max()
+                continue
+
+            delta = query[dim] - self.split[node]
+            near, far = (self.left[node], self.right[node]) if delta < 0 else (self.right[node], self.left[node])
+            stack.append((far, max(bound, delta * delta)))
+            stack.append((near, bound))
+
+        order = np.argsort(best_d2)
+        return best_d2[order], best_pos[order]
+
+    def within(self, query, radius):
+        """Returns positions of points within chord distance `radius`, unordered."""
+        found = []
+        stack = [0] if self.start else []
+        r2 = radius * radius
+        while stack:
+            node = stack.pop()
+            dim = self.dim[node]
+            if dim < 0:
+                start, end = self.start[node], self.end[node]
+                diff = self.points[start:end] - query
+                hits = np.nonzero(np.einsum('ij,ij->i', diff, diff) <= r2)[0]
+                found.extend((hits + start).tolist())
+                continue
+            delta = query[dim] - self.split[node]
+            if delta - radius <= 0:
+                stack.append(self.left[node])
+            if delta + radius >= 0:
+                stack.append(self.right[node])
+        return found
+
+
+class GeoIndex:
+    """
+    Sites and zip centroids from a data directory, with hot reload.
+
+    Queries never block on a reload: a new tree is built off to the side and
+    swapped in with a single assignment.
+    """
+
+    def __init__(self, geo_dir=DEFAULT_GEO_DIR, check_interval=5.0):
+        self.geo_dir = geo_dir
+        self.check_interval = check_interval
+        self._snapshot = ({}, [], KDTree(np.empty((0, 3))))
+        self._mtimes = None
+        self._last_check = 0.0
+        self._reload_lock = threading.Lock()
+        self.maybe_reload(force=True)
+
+    def _source_files(self):
+        if not os.path.isdir(self.geo_dir):
+            return []
+        return sorted(os.path.join(self.geo_dir, name) for name in os.listdir(self.geo_dir)
+                      if name.lower().endswith(('.csv', '.geojson', '.json')))
+
+    def maybe_reload(self, force=False):
+        """Rebuilds the index if source files changed; checks at most every check_interval seconds."""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return False
+        if not self._reload_lock.acquire(blocking=False):
+            return False  # another thread is already reloading
+        try:
+            self._last_check = now
+            files = self._source_files()
+            mtimes = {path: os.path.getmtime(path) for path in files}
+            if mtimes == self._mtimes:
+                return False
+            self._snapshot = self._load(files)
+            self._mtimes = mtimes
+            print(f"Geo index loaded {len(self._snapshot[1])} sites and {len(self._snapshot[0])} zip codes")
+            return True
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Unable to reload geo index from {self.geo_dir}: {e}")
+            return False
+        finally:
+            self._reload_lock.release()
+
+    def _load(self, files):
+        zip_centroids = {}
+        sites, latitudes, longitudes = [], [], []
+
+        for path in files:
+            name = os.path.basename(path)
+            if name == ZIP_CENTROIDS_FILE:
+                with open(path, 'r', encoding='utf-8', newline='') as file:
+                    for row in csv.DictReader(file):
+                        zip_centroids[row['zip'].strip().zfill(5)] = (float(row['latitude']), float(row['longitude']))
+                continue
+
+            dataset = os.path.splitext(name)[0]
+            for properties, lat, lon in (_read_geojson(path) if not name.lower().endswith('.csv')
+                                         else _read_csv(path)):
+                properties['dataset'] = dataset
+                sites.append(properties)
+                latitudes.append(lat)
+                longitudes.append(lon)
+
+        tree = KDTree(to_unit_vectors(latitudes, longitudes) if sites else np.empty((0, 3)))
+        # Reorder sites to match the tree so positions map straight to sites
+        sites = [sites[i] for i in tree.order]
+        coords = list(zip(np.asarray(latitudes)[tree.order].tolist(), np.asarray(longitudes)[tree.order].tolist())) \
+            if sites else []
+        for site, (lat, lon) in zip(sites, coords):
+            site['latitude'], site['longitude'] = lat, lon
+        return zip_centroids, sites, tree
+
+    def __len__(self):
+        return len(self._snapshot[1])
+
+    def zip_location(self, zipcode):
+        """(latitude, longitude) centroid of a zip code, or None if unknown."""
+        return self._snapshot[0].get(str(zipcode).strip()[:5].zfill(5))
+
+    def nearest(self, latitude, longitude, n=5, max_km=None):
+        """
+        The n sites closest to a point.
+
+        Returns:
+            list: Site property dicts with a distance_km field, closest first.
+        """
+        self.maybe_reload()
+        _, sites, tree = self._snapshot
+        query = to_unit_vectors([latitude], [longitude])[0]
+        d2, positions = tree.nearest(query, n)
+        results = []
+        for distance, position in zip(chord_to_km(np.sqrt(d2)), positions):
+            if max_km is not None and distance > max_km:
+                break
+            results.append(dict(sites[position], distance_km=round(float(distance), 2)))
+        return results
+
+    def within_radius(self, latitude, longitude, radius_km, limit=None):
+        """
+        Sites within radius_km of a point.
+
+        Returns:
+            list: Site property dicts with a distance_km field, closest first.
+        """
+        self.maybe_reload()
+        _, sites, tree = self._snapshot
+        query = to_unit_vectors([latitude], [longitude])[0]
+        positions = np.asarray(tree.within(query, km_to_chord(radius_km)), dtype=np.int64)
+        if not len(positions):
+            return []
+        distances = chord_to_km(np.linalg.norm(tree.points[positions] - query, axis=1))
+        order = np.argsort(distances)[:limit]
+        return [dict(sites[positions[i]], distance_km=round(float(distances[i]), 2)) for i in order]
+
+
+def _pick_column(fieldnames, candidates):
+    lowered = {name.lower().strip(): name for name in fieldnames or []}
+    for candidate in candidates:
+        if candidate in lowered:
+            return lowered[candidate]
+    raise KeyError(f"none of the columns {candidates}")
+
+
+def _read_csv(path):
+    with open(path, 'r', encoding='utf-8', newline='') as file:
+        reader = csv.DictReader(file)
+        lat_column = _pick_column(reader.fieldnames, _LAT_COLUMNS)
+        lon_column = _pick_column(reader.fieldnames, _LON_COLUMNS)
+        for row in reader:
+            try:
+                lat, lon = float(row.pop(lat_column)), float(row.pop(lon_column))
+            except (TypeError, ValueError):
+                continue  # rows without usable coordinates are skipped
+            yield {k: v for k, v in row.items() if k and v not in (None, '')}, lat, lon
+
+
+def _read_geojson(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        collection = json.load(file)
+    for feature in collection.get('features', []):
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') != 'Point':
+            continue
+        lon, lat = geometry['coordinates'][:2]
+        yield dict(feature.get('properties') or {}), float(lat), float(lon)
+
+
+#***********************************
+# Benchmark
+#***********************************
+def benchmark(n_sites, n_queries=2000, seed=7):
+    """Builds an index of random continental-US sites and times queries against brute force."""
+    rng = np.random.default_rng(seed)
+    latitudes = rng.uniform(25.0, 49.0, n_sites)
+    longitudes = rng.uniform(-124.0, -67.0, n_sites)
+
+    start = time.perf_counter()
+    points = to_unit_vectors(latitudes, longitudes)
+    tree = KDTree(points)
+    print(f"Built KD-tree over {n_sites} sites in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    queries = to_unit_vectors(rng.uniform(25.0, 49.0, n_queries), rng.uniform(-124.0, -67.0, n_queries))
+
+    start = time.perf_counter()
+    for query in queries:
+        tree.nearest(query, 5)
+    per_query = (time.perf_counter() - start) / n_queries * 1e6
+    print(f"nearest-5:      {per_query:8.1f} us/query")
+
+    radius = km_to_chord(25.0)
+    start = time.perf_counter()
+    hits = 0
+    for query in queries:
+        hits += len(tree.within(query, radius))
+    per_query = (time.perf_counter() - start) / n_queries * 1e6
+    print(f"within 25 km:   {per_query:8.1f} us/query ({hits / n_queries:.1f} sites on average)")
+
+    start = time.perf_counter()
+    for query in queries[:200]:
+        np.argpartition(np.einsum('ij,ij->i', points - query, points - query), 5)[:5]
+    per_query = (time.perf_counter() - start) / 200 * 1e6
+    print(f"brute force:    {per_query:8.1f} us/query")
+
+    # Spot-check correctness against brute force
+    for query in queries[:50]:
+        d2, _ = tree.nearest(query, 5)
+        expected = np.sort(np.einsum('ij,ij->i', points - query, points - query))[:5]
+        assert np.allclose(d2, expected), "KD-tree disagrees with brute force"
+    print("Results match brute force")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DisasterConnect geospatial index")
+    parser.add_argument('--bench', type=int, metavar='N', help="benchmark with N random sites")
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+    if args.bench:
+        benchmark(args.bench, args.queries)
+    else:
+        index = GeoIndex()
+        print(f"{len(index)} sites loaded from {index.geo_dir}")
@@ -0,0 +1,497 @@
+import hashlib
+import json
+import os
+import re
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from itertools import groupby
+
+import numpy as np
+
+#***********************************
+# Streaming ingestion pipeline
+#***********************************
+# discover -> parse -> normalize -> dedupe -> chunk -> embed -> upsert
+#
+# Every stage is a generator, so only a bounded window of paragraph batches and
+# chunks is in memory at any time, however large a file is: files are read in
+# fixed-size blocks and parsed one paragraph at a time, and paragraphs travel
+# in batches of PARAGRAPH_BATCH. Normalizing and MinHash signatures run on a
+# process pool; the main process parses, and does the LSH lookups, the chunk
+# packing, the batched embedding calls and the upserts. Near-duplicate
+# paragraphs (repeated boilerplate across agency bulletins) are dropped before
+# the remaining paragraphs are packed into chunks, so boilerplate never reaches
+# the embedding calls however it is mixed with new text.
+#
+# Record ids are derived from the chunk text. A manifest remembers which ids
+# each source file produced, so a re-run deletes the records a changed or
+# removed file no longer produces, and the first run deletes the numbered
+# "<namespace>_<n>" records of the original loader.
+#
+# This module has no import-time side effects so pool workers can import it.
+
+SUPPORTED_EXTENSIONS = ('.txt', '.md', '.markdown', '.html', '.htm')
+
+DEFAULT_CHUNK_SIZE = 500
+READ_BLOCK_SIZE = 1 << 16    # characters read from a file at a time
+MAX_PARAGRAPH_CHARS = 1 << 18  # a longer run without a blank line is cut here
+PARAGRAPH_BATCH = 256        # raw paragraphs per process pool task
+MINHASH_PERMUTATIONS = 128
+LSH_BANDS = 16               # 16 bands x 8 rows: candidates above roughly 0.7 Jaccard
+SHINGLE_WORDS = 5
+DUPLICATE_THRESHOLD = 0.8    # estimated Jaccard similarity treated as a duplicate
+DEDUPE_CAPACITY = 100000     # kept signatures remembered for dedupe (~51 MB)
+DEDUPE_MIN_WORDS = SHINGLE_WORDS  # shorter paragraphs (headings, "Stay safe.") are always kept
+
+_rng = np.random.default_rng(20240601)
+_SEEDS = _rng.integers(1, 2 ** 63, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_MULTIPLIERS = _rng.integers(1, 2 ** 63, size=MINHASH_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+
+
+#***********************************
+# Discover and parse
+#***********************************
+def discover(paths, extensions=SUPPORTED_EXTENSIONS):
+    """
+    Yields supported files under the given files and directories, in a stable order.
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(extensions):
+                    yield os.path.join(root, name)
+
+
+class _TextExtractor(HTMLParser):
+    """Collects visible text from HTML, one block element per paragraph."""
+
+    SKIP = {'script', 'style', 'nav', 'header', 'footer', 'noscript'}
+    BLOCKS = {'p', 'div', 'section', 'article', 'li', 'tr', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skip_depth += 1
+        elif tag in self.BLOCKS:
+            self.parts.append('\n\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in self.BLOCKS:
+            self.parts.append('\n\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+
+def _read_blocks(path, block_size=READ_BLOCK_SIZE):
+    with open(path, 'r', encoding='utf-8', errors='replace') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                return
+            yield block
+
+
+def _html_text(blocks):
+    """Feeds HTML blocks to the extractor and yields the visible text as it is found."""
+    extractor = _TextExtractor()
+    for block in blocks:
+        extractor.feed(block)
+        yield ''.join(extractor.parts)
+        extractor.parts.clear()
+    extractor.close()
+    yield ''.join(extractor.parts)
+
+
+def _split_paragraphs(blocks, max_chars=MAX_PARAGRAPH_CHARS):
+    """Re-cuts a stream of text blocks at blank lines, yielding one paragraph at a time."""
+    pending = ''
+    for block in blocks:
+        pending += block
+        *paragraphs, pending = re.split(r'\n[ \t\f\v]*\n', pending)
+        yield from paragraphs
+        if len(pending) > max_chars:
+            yield pending
+            pending = ''
+    if pending:
+        yield pending
+
+
+# Emphasis markers only count when they wrap words: snake_case and 2*3 are left alone
+_EMPHASIS = re.compile(r'(?<![\w*])(\*\*|__|\*|_)(?=[^\s*_])(.+?)(?<=[^\s*_])\1(?![\w*])')
+_URL = re.compile(r'(https?://[^\s)]+|www\.[^\s)]+)')
+
+
+def _strip_emphasis(text):
+    """Removes emphasis markers and inline code backticks outside of URLs."""
+    pieces = _URL.split(text)
+    for i in range(0, len(pieces), 2):
+        piece = re.sub(r'`([^`]*)`', r'\1', pieces[i])
+        # Twice, for bold inside italics (***text***)
+        pieces[i] = _EMPHASIS.sub(r'\2', _EMPHASIS.sub(r'\2', piece))
+    return ''.join(pieces)
+
+
+def _markdown_text(paragraphs):
+    """Strips markdown syntax paragraph by paragraph; fenced code blocks may span paragraphs."""
+    in_code = False
+    for paragraph in paragraphs:
+        # Text between fences alternates between prose and code
+        pieces = paragraph.split('```')
+        prose = [piece for i, piece in enumerate(pieces) if (i % 2 == 0) != in_code]
+        in_code ^= len(pieces) % 2 == 0
+        paragraph = ''.join(prose)
+        paragraph = re.sub(r'!\[([^\]]*)\]\([^)]*\)', r'\1', paragraph)              # images -> alt text
+        paragraph = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'\1 (\2)', paragraph)         # links keep their URL
+        paragraph = re.sub(r'^\s{0,3}(#{1,6}|>|[-*+]|\d+\.)\s+', '', paragraph, flags=re.MULTILINE)
+        yield _strip_emphasis(paragraph)
+
+
+def parse_text(path, block_size=READ_BLOCK_SIZE):
+    """
+    Yields the plain text of a file one paragraph at a time.
+
+    The file is read `block_size` characters at a time, so memory is bounded by
+    the longest paragraph (at most MAX_PARAGRAPH_CHARS) rather than the file size.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    blocks = _read_blocks(path, block_size)
+    if extension in ('.html', '.htm'):
+        blocks = _html_text(blocks)
+    paragraphs = _split_paragraphs(blocks)
+    if extension in ('.md', '.markdown'):
+        paragraphs = _markdown_text(paragraphs)
+    return paragraphs
+
+
+def normalize(text):
+    """Unicode-normalizes text and collapses whitespace, keeping paragraph breaks."""
+    text = unicodedata.normalize('NFKC', text).replace('\r\n', '\n')
+    paragraphs = (re.sub(r'[ \t\f\v]+', ' ', p).strip() for p in re.split(r'\n\s*\n', text))
+    return '\n\n'.join(' '.join(line.strip() for line in p.splitlines() if line.strip())
+                       for p in paragraphs if p)
+
+
+def _pieces(paragraphs, chunk_size):
+    """Paragraphs that fit in a chunk, with longer ones split on sentences (cut at chunk_size as a last resort)."""
+    for paragraph in paragraphs:
+        if len(paragraph) <= chunk_size:
+            yield paragraph
+            continue
+        for sentence in re.split(r'(?<=[.!?])\s+', paragraph):
+            yield from (sentence[i:i + chunk_size] for i in range(0, len(sentence), chunk_size))
+
+
+def iter_chunks(paragraphs, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Packs normalized paragraphs, in order, into chunks of at most chunk_size characters, yielding each when full."""
+    current = ''
+    for piece in _pieces(paragraphs, chunk_size):
+        if current and len(current) + 2 + len(piece) > chunk_size:
+            yield current
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        yield current
+
+
+def pack_chunks(paragraphs, chunk_size=DEFAULT_CHUNK_SIZE):
+    """iter_chunks() as a list."""
+    return list(iter_chunks(paragraphs, chunk_size))
+
+
+#***********************************
+# MinHash / LSH near-duplicate filter
+#***********************************
+def minhash_signature(text):
+    """MinHash signature over word shingles of a chunk, as a uint32 array."""
+    words = re.findall(r'\w+', text.lower())
+    if len(words) > SHINGLE_WORDS:
+        shingles = {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    else:
+        shingles = {' '.join(words)}
+
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little') for s in shingles),
+        dtype=np.uint64, count=len(shingles))
+    # One multiply-xorshift hash family member per permutation; uint64 arithmetic wraps
+    permuted = (hashes[:, None] ^ _SEEDS[None, :]) * _MULTIPLIERS[None, :]
+    return (permuted.min(axis=0) >> np.uint64(32)).astype(np.uint32)
+
+
+class NearDuplicateFilter:
+    """
+    LSH index over MinHash signatures of kept chunks.
+
+    Memory is bounded by `capacity`: when full, the oldest kept chunk is
+    forgotten, so only repeats within the last `capacity` unique chunks are
+    detected. Candidates from the LSH buckets are confirmed against the stored
+    signature before a chunk is dropped.
+    """
+
+    def __init__(self, capacity=DEDUPE_CAPACITY, bands=LSH_BANDS, threshold=DUPLICATE_THRESHOLD):
+        self.capacity = capacity
+        self.bands = bands
+        self.rows = MINHASH_PERMUTATIONS // bands
+        self.threshold = threshold
+        self.signatures = np.zeros((capacity, MINHASH_PERMUTATIONS), dtype=np.uint32)
+        self.buckets = [dict() for _ in range(bands)]
+        self.slot_keys = [None] * capacity
+        self.next_slot = 0
+        self.kept = 0
+        self.dropped = 0
+
+    def _band_keys(self, signature):
+        return [signature[b * self.rows:(b + 1) * self.rows].tobytes() for b in range(self.bands)]
+
+    def is_duplicate(self, signature):
+        """Returns True for a near-duplicate; otherwise remembers the signature and returns False."""
+        keys = self._band_keys(signature)
+        candidates = {self.buckets[b][key] for b, key in enumerate(keys) if key in self.buckets[b]}
+        for slot in candidates:
+            if np.mean(self.signatures[slot] == signature) >= self.threshold:
+                self.dropped += 1
+                return True
+
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.capacity
+        if self.slot_keys[slot] is not None:
+            # Evict the oldest entry from the buckets it still owns
+            for b, key in enumerate(self.slot_keys[slot]):
+                if self.buckets[b].get(key) == slot:
+                    del self.buckets[b][key]
+        self.signatures[slot] = signature
+        self.slot_keys[slot] = keys
+        for b, key in enumerate(keys):
+            self.buckets[b][key] = slot
+        self.kept += 1
+        return False
+
+
+#***********************************
+# Pipeline
+#***********************************
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def sign_paragraphs(raw_paragraphs):
+    """
+    Worker task: normalize a batch of parsed paragraphs and sign each one.
+
+    Returns:
+        list: (paragraph, MinHash signature or None) tuples; paragraphs shorter than
+            DEDUPE_MIN_WORDS words are not signed and always kept.
+    """
+    signed = []
+    for raw in raw_paragraphs:
+        for paragraph in normalize(raw).split('\n\n'):
+            if not paragraph:
+                continue
+            long_enough = len(re.findall(r'\w+', paragraph)) >= DEDUPE_MIN_WORDS
+            signed.append((paragraph, minhash_signature(paragraph) if long_enough else None))
+    return signed
+
+
+def _parsed_batches(path, batch_size):
+    try:
+        yield from batched(parse_text(path), batch_size)
+    except (OSError, UnicodeError) as e:
+        print(f"Skipping the rest of {path}: {e}")
+
+
+def prepared_batches(paths, workers=None, window=None, batch_size=PARAGRAPH_BATCH):
+    """
+    Yields (source path, sign_paragraphs() result) batches in discovery order.
+
+    Files are parsed here a batch of paragraphs at a time and the batches signed on
+    a process pool. At most `window` batches are in flight, so memory does not grow
+    with the corpus or with the size of any one file.
+    """
+    workers = workers or os.cpu_count() or 1
+    window = window or workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in discover(paths):
+            for batch in _parsed_batches(path, batch_size):
+                pending.append((path, pool.submit(sign_paragraphs, batch)))
+                if len(pending) >= window:
+                    source, future = pending.popleft()
+                    yield source, future.result()
+        while pending:
+            source, future = pending.popleft()
+            yield source, future.result()
+
+
+def unique_chunks(batches, dedupe, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Drops near-duplicate paragraphs, then packs each file's remaining paragraphs into chunks."""
+    for source, file_batches in groupby(batches, key=lambda batch: batch[0]):
+        kept = (paragraph for _, signed in file_batches for paragraph, signature in signed
+                if signature is None or not dedupe.is_duplicate(signature))
+        for chunk in iter_chunks(kept, chunk_size):
+            yield source, chunk
+
+
+def chunk_id(namespace, chunk):
+    """Content-derived record id, so re-ingesting the same chunk overwrites it."""
+    return f"{namespace}_{hashlib.sha1(chunk.encode('utf-8')).hexdigest()[:16]}"
+
+
+def embedded_batches(chunks, embed_batch, batch_size=64):
+    """
+    Embeds chunks in batches, one embedding call per batch.
+
+    Args:
+        chunks (iterable): (source, chunk) tuples.
+        embed_batch (callable): list of texts -> list of embeddings.
+
+    Yields:
+        list: (source, chunk, embedding) tuples for one batch.
+    """
+    for batch in batched(chunks, batch_size):
+        embeddings = embed_batch([chunk for _, chunk in batch])
+        yield [(source, chunk, embedding) for (source, chunk), embedding in zip(batch, embeddings)]
+
+
+class IngestManifest:
+    """
+    Record ids produced by each source file in earlier runs, stored as JSON.
+
+    Args:
+        path (str): Manifest file; a missing file is an empty manifest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}
+        # Set once the numbered ids of the original loader have been deleted
+        self.legacy_removed = False
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            self.sources = data.get('sources', {})
+            self.legacy_removed = data.get('legacy_removed', False)
+
+    def stale_ids(self, ingested, produced):
+        """
+        Ids to delete after a run.
+
+        Args:
+            ingested (set): Sources read in this run.
+            produced (dict): source -> ids written in this run.
+
+        Returns:
+            list: Earlier ids of sources that were re-ingested or no longer exist, that
+                no source produces now.
+        """
+        live = {record_id for ids in produced.values() for record_id in ids}
+        for source, ids in self.sources.items():
+            if source not in ingested and os.path.exists(source):
+                live.update(ids)  # not part of this run, keep
+        stale = []
+        for source, ids in self.sources.items():
+            if source in ingested or not os.path.exists(source):
+                stale.extend(record_id for record_id in ids if record_id not in live)
+        return list(dict.fromkeys(stale))
+
+    def update(self, ingested, produced):
+        """Records this run's ids and forgets sources that no longer exist."""
+        for source in ingested:
+            self.sources[source] = list(dict.fromkeys(produced.get(source, ())))
+        self.sources = {source: ids for source, ids in self.sources.items() if os.path.exists(source)}
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'sources': self.sources, 'legacy_removed': self.legacy_removed}, file, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def legacy_ids(record_ids, namespace):
+    """Ids in the "<namespace>_<n>" form the original loader wrote."""
+    pattern = re.compile(rf'{re.escape(namespace)}_\d+')
+    return [record_id for record_id in record_ids if pattern.fullmatch(record_id)]
+
+
+def run_ingest(paths, embed_batch, upsert_batch, namespace, store_writer=None, workers=None,
+               chunk_size=DEFAULT_CHUNK_SIZE, batch_size=64, dedupe_capacity=DEDUPE_CAPACITY,
+               manifest=None, delete_batch=None, list_ids=None):
+    """
+    Runs the whole pipeline.
+
+    Args:
+        paths (list): Files and directories to ingest.
+        embed_batch (callable): list of texts -> list of embeddings.
+        upsert_batch (callable): list of {"id", "values", "metadata"} vectors -> None.
+        namespace (str): Vector namespace, also the record id prefix.
+        store_writer (CompactStoreWriter): Optional local compact copy of the records.
+        workers (int): Normalizing and signing processes (default: one per CPU).
+        manifest (IngestManifest): Ids of earlier runs; with delete_batch, records no
+            longer produced are deleted after the upserts and the manifest is saved.
+        delete_batch (callable): list of ids -> None.
+        list_ids (callable): id prefix -> iterable of stored ids; used once to find
+            the original loader's numbered records.
+
+    Returns:
+        dict: Counts of upserted chunks, dropped near-duplicate paragraphs, embedding
+            calls and deleted stale records.
+    """
+    dedupe = NearDuplicateFilter(capacity=dedupe_capacity)
+    embedding_calls = 0
+    upserted = 0
+    deleted = 0
+    ingested = {os.path.normpath(source) for source in discover(paths)}
+    produced = {}
+
+    chunks = unique_chunks(prepared_batches(paths, workers), dedupe, chunk_size)
+    for batch in embedded_batches(chunks, embed_batch, batch_size):
+        embedding_calls += 1
+        vectors = [{"id": chunk_id(namespace, chunk), "values": embedding,
+                    "metadata": {"text": chunk, "source": source}}
+                   for source, chunk, embedding in batch]
+        upsert_batch(vectors)
+        for vector in vectors:
+            produced.setdefault(os.path.normpath(vector["metadata"]["source"]), []).append(vector["id"])
+        if store_writer is not None:
+            for vector in vectors:
+                store_writer.add(vector["id"], vector["values"], vector["metadata"]["text"])
+        upserted += len(vectors)
+        print(f"Upserted {upserted} chunks so far ({dedupe.dropped} near-duplicate paragraphs dropped)")
+
+    if manifest is not None and delete_batch is not None:
+        stale = manifest.stale_ids(ingested, produced)
+        if not manifest.legacy_removed and list_ids is not None:
+            live = {record_id for ids in produced.values() for record_id in ids}
+            stale.extend(record_id for record_id in legacy_ids(list_ids(f"{namespace}_"), namespace)
+                         if record_id not in live)
+        for ids in batched(stale, 1000):
+            delete_batch(ids)
+            deleted += len(ids)
+        if deleted:
+            print(f"Deleted {deleted} records that are no longer produced")
+        manifest.update(ingested, produced)
+        manifest.legacy_removed = manifest.legacy_removed or list_ids is not None
+        manifest.save()
+
+    return {"upserted": upserted, "dropped": dedupe.dropped, "embedding_calls": embedding_calls,
+            "deleted": deleted}
@@ -0,0 +1,416 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import defaultdict
+
+import aiohttp
+
+#***********************************
+# Traffic replay load test
+#***********************************
+# Replays multi-turn conversations against the chat app at an open-loop session
+# arrival rate: new virtual sessions start on a Poisson schedule whether or not
+# earlier ones have finished, so a slow server builds a backlog just like it
+# would during a real surge. Each session keeps its own cookies and plays its
+# turns in order with a think time between them.
+#
+# By default the app runs in-process with OpenAI, Pinecone and the tool APIs
+# replaced by local fakes with realistic latencies, so no quota is spent.
+#
+# Usage:
+#   python loadtest.py --rates 2,5,10,20 --step-seconds 30
+#   python loadtest.py --transcripts conversations.jsonl --rates 10
+#   python loadtest.py --url http://staging:5000 --rates 5     (no fakes)
+
+SYNTHETIC_QUESTIONS = [
+    "Where can I find a shelter near me?",
+    "How do I apply for FEMA assistance?",
+    "What should I pack in an emergency go bag?",
+    "How can I donate supplies to fire survivors?",
+    "How do I volunteer with a relief organization?",
+    "Is the water safe to drink after a flood?",
+    "Why aren't there new updates on the incident?",
+    "How do I get Watch Duty notifications?",
+]
+SYNTHETIC_TOOL_QUESTIONS = [
+    "What is the weather at latitude 34.05 longitude -118.24?",
+    "What's the air quality at 39.14, -121.62 today?",
+    "What is the weather at 37.77, -122.42 right now?",
+]
+
+
+#***********************************
+# Upstream fakes
+#***********************************
+class FakeLatency:
+    """Log-normal latency around a median, scaled by a global factor."""
+
+    def __init__(self, median, sigma=0.5, scale=1.0):
+        self.median = median
+        self.sigma = sigma
+        self.scale = scale
+
+    def sleep(self):
+        time.sleep(self.scale * self.median * math.exp(random.gauss(0, self.sigma)))
+
+
+def _message_field(message, name):
+    return message.get(name) if isinstance(message, dict) else getattr(message, name, None)
+
+
+class FakeCompletions:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def create(self, model=None, messages=None, tools=None, tool_choice=None, **kwargs):
+        self.latency.sleep()
+        # The prompt ends with the retrieval block (and, after a tool call, the tool
+        # results), so look at the user's message and at whether tools already ran
+        last_user = next((m for m in reversed(messages) if _message_field(m, 'role') == 'user'), None)
+        content = (_message_field(last_user, 'content') if last_user is not None else '') or ''
+        tools_answered = _message_field(messages[-1], 'role') == 'tool'
+        tool_calls = None
+
+        # Ask for a tool when the question carries coordinates, as the real model would
+        numbers = re.findall(r'-?\d+\.\d+', content)
+        if tools and not tools_answered and len(numbers) >= 2:
+            name = 'GetCurrentAirQuality' if 'air' in content.lower() else 'get_current_weather'
+            arguments = json.dumps({'latitude': float(numbers[0]), 'longitude': float(numbers[1])})
+            tool_calls = [types.SimpleNamespace(
+                id=f"call_{random.getrandbits(32):08x}", type='function',
+                function=types.SimpleNamespace(name=name, arguments=arguments))]
+            content = None
+        else:
+            content = "Here is some guidance from the knowledge base. **Stay safe** and call 911 in an emergency."
+
+        message = types.SimpleNamespace(role='assistant', content=content, tool_calls=tool_calls)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+
+class FakeEmbeddings:
+    def __init__(self, latency, dim=1536):
+        self.latency = latency
+        self.dim = dim
+
+    def create(self, input=None, model=None, **kwargs):
+        self.latency.sleep()
+        rng = random.Random(hash(input))
+        embedding = [rng.uniform(-1, 1) for _ in range(self.dim)]
+        return types.SimpleNamespace(data=[types.SimpleNamespace(embedding=embedding)])
+
+
+class FakeOpenAI:
+    def __init__(self, completion_latency, embedding_latency):
+        self.chat = types.SimpleNamespace(completions=FakeCompletions(completion_latency))
+        self.embeddings = FakeEmbeddings(embedding_latency)
+
+
+class FakePineconeIndex:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def query(self, vector=None, top_k=3, namespace=None, **kwargs):
+        self.latency.sleep()
+        matches = [types.SimpleNamespace(id=f"{namespace}_{random.randint(1, 500)}",
+                                         score=0.8, metadata={'text': 'Knowledge base excerpt.'})
+                   for _ in range(top_k)]
+        return types.SimpleNamespace(matches=matches)
+
+
+class FakePinecone:
+    def __init__(self, latency):
+        self.index = FakePineconeIndex(latency)
+
+    def Index(self, name):
+        return self.index
+
+
+class FakeHTTPResponse:
+    def __init__(self, payload):
+        self.payload = payload
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+def make_fake_requests_get(latency, real_get):
+    """requests.get with the weather and air quality APIs faked; every other URL goes to real_get."""
+    def fake_get(url, params=None, timeout=None, **kwargs):
+        if 'open-meteo' in url:
+            latency.sleep()
+            return FakeHTTPResponse({'current_weather': {'temperature': 18.5, 'windspeed': 12.0}})
+        if 'airnow' in url:
+            latency.sleep()
+            return FakeHTTPResponse([{
+                'DateForecast': time.strftime('%Y-%m-%d'), 'ReportingArea': 'Test Area', 'StateCode': 'CA',
+                'ParameterName': 'PM2.5', 'AQI': 77, 'ActionDay': False,
+                'Category': {'Number': 2, 'Name': 'Moderate'},
+            }])
+        # e.g. the tokenizer download
+        return real_get(url, params=params, timeout=timeout, **kwargs)
+    return fake_get
+
+
+def start_local_app(latency_scale):
+    """
+    Imports the app with fake upstreams and serves it on a free local port.
+
+    Returns:
+        str: Base URL of the running app.
+    """
+    # All virtual sessions share 127.0.0.1, so the per-client limit would throttle the
+    # whole test; the global admission limits still apply.
+    os.environ.setdefault('CLIENT_RATE_PER_MINUTE', '1000000')
+    os.environ.setdefault('CLIENT_BURST', '1000000')
+    os.environ.setdefault('OPENAI_API_KEY', 'loadtest')
+    os.environ.setdefault('PINECONE_API_KEY', 'loadtest')
+    os.environ.setdefault('CONVERSATION_DB', os.path.join(tempfile.mkdtemp(), 'loadtest.db'))
+
+    import requests
+    requests.get = make_fake_requests_get(FakeLatency(0.25, scale=latency_scale), requests.get)
+
+    import app as chat_app
+    chat_app.client = FakeOpenAI(FakeLatency(0.9, scale=latency_scale), FakeLatency(0.08, scale=latency_scale))
+    chat_app.pc = FakePinecone(FakeLatency(0.04, scale=latency_scale))
+    # Silence the app's debug prints so the report stays readable
+    chat_app.print = lambda *args, **kwargs: None
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = make_server('127.0.0.1', port, chat_app.app, threaded=True, request_handler=QuietRequestHandler)
+    server.socket.listen(4096)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+
+#***********************************
+# Transcripts
+#***********************************
+def load_transcripts(path):
+    """
+    Reads user turns from a conversation_store.py JSONL export.
+
+    Returns:
+        list: One list of user messages per conversation.
+    """
+    conversations = defaultdict(list)
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            turn = json.loads(line)
+            if turn.get('role') == 'user':
+                conversations[turn['conversation_id']].append(turn['content'])
+    return [turns for turns in conversations.values() if turns]
+
+
+def synthetic_transcript(rng):
+    """A persona selection followed by one to three questions, some needing tools."""
+    turns = [rng.choice(['1', '2', '3', '4'])]
+    for _ in range(rng.randint(1, 3)):
+        pool = SYNTHETIC_TOOL_QUESTIONS if rng.random() < 0.25 else SYNTHETIC_QUESTIONS
+        turns.append(rng.choice(pool))
+    return turns
+
+
+def route_of(message):
+    if message.strip() in ('1', '2', '3', '4'):
+        return 'POST / persona'
+    if len(re.findall(r'-?\d+\.\d+', message)) >= 2:
+        return 'POST / tool question'
+    return 'POST / question'
+
+
+#***********************************
+# Load generation
+#***********************************
+class StepResults:
+    def __init__(self, rate):
+        self.rate = rate
+        self.latencies = defaultdict(list)
+        self.stages = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.requests = 0
+        self.sessions_started = 0
+        self.sessions_completed = 0
+        self.elapsed = 0.0
+
+    def record(self, route, status, seconds, server_timing):
+        self.requests += 1
+        self.statuses[route][status] += 1
+        if status == 200:
+            self.latencies[route].append(seconds)
+            for name, ms in server_timing.items():
+                self.stages[name].append(ms / 1000.0)
+
+    def count(self, predicate):
+        return sum(n for statuses in self.statuses.values()
+                   for status, n in statuses.items() if predicate(status))
+
+
+def parse_server_timing(header):
+    timings = {}
+    for part in (header or '').split(','):
+        match = re.match(r'\s*([^;]+);dur=([\d.]+)', part)
+        if match:
+            timings[match.group(1)] = float(match.group(2))
+    return timings
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+
+async def run_session(http, base_url, turns, think_time, results, request_timeout):
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
+    jar = aiohttp.CookieJar(unsafe=True)
+    async with aiohttp.ClientSession(connector=http, connector_owner=False, cookie_jar=jar,
+                                     timeout=timeout) as session:
+        start = time.perf_counter()
+        try:
+            async with session.get(base_url + '/') as response:
+                await response.read()
+                results.record('GET /', response.status, time.perf_counter() - start, {})
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            results.record('GET /', 'error', time.perf_counter() - start, {})
+            return
+
+        for message in turns:
+            await asyncio.sleep(random.expovariate(1 / think_time) if think_time > 0 else 0)
+            route = route_of(message)
+            start = time.perf_counter()
+            try:
+                async with session.post(base_url + '/', data={'user_input': message}) as response:
+                    await response.read()
+                    results.record(route, response.status, time.perf_counter() - start,
+                                   parse_server_timing(response.headers.get('Server-Timing')))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                results.record(route, 'error', time.perf_counter() - start, {})
+        results.sessions_completed += 1
+
+
+async def run_step(base_url, rate, duration, transcripts, think_time, request_timeout, rng):
+    """Starts sessions at `rate` per second for `duration` seconds and waits for them to finish."""
+    results = StepResults(rate)
+    connector = aiohttp.TCPConnector(limit=0)
+    tasks = []
+    start = time.perf_counter()
+    next_arrival = start
+
+    try:
+        while next_arrival - start < duration:
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            turns = rng.choice(transcripts) if transcripts else synthetic_transcript(rng)
+            tasks.append(asyncio.create_task(
+                run_session(connector, base_url, turns, think_time, results, request_timeout)))
+            results.sessions_started += 1
+            next_arrival += rng.expovariate(rate)
+
+        await asyncio.gather(*tasks)
+    finally:
+        await connector.close()
+
+    results.elapsed = time.perf_counter() - start
+    return results
+
+
+def format_ms(seconds):
+    return f"{seconds * 1000:8.0f}" if not math.isnan(seconds) else "       -"
+
+
+def report_step(results):
+    shed = results.count(lambda s: s in (429, 503))
+    errors = results.count(lambda s: s == 'error' or (isinstance(s, int) and s >= 500 and s != 503))
+    print(f"\n=== {results.rate:g} sessions/s: {results.sessions_started} sessions, "
+          f"{results.requests} requests in {results.elapsed:.1f}s "
+          f"({results.requests / results.elapsed:.1f} req/s) ===")
+    print(f"{'route':<24}{'count':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'shed':>7}{'errors':>8}")
+    for route in sorted(results.statuses):
+        statuses = results.statuses[route]
+        latencies = results.latencies[route]
+        route_shed = statuses.get(429, 0) + statuses.get(503, 0)
+        route_errors = sum(n for s, n in statuses.items()
+                           if s == 'error' or (isinstance(s, int) and s >= 500 and s != 503))
+        print(f"{route:<24}{sum(statuses.values()):>8}{format_ms(percentile(latencies, 50))} "
+              f"{format_ms(percentile(latencies, 95))} {format_ms(percentile(latencies, 99))}"
+              f"{route_shed:>7}{route_errors:>8}")
+    if results.stages:
+        print(f"{'stage':<24}{'count':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for name in sorted(results.stages):
+            values = results.stages[name]
+            print(f"{name:<24}{len(values):>8}{format_ms(percentile(values, 50))} "
+                  f"{format_ms(percentile(values, 95))} {format_ms(percentile(values, 99))}")
+    print(f"shed rate {shed / max(1, results.requests):.2%}, error rate {errors / max(1, results.requests):.2%}")
+    return shed, errors
+
+
+def is_saturated(results, shed, errors, slo_p95, max_failure_rate):
+    """A step is saturated if questions miss the p95 SLO or too many requests fail or are shed."""
+    failure_rate = (shed + errors) / max(1, results.requests)
+    question_latencies = [s for route, values in results.latencies.items()
+                          if route.startswith('POST') for s in values]
+    return failure_rate > max_failure_rate or percentile(question_latencies, 95) > slo_p95
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay chat traffic against DisasterConnect")
+    parser.add_argument('--url', help="target base URL; default runs the app in-process with fake upstreams")
+    parser.add_argument('--rates', default='1,2,5,10', help="comma-separated session arrival rates per second")
+    parser.add_argument('--step-seconds', type=float, default=30, help="arrival window per rate step")
+    parser.add_argument('--transcripts', help="JSONL export from conversation_store.py to replay")
+    parser.add_argument('--think-time', type=float, default=2.0, help="mean seconds between a session's turns")
+    parser.add_argument('--request-timeout', type=float, default=60.0, help="client timeout per request")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="multiplier on fake upstream latencies")
+    parser.add_argument('--slo-p95', type=float, default=5.0, help="p95 latency SLO for POSTs in seconds")
+    parser.add_argument('--max-failure-rate', type=float, default=0.01, help="shed + error rate considered saturated")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    transcripts = load_transcripts(args.transcripts) if args.transcripts else None
+    base_url = args.url.rstrip('/') if args.url else start_local_app(args.latency_scale)
+    rates = [float(rate) for rate in args.rates.split(',')]
+
+    saturation = None
+    for rate in rates:
+        results = asyncio.run(run_step(base_url, rate, args.step_seconds, transcripts,
+                                       args.think_time, args.request_timeout, rng))
+        shed, errors = report_step(results)
+        if saturation is None and is_saturated(results, shed, errors, args.slo_p95, args.max_failure_rate):
+            saturation = rate
+
+    if saturation is None:
+        print(f"\nNo saturation up to {rates[-1]:g} sessions/s")
+    else:
+        print(f"\nSaturation at {saturation:g} sessions/s (p95 > {args.slo_p95:g}s "
+              f"or failure rate > {args.max_failure_rate:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+from collections import Counter, namedtuple
+
+from admission import EMERGENCY_PATTERN
+from prefetch import detect_location
+
+#***********************************
+# Per-turn model routing
+#***********************************
+# Picks the model and output token limit for each completion from cheap local
+# features of the turn: its length, a keyword intent, whether a tool call is
+# likely, and how slow each model has been recently. Short acknowledgements go
+# to a small model with a tight token limit; long multi-part relief questions
+# go to a larger model unless its recent latency is over the route's budget,
+# in which case the route's fallback is used instead. One in PROBE_EVERY of
+# those turns still goes to the slow model so its estimate can recover.
+# An acknowledgement that answers an offer or question in the previous reply
+# ("Would you like me to email this?" - "sure") keeps the relief route and its
+# tools, so the confirmed action can still run.
+#
+# Routes can be overridden with a JSON file named by MODEL_ROUTES_FILE:
+#   {"routes": {"complex": {"model": "gpt-4o-mini", "max_tokens": 700}},
+#    "force": "relief"}
+# "force" pins every relief turn to one route (e.g. during an upstream incident).
+#
+# Usage: python model_router.py --bench [--turns 5000]
+
+Route = namedtuple('Route', ['name', 'model', 'max_tokens', 'tools', 'latency_budget', 'fallback'])
+
+DEFAULT_ROUTES = {
+    # "thanks", "ok", greetings: no tools, short answer
+    "small_talk": Route("small_talk", "gpt-4o-mini", 200, False, 3.0, None),
+    # Greeting and persona guidance
+    "persona": Route("persona", "gpt-4o-mini", 700, False, 8.0, None),
+    # Someone in danger: fast model, short actionable answer
+    "emergency": Route("emergency", "gpt-4o-mini", 400, True, 4.0, None),
+    # Ordinary relief questions and single tool lookups
+    "relief": Route("relief", "gpt-4o-mini", 700, True, 8.0, None),
+    # Long or multi-part questions that need several tools or careful reasoning
+    "complex": Route("complex", "gpt-4o", 900, True, 12.0, "relief"),
+}
+PROBE_EVERY = 10
+
+# USD per million tokens (input, output), for cost estimates
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+
+SMALL_TALK_PATTERN = re.compile(
+    r"^\W*(hi|hello|hey|thanks?( you)?|thank you( so much)?|ok(ay)?|got it|great|cool|bye|goodbye|"
+    r"sounds good|perfect)\W*$", re.IGNORECASE)
+# The previous reply explicitly offered to do something the next message may confirm; an
+# ordinary question is not an offer, so "thanks" after one is still small talk
+OFFER_PATTERN = re.compile(
+    r"\b(would you like me to|(do )?you want me to|shall i|should i)\b", re.IGNORECASE)
+TOOL_PATTERN = re.compile(
+    r"\b(weather|temperature|wind|rain|air quality|aqi|smoke|shelters?|nearest|near me|email)\b",
+    re.IGNORECASE)
+COMPLEX_WORDS = 60
+COMPLEX_PARTS = 3
+
+
+def previous_reply(messages):
+    """Text of the last assistant message in a prompt, or None."""
+    for message in reversed(messages):
+        role = message.get('role') if isinstance(message, dict) else getattr(message, 'role', None)
+        if role == 'assistant':
+            content = message.get('content') if isinstance(message, dict) else getattr(message, 'content', None)
+            if content:
+                return content
+    return None
+
+
+def turn_features(user_input, previous_reply=None):
+    """
+    Local features of a user message used for routing.
+
+    Args:
+        user_input (str): The user's message.
+        previous_reply (str): The assistant's previous message, if any.
+
+    Returns:
+        dict: words, parts (questions or clauses), intent and tools_likely.
+    """
+    text = user_input or ''
+    words = len(text.split())
+    parts = max(text.count('?'), 1) + len(re.findall(r'\b(and also|also|plus|as well as)\b', text, re.IGNORECASE))
+    tools_likely = bool(TOOL_PATTERN.search(text)) or detect_location(text) is not None
+
+    if SMALL_TALK_PATTERN.match(text) and not (previous_reply and OFFER_PATTERN.search(previous_reply)):
+        intent = "small_talk"
+    elif EMERGENCY_PATTERN.search(text):
+        intent = "emergency"
+    elif words >= COMPLEX_WORDS or parts >= COMPLEX_PARTS or (tools_likely and parts >= 2):
+        intent = "complex"
+    else:
+        intent = "relief"
+    return {"words": words, "parts": parts, "intent": intent, "tools_likely": tools_likely}
+
+
+class LatencyTracker:
+    """Exponentially weighted moving average of completion latency per model."""
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self._ewma = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model, seconds):
+        with self._lock:
+            previous = self._ewma.get(model)
+            self._ewma[model] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+
+    def estimate(self, model):
+        """Recent latency in seconds, or None before the first measurement."""
+        with self._lock:
+            return self._ewma.get(model)
+
+    def snapshot(self):
+        with self._lock:
+            return {model: round(seconds, 3) for model, seconds in self._ewma.items()}
+
+
+def load_route_overrides(path, routes=DEFAULT_ROUTES):
+    """
+    Applies a JSON override file to the routes.
+
+    Returns:
+        tuple: (routes dict, forced route name or None).
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        config = json.load(file)
+    routes = dict(routes)
+    for name, fields in config.get("routes", {}).items():
+        base = routes.get(name, DEFAULT_ROUTES["relief"]._replace(name=name))
+        routes[name] = base._replace(**{k: v for k, v in fields.items() if k in Route._fields and k != "name"})
+    force = config.get("force")
+    if force is not None and force not in routes:
+        raise ValueError(f"forced route {force!r} is not defined")
+    return routes, force
+
+
+class ModelRouter:
+    """
+    Chooses a Route per completion and keeps counts of the decisions.
+
+    Args:
+        routes (dict): Route name -> Route.
+        force (str): Route used for every relief turn, if set.
+        tracker (LatencyTracker): Recent latency per model; fed by observe().
+    """
+
+    def __init__(self, routes=None, force=None, tracker=None, probe_every=PROBE_EVERY):
+        self.routes = routes or dict(DEFAULT_ROUTES)
+        self.force = force
+        self.tracker = tracker or LatencyTracker()
+        self.probe_every = probe_every
+        self._counts = Counter()
+        self._fallbacks = Counter()
+        self._over_budget = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        path = os.getenv('MODEL_ROUTES_FILE')
+        if not path:
+            return cls()
+        routes, force = load_route_overrides(path)
+        return cls(routes, force)
+
+    def route(self, user_input, purpose="relief", previous_reply=None):
+        """
+        Args:
+            user_input (str): The user's message.
+            purpose (str): "relief" for answering a message, or a route name such as "persona".
+            previous_reply (str): The assistant's previous message, so a short reply
+                confirming an offer in it isn't treated as small talk.
+
+        Returns:
+            Route: The model, max_tokens and whether to offer tools.
+        """
+        if purpose != "relief":
+            name = purpose
+        elif self.force:
+            name = self.force
+        else:
+            name = turn_features(user_input, previous_reply)["intent"]
+        route = self.routes[name]
+
+        with self._lock:
+            # Over budget: step down to the fallback route, except for an occasional probe
+            fell_back = False
+            while route.fallback:
+                latency = self.tracker.estimate(route.model)
+                if latency is None or latency <= route.latency_budget:
+                    break
+                self._over_budget[route.name] += 1
+                if self._over_budget[route.name] % self.probe_every == 0:
+                    break
+                route = self.routes[route.fallback]
+                fell_back = True
+
+            self._counts[route.name] += 1
+            if fell_back:
+                self._fallbacks[name] += 1
+        return route
+
+    def observe(self, model, seconds):
+        self.tracker.observe(model, seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "routes": dict(self._counts),
+                "fallbacks": dict(self._fallbacks),
+                "forced": self.force,
+                "latency_ewma": self.tracker.snapshot(),
+            }
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    input_price, output_price = MODEL_PRICES.get(model, MODEL_PRICES["gpt-4o-mini"])
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+
+
+#***********************************
+# Benchmark with a simulated client
+#***********************************
+BENCH_TURNS = [
+    # (weight, message)
+    (20, "thanks"),
+    (8, "ok got it"),
+    (10, "1"),
+    (18, "How do I apply for FEMA assistance?"),
+    (14, "Is the water safe to drink after a flood?"),
+    (10, "What is the weather at 37.77, -122.42 right now?"),
+    (6, "Help me, I'm trapped by the flood in my house"),
+    (8, "My family lost our home in the fire and we have two kids and a dog. Where is the nearest shelter "
+        "that takes pets? Also what is the air quality near zip 95928, and how do we apply for FEMA "
+        "assistance and replace our IDs?"),
+    (6, "What's the weather and air quality at 39.14, -121.62, and is there a shelter nearby?"),
+]
+
+# Per model: (seconds to first token, seconds per output token)
+SIMULATED_SPEED = {
+    "gpt-4o-mini": (0.35, 0.006),
+    "gpt-4o": (0.60, 0.012),
+}
+STATIC_PROMPT_TOKENS = 3500
+
+
+class SimulatedClient:
+    """
+    Completion latency and token usage without network calls.
+
+    Between `slow_from` and `slow_until` (fractions of the run) the large model
+    is `slow_factor` times slower, to show latency-driven fallback.
+    """
+
+    def __init__(self, rng, slow_model="gpt-4o", slow_factor=3.0, slow_from=0.4, slow_until=0.6):
+        self.rng = rng
+        self.slow_model = slow_model
+        self.slow_factor = slow_factor
+        self.slow_window = (slow_from, slow_until)
+
+    def complete(self, model, message, prompt_tokens, max_tokens, progress):
+        first_token, per_token = SIMULATED_SPEED.get(model, SIMULATED_SPEED["gpt-4o-mini"])
+        # Short messages get short answers; long questions get long ones
+        words = len(message.split())
+        median = 40 if words <= 3 else 250 + 5 * words
+        wanted = int(self.rng.lognormvariate(math.log(median), 0.6))
+        completion_tokens = min(wanted, max_tokens) if max_tokens else wanted
+        seconds = (first_token + prompt_tokens / 20000 + completion_tokens * per_token) \
+            * self.rng.lognormvariate(0, 0.25)
+        if model == self.slow_model and self.slow_window[0] <= progress < self.slow_window[1]:
+            seconds *= self.slow_factor
+        return seconds, completion_tokens
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(pct / 100 * len(values))) - 1)] if values else 0.0
+
+
+def run_benchmark(turns=5000, seed=7, router=None, baseline_model=None):
+    """
+    Runs a mixed workload through the router (or one fixed model with no token limit).
+
+    Returns:
+        dict: route name -> list of (seconds, cost) samples.
+    """
+    rng = random.Random(seed)
+    client = SimulatedClient(rng)
+    weights = [weight for weight, _ in BENCH_TURNS]
+    messages = [message for _, message in BENCH_TURNS]
+    samples = {}
+    for i in range(turns):
+        message = rng.choices(messages, weights)[0]
+        if baseline_model:
+            model, max_tokens, name = baseline_model, None, baseline_model
+        else:
+            purpose = "persona" if message.strip() in ('1', '2', '3', '4') else "relief"
+            route = router.route(message, purpose)
+            model, max_tokens, name = route.model, route.max_tokens, route.name
+        prompt_tokens = STATIC_PROMPT_TOKENS + len(message.split()) * 2
+        seconds, completion_tokens = client.complete(model, message, prompt_tokens, max_tokens, i / turns)
+        if router is not None:
+            router.observe(model, seconds)
+        samples.setdefault(name, []).append((seconds, estimate_cost(model, prompt_tokens, completion_tokens)))
+    return samples
+
+
+def report(title, samples):
+    print(f"\n{title}")
+    print(f"{'route':<14}{'turns':>7}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'$/1k turns':>13}")
+    everything = []
+    for name, values in sorted(samples.items()):
+        everything.extend(values)
+        latencies = [seconds for seconds, _ in values]
+        cost = sum(c for _, c in values) / len(values) * 1000
+        print(f"{name:<14}{len(values):>7}{_percentile(latencies, 50):>9.2f}{_percentile(latencies, 95):>9.2f}"
+              f"{_percentile(latencies, 99):>9.2f}{cost:>13.3f}")
+    latencies = [seconds for seconds, _ in everything]
+    cost = sum(c for _, c in everything) / len(everything) * 1000
+    print(f"{'all':<14}{len(everything):>7}{_percentile(latencies, 50):>9.2f}{_percentile(latencies, 95):>9.2f}"
+          f"{_percentile(latencies, 99):>9.2f}{cost:>13.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DisasterConnect model routing")
+    parser.add_argument('--bench', action='store_true', help="run the simulated mixed-workload benchmark")
+    parser.add_argument('--turns', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args(argv)
+    if not args.bench:
+        parser.print_help()
+        return 0
+
+    for model in MODEL_PRICES:
+        report(f"Baseline: every turn on {model}, no token limit", run_benchmark(args.turns, args.seed,
+                                                                                 baseline_model=model))
+    router = ModelRouter.from_env()
+    report("Routed (large model 3x slower for 20% of the run)", run_benchmark(args.turns, args.seed, router))
+    print(f"\nFallbacks: {router.stats()['fallbacks']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
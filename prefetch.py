@@ -0,0 +1,337 @@
+import asyncio
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from resilience import current_deadline
+
+#***********************************
+# Tool result cache and speculative prefetch
+#***********************************
+# Once a user's location shows up in the conversation, the next turns almost
+# always ask for weather, air quality or shelters there. The Prefetcher runs
+# those tools on a small background pool as soon as the location is seen and
+# stores the results in the ToolResultCache, so the model's tool call later in
+# the conversation is answered from memory. A tool call that arrives while the
+# same lookup is still running waits for it instead of starting another one,
+# but never past its request deadline: prefetches run outside any deadline.
+
+# Coordinates rounded to 2 decimals (~1 km) share a cache entry
+COORDINATE_PRECISION = 2
+
+_COORDINATE_PAIR = re.compile(
+    r'(?:lat(?:itude)?\s*[:=]?\s*)?(-?\d{1,2}\.\d{2,})\s*(?:°\s*[NS]?)?\s*[,/ ]\s*'
+    r'(?:(?:and\s+)?lon(?:g(?:itude)?)?\s*[:=]?\s*)?(-?\d{1,3}\.\d{2,})', re.IGNORECASE)
+# "zip 94103", "zipcode: 94103", "postal code 94103"
+_LABELLED_ZIPCODE = re.compile(r'\b(?:zip|postal)(?:\s*code)?\s*(?:is|:|#)?\s*(\d{5})(?:-\d{4})?\b', re.IGNORECASE)
+_BARE_ZIPCODE = re.compile(r'(?<![\d.,$#-])\b(\d{5})(?:-\d{4})?\b(?![.,]\d)')
+
+
+def detect_location(text, is_known_zip=None):
+    """
+    Finds a location in a user message.
+
+    Args:
+        text (str): The message.
+        is_known_zip (callable): zip code -> bool. A 5-digit number without a "zip"
+            label only counts as a zip code if this accepts it; without it, only
+            labelled zip codes are found.
+
+    Returns:
+        dict or None: {"latitude", "longitude"} for coordinates, {"zipcode"} for a zip code.
+    """
+    match = _COORDINATE_PAIR.search(text or '')
+    if match:
+        latitude, longitude = float(match.group(1)), float(match.group(2))
+        if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            return {"latitude": latitude, "longitude": longitude}
+    match = _LABELLED_ZIPCODE.search(text or '')
+    if match:
+        return {"zipcode": match.group(1)}
+    if is_known_zip is not None:
+        for match in _BARE_ZIPCODE.finditer(text or ''):
+            if is_known_zip(match.group(1)):
+                return {"zipcode": match.group(1)}
+    return None
+
+
+def cache_key(tool_name, arguments):
+    """Canonical key: sorted arguments with coordinates rounded."""
+    canonical = []
+    for name, value in sorted(arguments.items()):
+        if name in ('latitude', 'longitude') and value is not None:
+            value = round(float(value), COORDINATE_PRECISION)
+        canonical.append((name, value))
+    return tool_name, tuple(canonical)
+
+
+def _is_error(value):
+    return isinstance(value, dict) and "error" in value
+
+
+# Result handed to callers waiting on a lookup that raised
+_FAILED = object()
+
+
+def _join_timeout():
+    """Seconds a request may wait for a lookup it joined: the rest of its deadline."""
+    deadline = current_deadline()
+    return deadline.remaining() if deadline is not None else None
+
+
+def _join_timed_out(tool_name):
+    return {"error": f"The {tool_name} lookup did not finish in time; try again shortly."}
+
+
+class _Entry:
+    __slots__ = ("value", "expires", "prefetched", "used")
+
+    def __init__(self, value, expires, prefetched):
+        self.value = value
+        self.expires = expires
+        self.prefetched = prefetched
+        self.used = False
+
+
+class ToolResultCache:
+    """
+    TTL + LRU cache of tool results.
+
+    Lookups in progress are kept as futures, so a call for a key that is being
+    fetched (by a prefetch or another request) joins it. Tracks how many
+    prefetched results were used before they expired or were evicted, and how
+    many were wasted.
+    """
+
+    def __init__(self, ttls, default_ttl=300.0, max_entries=5000):
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # key -> (Future, prefetched) for lookups in progress
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.prefetch_hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.join_timeouts = 0
+        self.wasted = 0
+
+    def _retire(self, entry):
+        if entry.prefetched and not entry.used:
+            self.wasted += 1
+
+    def get(self, key):
+        """Returns the cached value or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._retire(self._entries.pop(key))
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if entry.prefetched and not entry.used:
+                self.prefetch_hits += 1
+            entry.used = True
+            return entry.value
+
+    def contains(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry.expires > time.monotonic()
+
+    def put(self, key, value, prefetched=False):
+        ttl = self.ttls.get(key[0], self.default_ttl)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._retire(old)
+            self._entries[key] = _Entry(value, time.monotonic() + ttl, prefetched)
+            while len(self._entries) > self.max_entries:
+                self._retire(self._entries.popitem(last=False)[1])
+
+    def claim(self, key, prefetched=False):
+        """
+        Registers a lookup of key, unless one is already in progress.
+
+        Returns:
+            tuple: (future, prefetched, owner). The owner runs the lookup and hands
+            the result to resolve(); everyone else waits on the future.
+        """
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                return pending + (False,)
+            future = Future()
+            self._pending[key] = (future, prefetched)
+            return future, prefetched, True
+
+    def resolve(self, key, future, value):
+        """Caches the result of a claimed lookup and wakes its waiters; value is _FAILED if it raised."""
+        with self._lock:
+            _, prefetched = self._pending.get(key, (None, False))
+        if value is not _FAILED and not _is_error(value):
+            self.put(key, value, prefetched=prefetched)
+        with self._lock:
+            self._pending.pop(key, None)
+        future.set_result(value)
+
+    def _count_join(self, key, prefetched):
+        with self._lock:
+            self.joined += 1
+            entry = self._entries.get(key)
+            if entry is not None and entry.prefetched and not entry.used:
+                self.prefetch_hits += 1
+                entry.used = True
+
+    def _count_join_timeout(self):
+        with self._lock:
+            self.join_timeouts += 1
+
+    def call(self, tool_name, arguments, fn):
+        """
+        Returns fn(**arguments), served from the cache or an identical lookup in progress when possible.
+
+        Error results ({"error": ...}) are returned but not cached. Waiting for a
+        lookup in progress is bounded by the request deadline; past it the call
+        returns an error result.
+        """
+        key = cache_key(tool_name, arguments)
+        value = self.get(key)
+        if value is not None:
+            return value
+        future, prefetched, owner = self.claim(key)
+        if not owner:
+            try:
+                value = future.result(timeout=_join_timeout())
+            except FutureTimeout:
+                self._count_join_timeout()
+                return _join_timed_out(tool_name)
+            if value is not _FAILED:
+                self._count_join(key, prefetched)
+                return value
+            # The lookup we joined raised; make our own
+            return fn(**arguments)
+        value = _FAILED
+        try:
+            value = fn(**arguments)
+            return value
+        finally:
+            self.resolve(key, future, value)
+
+    async def acall(self, tool_name, arguments, coro_fn):
+        """call() for coroutine tools."""
+        key = cache_key(tool_name, arguments)
+        value = self.get(key)
+        if value is not None:
+            return value
+        future, prefetched, owner = self.claim(key)
+        if not owner:
+            # Shielded so a cancelled or timed out request doesn't cancel the lookup for the others
+            try:
+                value = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), _join_timeout())
+            except asyncio.TimeoutError:
+                self._count_join_timeout()
+                return _join_timed_out(tool_name)
+            if value is not _FAILED:
+                self._count_join(key, prefetched)
+                return value
+            return await coro_fn(**arguments)
+        value = _FAILED
+        try:
+            value = await coro_fn(**arguments)
+            return value
+        finally:
+            self.resolve(key, future, value)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "prefetch_hits": self.prefetch_hits,
+                "misses": self.misses,
+                "joined": self.joined,
+                "join_timeouts": self.join_timeouts,
+                "in_progress": len(self._pending),
+                "wasted_prefetches": self.wasted,
+            }
+
+
+class Prefetcher:
+    """Runs tool calls speculatively on a bounded background pool."""
+
+    def __init__(self, cache, max_workers=4, max_pending=32):
+        self.cache = cache
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def prefetch(self, tool_name, arguments, fn):
+        """Schedules fn(**arguments) unless it is cached, already running, or the pool is saturated."""
+        key = cache_key(tool_name, arguments)
+        if self.cache.contains(key):
+            return False
+        with self._lock:
+            if len(self._in_flight) >= self.max_pending:
+                self.skipped += 1
+                return False
+        # Tool calls for the same key made while this runs wait for its result
+        future, _, owner = self.cache.claim(key, prefetched=True)
+        if not owner:
+            return False
+        with self._lock:
+            self._in_flight.add(key)
+            self.scheduled += 1
+        try:
+            self._pool.submit(self._run, key, future, arguments, fn)
+        except RuntimeError:
+            # Shutting down: release the claim so waiters make their own lookup
+            self.cache.resolve(key, future, _FAILED)
+            with self._lock:
+                self._in_flight.discard(key)
+            return False
+        return True
+
+    def _run(self, key, future, arguments, fn):
+        value = _FAILED
+        try:
+            value = fn(**arguments)
+        except Exception as e:
+            print(f"Prefetch of {key[0]} failed: {e}")
+        finally:
+            self.cache.resolve(key, future, value)
+            with self._lock:
+                self._in_flight.discard(key)
+                if value is _FAILED or _is_error(value):
+                    self.failed += 1
+                else:
+                    self.completed += 1
+
+    def stats(self):
+        cache_stats = self.cache.stats()
+        with self._lock:
+            completed = self.completed
+            stats = {
+                "scheduled": self.scheduled,
+                "completed": completed,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "in_flight": len(self._in_flight),
+            }
+        stats.update(cache_stats)
+        # Share of completed prefetches that a later tool call actually used
+        stats["prefetch_hit_rate"] = cache_stats["prefetch_hits"] / completed if completed else 0.0
+        return stats
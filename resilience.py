@@ -0,0 +1,379 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import aiohttp
+import requests
+
+#***********************************
+# Resilience layer for upstream calls
+#***********************************
+# Every call to OpenAI, Pinecone or a tool API goes through call_upstream(), which
+#   - refuses to start work once the request deadline has passed,
+#   - fails fast while the upstream's circuit breaker is open,
+#   - retries only idempotent calls that failed with a retryable error, and only
+#     while the upstream's retry budget and the request deadline allow it.
+# When it gives up it raises UpstreamUnavailable so the caller can pick a fallback.
+# acall_upstream() applies the same policy to coroutines, sharing the breakers and
+# budgets, for the asyncio pipeline.
+
+DEFAULT_REQUEST_DEADLINE = 25.0  # seconds for a whole chat turn
+DEFAULT_ATTEMPT_TIMEOUT = 10.0   # seconds for a single upstream attempt
+
+
+class UpstreamUnavailable(Exception):
+    """Raised when an upstream call is not attempted or gives up."""
+
+    def __init__(self, upstream, reason, cause=None):
+        super().__init__(f"{upstream} unavailable: {reason}")
+        self.upstream = upstream
+        self.reason = reason
+        self.cause = cause
+
+
+class Deadline:
+    """End-to-end time budget for one request."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+_current_deadline = ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def request_deadline(seconds=DEFAULT_REQUEST_DEADLINE):
+    """Runs the enclosed block under an end-to-end deadline."""
+    deadline = Deadline(seconds)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def current_deadline():
+    """Returns the active Deadline, or None outside of a request."""
+    return _current_deadline.get()
+
+
+def attempt_timeout(default=DEFAULT_ATTEMPT_TIMEOUT):
+    """Timeout for the next upstream attempt, capped by the request deadline."""
+    deadline = current_deadline()
+    if deadline is None:
+        return default
+    # Never hand a zero timeout to a client library; expiry is checked before each attempt
+    return max(0.05, min(default, deadline.remaining()))
+
+
+class CircuitBreaker:
+    """
+    Classic three-state circuit breaker.
+
+    Closed: calls flow, consecutive failures are counted.
+    Open: calls are rejected until reset_timeout has elapsed.
+    Half-open: a limited number of trial calls decide whether to close again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.half_open_calls = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if a call may be attempted now."""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.half_open_calls = 0
+
+            if self.state == self.HALF_OPEN:
+                if self.half_open_calls >= self.half_open_max_calls:
+                    self.rejected += 1
+                    return False
+                self.half_open_calls += 1
+
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """Gives back a half-open trial slot for a call that proved nothing."""
+        with self._lock:
+            if self.state == self.HALF_OPEN and self.half_open_calls > 0:
+                self.half_open_calls -= 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of recent traffic.
+
+    Each first attempt deposits `ratio` tokens and each retry spends one, so
+    during a brownout retries cannot multiply the load on the upstream.
+    """
+
+    def __init__(self, ratio=0.2, max_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+
+class _Upstream:
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.budget = RetryBudget()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        # Counters are bumped from request threads and the event loop alike
+        self._lock = threading.Lock()
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def counters(self):
+        with self._lock:
+            return {"calls": self.calls, "retries": self.retries, "failures": self.failures}
+
+
+_upstreams = {}
+_upstreams_lock = threading.Lock()
+
+
+def get_upstream(name, failure_threshold=5, reset_timeout=30.0):
+    """Returns the shared breaker and retry budget for an upstream, creating them on first use."""
+    with _upstreams_lock:
+        upstream = _upstreams.get(name)
+        if upstream is None:
+            upstream = _Upstream(name, failure_threshold, reset_timeout)
+            _upstreams[name] = upstream
+        return upstream
+
+
+_RETRYABLE_OPENAI_ERRORS = ("APITimeoutError", "APIConnectionError", "RateLimitError", "InternalServerError")
+_RETRYABLE_GRPC_CODES = ("UNAVAILABLE", "DEADLINE_EXCEEDED", "RESOURCE_EXHAUSTED")
+
+
+def is_retryable(exc):
+    """
+    Decides whether a failed call is worth retrying.
+
+    Timeouts, connection failures, throttling and 5xx responses are retryable;
+    client errors such as a bad request or a bad API key are not.
+    """
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout, TimeoutError, asyncio.TimeoutError,
+                        ConnectionError)):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    if type(exc).__name__ in _RETRYABLE_OPENAI_ERRORS:
+        return True
+
+    if isinstance(exc, aiohttp.ClientConnectionError):
+        return True
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+
+    # grpc.RpcError (Pinecone) exposes the status through code()
+    code = getattr(exc, "code", None)
+    if callable(code):
+        try:
+            return getattr(code(), "name", "") in _RETRYABLE_GRPC_CODES
+        except Exception:
+            return False
+    return False
+
+
+def call_upstream(name, fn, *args, idempotent=True, max_attempts=3, base_delay=0.25, max_delay=2.0, **kwargs):
+    """
+    Calls fn(*args, **kwargs) against a named upstream with deadline, breaker and retry budget.
+
+    Args:
+        name (str): Upstream name, e.g. "openai" or "pinecone".
+        fn (callable): The call to make.
+        idempotent (bool): Only idempotent calls are ever retried.
+        max_attempts (int): Upper bound on attempts, including the first.
+        base_delay (float): Base of the jittered exponential backoff in seconds.
+        max_delay (float): Cap on a single backoff sleep in seconds.
+
+    Returns:
+        Whatever fn returns.
+
+    Raises:
+        UpstreamUnavailable: The deadline passed, the circuit is open, or retries ran out.
+        Exception: Non-retryable errors from fn are raised unchanged.
+    """
+    upstream, deadline = _start_call(name)
+    attempt = 0
+
+    while True:
+        attempt += 1
+        _check_attempt(name, upstream, deadline)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            delay = _retry_delay(name, upstream, deadline, e, attempt, idempotent, max_attempts,
+                                 base_delay, max_delay)
+            time.sleep(delay)
+            continue
+
+        upstream.breaker.record_success()
+        return result
+
+
+async def acall_upstream(name, fn, *args, idempotent=True, max_attempts=3, base_delay=0.25, max_delay=2.0,
+                         **kwargs):
+    """
+    Awaits fn(*args, **kwargs) with the same deadline, breaker and retry policy as call_upstream().
+
+    Cancellation is not a failure: it propagates without touching the breaker.
+    """
+    upstream, deadline = _start_call(name)
+    attempt = 0
+
+    while True:
+        attempt += 1
+        _check_attempt(name, upstream, deadline)
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            upstream.breaker.release()
+            raise
+        except Exception as e:
+            delay = _retry_delay(name, upstream, deadline, e, attempt, idempotent, max_attempts,
+                                 base_delay, max_delay)
+            await asyncio.sleep(delay)
+            continue
+
+        upstream.breaker.record_success()
+        return result
+
+
+def _start_call(name):
+    upstream = get_upstream(name)
+    upstream.count("calls")
+    upstream.budget.deposit()
+    return upstream, current_deadline()
+
+
+def _check_attempt(name, upstream, deadline):
+    if deadline is not None and deadline.expired():
+        raise UpstreamUnavailable(name, "request deadline exceeded")
+    if not upstream.breaker.allow():
+        raise UpstreamUnavailable(name, "circuit open")
+
+
+def _retry_delay(name, upstream, deadline, exc, attempt, idempotent, max_attempts, base_delay, max_delay):
+    """
+    Records a failed attempt and returns the backoff before the next one.
+
+    Raises:
+        The original exception if it is not retryable, or UpstreamUnavailable
+        when no further attempt is allowed.
+    """
+    if not is_retryable(exc):
+        # The upstream answered; the request itself was bad
+        upstream.breaker.release()
+        raise exc
+
+    upstream.count("failures")
+    upstream.breaker.record_failure()
+    print(f"Upstream {name} attempt {attempt} failed: {exc}")
+
+    delay = min(max_delay, base_delay * (2 ** (attempt - 1))) * random.random()
+    out_of_time = deadline is not None and deadline.remaining() <= delay
+    if (not idempotent or attempt >= max_attempts or out_of_time
+            or not upstream.budget.try_spend()):
+        raise UpstreamUnavailable(name, "retries exhausted", cause=exc) from exc
+
+    upstream.count("retries")
+    return delay
+
+
+def resilient_get(name, url, params=None, default_timeout=5.0):
+    """
+    GET request through call_upstream() with the timeout capped by the deadline.
+
+    Returns:
+        requests.Response: A response that passed raise_for_status().
+    """
+    def _get():
+        response = requests.get(url, params=params, timeout=attempt_timeout(default_timeout))
+        response.raise_for_status()
+        return response
+
+    return call_upstream(name, _get)
+
+
+async def aresilient_get_json(session, name, url, params=None, default_timeout=5.0):
+    """
+    GET request on an aiohttp session through acall_upstream(), returning the decoded JSON.
+    """
+    async def _get():
+        timeout = aiohttp.ClientTimeout(total=attempt_timeout(default_timeout))
+        async with session.get(url, params=params, timeout=timeout) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    return await acall_upstream(name, _get)
+
+
+def resilience_stats():
+    """Snapshot of per-upstream breaker state and call counters."""
+    with _upstreams_lock:
+        upstreams = dict(_upstreams)
+    return {
+        name: dict(upstream.breaker.snapshot(), **upstream.counters())
+        for name, upstream in upstreams.items()
+    }
@@ -0,0 +1,101 @@
+import html
+import json
+import os
+
+#***********************************
+# Built static asset lookup
+#***********************************
+# Reads the manifest written by build_assets.py and maps original asset names
+# to their content-hashed copies. Without a build every lookup falls back to
+# the original file, so the app still works before build_assets.py has run.
+
+BUILD_DIR = 'static_build'
+MANIFEST_FILE = os.path.join(BUILD_DIR, 'manifest.json')
+
+# Hashed files never change, so browsers may keep them for a year
+IMMUTABLE_MAX_AGE = 31536000
+# Un-hashed originals may change on deploy
+ORIGINAL_MAX_AGE = 300
+
+CHAT_IMAGE_SIZES = "(max-width: 600px) 90vw, 480px"
+# Variant types offered to browsers, best compression first
+VARIANT_TYPES = ('image/avif', 'image/webp')
+
+
+class AssetManifest:
+    """Original asset name -> hashed file and responsive variants."""
+
+    def __init__(self, manifest_file=MANIFEST_FILE):
+        self.images = {}
+        self.css = {}
+        self.hashed_files = set()
+
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r', encoding='utf-8') as file:
+                manifest = json.load(file)
+            self.images = manifest.get('images', {})
+            self.css = manifest.get('css', {})
+
+        for entry in list(self.images.values()) + list(self.css.values()):
+            self.hashed_files.add(entry['file'])
+            for variant in entry.get('variants', []):
+                self.hashed_files.add(variant['file'])
+
+    def is_hashed(self, filename):
+        return filename in self.hashed_files
+
+    def url(self, kind, filename):
+        """
+        URL of the best copy of an asset.
+
+        Args:
+            kind (str): "images" or "css".
+            filename (str): Original file name, e.g. "logo.png".
+        """
+        entry = getattr(self, kind, {}).get(filename)
+        return f"/{kind}/{entry['file'] if entry else filename}"
+
+    def srcset(self, filename, mime_type='image/webp'):
+        """srcset value listing the variants of an image with the given type, or '' if none."""
+        entry = self.images.get(filename)
+        if not entry:
+            return ''
+        return ", ".join(f"/images/{v['file']} {v['width']}w"
+                         for v in entry['variants'] if v['type'] == mime_type)
+
+    def largest_variant_url(self, filename, mime_type='image/webp'):
+        """URL of the widest variant with the given type, falling back to the image itself."""
+        entry = self.images.get(filename)
+        variants = [v for v in (entry or {}).get('variants', []) if v['type'] == mime_type]
+        if not variants:
+            return self.url('images', filename)
+        return f"/images/{max(variants, key=lambda v: v['width'])['file']}"
+
+    def image_tag(self, filename, alt, css_class="chat-image", sizes=CHAT_IMAGE_SIZES, lazy=True):
+        """
+        HTML for an image: a <picture> with AVIF and WebP sources when a build is
+        available, otherwise a plain <img>.
+
+        Browsers use the first <source> whose type they support and fall back to
+        the <img>, whose src is the (hashed) original.
+
+        Args:
+            sizes (str): sizes attribute for the responsive variants.
+            lazy (bool): Defer loading until the image is near the viewport.
+        """
+        alt = html.escape(alt, quote=True)
+        src = self.url('images', filename)
+        loading = ' loading="lazy" decoding="async"' if lazy else ''
+        img = f'<img src="{src}" alt="{alt}" class="{css_class}"{loading} />'
+
+        sources = [(mime_type, self.srcset(filename, mime_type)) for mime_type in VARIANT_TYPES]
+        sources = "".join(f'<source type="{mime_type}" srcset="{srcset}" sizes="{sizes}" />'
+                          for mime_type, srcset in sources if srcset)
+        if not sources:
+            return img
+        return f'<picture>{sources}{img}</picture>'
+
+
+def build_path(kind):
+    """Directory holding the built copies of an asset kind."""
+    return os.path.join(BUILD_DIR, kind)
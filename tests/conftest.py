@@ -0,0 +1,55 @@
+import json
+import os
+import tempfile
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py reads its data files relative to the repository root and configures
+# itself from the environment at import time
+os.chdir(ROOT)
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+os.environ.setdefault('PINECONE_API_KEY', 'test')
+os.environ.setdefault('CONVERSATION_DB', os.path.join(tempfile.mkdtemp(), 'conversations.db'))
+os.environ.setdefault('CLIENT_RATE_PER_MINUTE', '1000000')
+os.environ.setdefault('CLIENT_BURST', '1000000')
+
+
+@pytest.fixture(scope="session")
+def chat_app():
+    """The Flask app with OpenAI and Pinecone replaced by the load tester's instant fakes."""
+    import app as chat_app
+    from loadtest import FakeLatency, FakeOpenAI, FakePinecone
+
+    chat_app.client = FakeOpenAI(FakeLatency(0), FakeLatency(0))
+    chat_app.pc = FakePinecone(FakeLatency(0))
+    return chat_app
+
+
+@pytest.fixture
+def client(chat_app):
+    return chat_app.app.test_client()
+
+
+def fake_completion(content=None, tool_calls=None):
+    message = types.SimpleNamespace(role="assistant", content=content, tool_calls=tool_calls)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+
+def fake_tool_call(call_id, name, **arguments):
+    return types.SimpleNamespace(id=call_id, type="function",
+                                 function=types.SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+
+
+@pytest.fixture
+def completion():
+    """Builds a chat completion response as the OpenAI client returns it."""
+    return fake_completion
+
+
+@pytest.fixture
+def tool_call():
+    """Builds one tool call of a completion's assistant message."""
+    return fake_tool_call
@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+import uuid
+
+import pytest
+
+from admission import (PRIORITY_EMERGENCY, PRIORITY_NORMAL, PRIORITY_SURVIVOR, AdmissionController,
+                       ClientRateLimiter, Rejected, TokenBucket, classify_priority)
+
+
+def test_token_bucket_burst_then_refill(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    bucket = TokenBucket(rate=1.0, capacity=2)
+    assert bucket.try_take() == 0
+    assert bucket.try_take() == 0
+    assert bucket.try_take() == pytest.approx(1.0)
+    now[0] += 0.5
+    assert bucket.try_take() == pytest.approx(0.5)
+    now[0] += 0.5
+    assert bucket.try_take() == 0
+
+
+def test_rate_limiter_is_per_client():
+    limiter = ClientRateLimiter(rate_per_minute=1, burst=1)
+    assert limiter.check("a") == 0
+    assert limiter.check("a") > 0
+    assert limiter.check("b") == 0
+
+
+@pytest.mark.parametrize("message, user_type, expected", [
+    ("I'm trapped, help me", None, PRIORITY_EMERGENCY),
+    ("I'm trapped, help me", "Survivor/Caregiver", PRIORITY_EMERGENCY),
+    ("I'm trapped, help me", "Provider/Donor", PRIORITY_SURVIVOR),
+    ("Where is a shelter?", "Survivor/Caregiver", PRIORITY_SURVIVOR),
+    ("Where is a shelter?", "Concerned Public", PRIORITY_NORMAL),
+])
+def test_classify_priority(message, user_type, expected):
+    assert classify_priority(message, user_type) == expected
+
+
+def test_rate_limited_turns_are_rejected():
+    controller = AdmissionController(rate_limiter=ClientRateLimiter(rate_per_minute=1, burst=1))
+    with controller.admit(client_key="a"):
+        pass
+    with pytest.raises(Rejected) as rejected:
+        with controller.admit(client_key="a"):
+            pass
+    assert rejected.value.reason == "rate_limited"
+    assert controller.stats()["shed"]["rate_limited"] == 1
+
+
+def test_shed_turns_give_their_token_back():
+    controller = AdmissionController(max_concurrent=1, max_queue=0, max_wait=0.05,
+                                     rate_limiter=ClientRateLimiter(rate_per_minute=1, burst=1))
+    with controller.admit(client_key="other"):
+        with pytest.raises(Rejected) as rejected:
+            with controller.admit(client_key="a"):
+                pass
+        assert rejected.value.reason == "queue_full"
+    # The shed turn did not use up the client's only token
+    with controller.admit(client_key="a"):
+        pass
+
+    controller.max_queue = 1
+    with controller.admit(client_key="c"):
+        with pytest.raises(Rejected) as rejected:
+            with controller.admit(client_key="b"):
+                pass
+        assert rejected.value.reason == "timeout"
+    with controller.admit(client_key="b"):
+        pass
+    assert controller.stats()["shed"]["rate_limited"] == 0
+
+
+def test_full_queue_sheds_and_emergency_displaces():
+    controller = AdmissionController(max_concurrent=1, max_queue=1, max_wait=2)
+    results = {}
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with controller.admit():
+            holding.set()
+            release.wait()
+
+    def wait(name, priority):
+        try:
+            with controller.admit(priority):
+                results[name] = "admitted"
+        except Rejected as e:
+            results[name] = e.reason
+
+    threads = [threading.Thread(target=hold)]
+    threads[0].start()
+    holding.wait()
+    threads.append(threading.Thread(target=wait, args=("normal", PRIORITY_NORMAL)))
+    threads[-1].start()
+    while controller.stats()["queue_depth"] < 1:
+        time.sleep(0.001)
+
+    with pytest.raises(Rejected) as rejected:
+        with controller.admit(PRIORITY_NORMAL):
+            pass
+    assert rejected.value.reason == "queue_full"
+
+    threads.append(threading.Thread(target=wait, args=("emergency", PRIORITY_EMERGENCY)))
+    threads[-1].start()
+    while "normal" not in results:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == {"normal": "displaced", "emergency": "admitted"}
+    assert controller.stats()["in_flight"] == 0
+
+
+def test_queued_turn_times_out():
+    controller = AdmissionController(max_concurrent=1, max_queue=4, max_wait=0.05)
+    with controller.admit():
+        with pytest.raises(Rejected) as rejected:
+            with controller.admit():
+                pass
+    assert rejected.value.reason == "timeout"
+    assert controller.stats()["in_flight"] == 0
+
+
+def test_aadmit_cancelled_while_queued_leaves_the_queue():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, max_queue=4, max_wait=5)
+        async with controller.aadmit():
+            waiting = asyncio.ensure_future(controller.aadmit().__aenter__())
+            await asyncio.sleep(0.01)
+            assert controller.stats()["queue_depth"] == 1
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+        return controller.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["queue_depth"] == 0
+    assert stats["in_flight"] == 0
+
+
+def test_priority_comes_from_the_requesting_conversation(chat_app, client, monkeypatch):
+    survivor, public = uuid.uuid4().hex, uuid.uuid4().hex
+    client.set_cookie("dc_conversation", survivor)
+    client.post("/", data={"user_input": "1"})
+    client.set_cookie("dc_conversation", public)
+    client.post("/", data={"user_input": "3"})
+
+    priorities = []
+    admit = chat_app.admission.admit
+
+    def recording_admit(priority, client_key=None):
+        priorities.append(priority)
+        return admit(priority, client_key)
+
+    monkeypatch.setattr(chat_app.admission, "admit", recording_admit)
+    for conversation_id in (survivor, public):
+        client.set_cookie("dc_conversation", conversation_id)
+        client.post("/", data={"user_input": "Where is a shelter?"})
+    assert priorities == [PRIORITY_SURVIVOR, PRIORITY_NORMAL]
+
+
+def test_rate_limit_is_per_conversation_not_per_address(chat_app, client, monkeypatch):
+    monkeypatch.setattr(chat_app.admission, "rate_limiter", ClientRateLimiter(rate_per_minute=1, burst=1))
+    # Two browsers behind the same address each get their own bucket
+    for _ in range(2):
+        client.set_cookie("dc_conversation", uuid.uuid4().hex)
+        assert client.post("/", data={"user_input": "1"}).status_code == 200
+    assert client.post("/", data={"user_input": "Where is a shelter?"}).status_code == 429
+    # Without a cookie the address is the bucket
+    client.delete_cookie("dc_conversation")
+    assert client.post("/", data={"user_input": "1"}).status_code == 200
+    client.delete_cookie("dc_conversation")
+    assert client.post("/", data={"user_input": "1"}).status_code == 429
+
+
+def test_forwarded_client_address_trusts_only_the_configured_proxies(chat_app, monkeypatch):
+    assert chat_app.forwarded_client_address("10.0.0.1", "203.0.113.9") == "10.0.0.1"
+    monkeypatch.setattr(chat_app, "TRUSTED_PROXIES", 1)
+    # A client-supplied entry before the proxy's own is ignored
+    assert chat_app.forwarded_client_address("10.0.0.1", "6.6.6.6, 203.0.113.9") == "203.0.113.9"
+    assert chat_app.forwarded_client_address("10.0.0.1", None) == "10.0.0.1"
+    assert chat_app.rate_limit_key(None, "203.0.113.9") == "address:203.0.113.9"
+    assert chat_app.rate_limit_key("abc", "203.0.113.9") == "conversation:abc"
@@ -0,0 +1,84 @@
+import uuid
+
+from conversations import Conversation
+
+
+def post(client, conversation_id, message):
+    client.set_cookie("dc_conversation", conversation_id)
+    return client.post("/", data={"user_input": message})
+
+
+def test_conversations_are_isolated(chat_app, client):
+    alice, bob = uuid.uuid4().hex, uuid.uuid4().hex
+    assert post(client, alice, "1").status_code == 200
+    assert post(client, alice, "My name is Alice Example, how do I apply for FEMA aid?").status_code == 200
+
+    response = post(client, bob, "How do I volunteer?")
+    assert response.status_code == 200
+    assert b"Alice Example" not in response.data
+
+    bob_conversation = chat_app.conversations.get(bob)
+    assert not any("Alice" in str(m.get("content")) for m in bob_conversation.context if isinstance(m, dict))
+    assert bob_conversation.user_type is None
+    assert chat_app.conversations.get(alice).user_type == "Survivor/Caregiver"
+
+
+def test_role_selection_is_per_conversation(chat_app, client):
+    first, second = uuid.uuid4().hex, uuid.uuid4().hex
+    post(client, first, "How do I volunteer?")
+    # The second conversation was just greeted, so "2" picks its role even though the
+    # first conversation's last message is an answer
+    post(client, second, "2")
+    assert chat_app.conversations.get(second).user_type == "Provider/Donor"
+    assert chat_app.conversations.get(first).user_type is None
+
+
+def test_restart_restores_only_the_cookie_owners_conversation(chat_app, client):
+    owner = uuid.uuid4().hex
+    post(client, owner, "1")
+    post(client, owner, "Is the water safe to drink at 123 Private Lane?")
+    chat_app.conversation_store.flush()
+
+    # A restart loses the in-memory state; the owner comes back with the cookie
+    restored = chat_app.load_conversation(owner)
+    assert restored.user_type == "Survivor/Caregiver"
+    assert any("123 Private Lane" in entry[0] for entry in restored.chat_history)
+
+    stranger = chat_app.load_conversation(uuid.uuid4().hex)
+    assert stranger.chat_history == []
+    assert not any("123 Private Lane" in str(m.get("content")) for m in stranger.context)
+
+
+def test_greeting_is_generated_once(chat_app, client):
+    calls = []
+    create = chat_app.client.chat.completions.create
+
+    def counting_create(**kwargs):
+        calls.append(kwargs)
+        return create(**kwargs)
+
+    chat_app.client.chat.completions.create = counting_create
+    chat_app.initial_greeting = None
+    try:
+        for _ in range(3):
+            chat_app.get_initial_greeting(Conversation(uuid.uuid4().hex, chat_app.chatContext))
+    finally:
+        chat_app.client.chat.completions.create = create
+    assert len(calls) == 1
+
+
+def test_restored_persona_message_sits_where_the_role_was_selected(chat_app, client):
+    owner = uuid.uuid4().hex
+    post(client, owner, "1")
+    post(client, owner, "Where can I get drinking water?")
+    live = chat_app.conversations.get(owner)
+    chat_app.conversation_store.flush()
+
+    restored = chat_app.load_conversation(owner)
+    persona = restored.context[restored.persona_index]
+    assert persona == chat_app.persona_message("Survivor/Caregiver")
+    assert [m for m in restored.context if m == persona] == [persona]
+    # Right after the selection, before the later question and its answer
+    assert restored.context[restored.persona_index - 1] == {"role": "user", "content": "1"}
+    assert restored.context[-2]["content"] == "Where can I get drinking water?"
+    assert live.context[live.persona_index] == persona
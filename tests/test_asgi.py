@@ -0,0 +1,114 @@
+import asyncio
+import uuid
+
+import pytest
+from starlette.testclient import TestClient
+
+from app import ReliefAnswer
+
+
+@pytest.fixture
+def asgi(chat_app):
+    import asgi
+    return asgi
+
+
+def ready_conversation(chat_app):
+    """A conversation past the greeting and role selection, so the next POST is a relief question."""
+    conversation = chat_app.conversations.get(uuid.uuid4().hex)
+    conversation.chat_history.append(("Welcome", "bot", "2024-01-01 00:00:00"))
+    conversation.user_type = "Survivor/Caregiver"
+    conversation.answered_questions = 1
+    return conversation
+
+
+def test_other_routes_fall_through_to_flask(asgi):
+    with TestClient(asgi.app) as client:
+        stats = client.get("/stats")
+        assert stats.status_code == 200
+        assert "admission" in stats.json()
+
+        page = client.get("/")
+        assert page.status_code == 200
+        assert "text/html" in page.headers["content-type"]
+
+        assert client.get("/css/missing.css").status_code == 404
+
+
+def test_chat_post_is_answered_by_the_async_pipeline(chat_app, asgi, monkeypatch):
+    async def answer(messages, user_input):
+        return ReliefAnswer("Apply at disasterassistance.gov.", [], False)
+
+    monkeypatch.setattr(asgi.async_pipeline, "agenerate_relief_answer", answer)
+    conversation = ready_conversation(chat_app)
+    with TestClient(asgi.app) as client:
+        client.cookies.set(chat_app.CONVERSATION_COOKIE, conversation.id)
+        response = client.post("/", data={"user_input": "How do I apply for FEMA aid?"})
+
+    assert response.status_code == 200
+    assert "disasterassistance.gov" in response.text
+    assert "Server-Timing" in response.headers
+    assert conversation.chat_history[-1][1] == "bot"
+
+
+def test_client_disconnect_cancels_the_turn(chat_app, asgi, monkeypatch):
+    # TestClient never disconnects mid-request, so this drives the ASGI app directly
+    cancelled = []
+
+    async def slow_answer(messages, user_input):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(user_input)
+            raise
+
+    monkeypatch.setattr(asgi.async_pipeline, "agenerate_relief_answer", slow_answer)
+    conversation = ready_conversation(chat_app)
+    context_before = list(conversation.context)
+    history_before = list(conversation.chat_history)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/", "raw_path": b"/", "root_path": "", "query_string": b"",
+        "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+        "headers": [(b"host", b"testserver"),
+                    (b"content-type", b"application/x-www-form-urlencoded"),
+                    (b"cookie", f"{chat_app.CONVERSATION_COOKIE}={conversation.id}".encode())],
+    }
+    body = [{"type": "http.request", "body": b"user_input=Is+the+water+safe%3F", "more_body": False}]
+    sent = []
+
+    async def receive():
+        if body:
+            return body.pop(0)
+        await asyncio.sleep(0.1)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    async def main():
+        started = asyncio.get_running_loop().time()
+        await asgi.app(scope, receive, send)
+        return asyncio.get_running_loop().time() - started
+
+    elapsed = asyncio.run(main())
+
+    assert elapsed < 2
+    assert cancelled == ["Is the water safe?"]
+    assert sent[0]["status"] == asgi.CLIENT_CLOSED_REQUEST
+    # The unanswered message is forgotten
+    assert conversation.context == context_before
+    assert conversation.chat_history == history_before
+
+
+def test_until_disconnected_returns_the_result_when_the_client_stays(asgi):
+    class Request:
+        async def receive(self):
+            await asyncio.sleep(5)
+
+    async def work():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    assert asyncio.run(asgi.until_disconnected(Request(), work())) == "done"
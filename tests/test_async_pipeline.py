@@ -0,0 +1,165 @@
+import asyncio
+import threading
+import time
+import types
+import uuid
+
+import pytest
+
+from conversations import Conversation
+from token_accounting import PromptTooLarge
+
+
+class ScriptedAsyncOpenAI:
+    """AsyncOpenAI stand-in that returns the given completions in order."""
+
+    def __init__(self, *replies, delay=0.0):
+        self.replies = list(replies)
+        self.requests = []
+        self.delay = delay
+
+        async def create_completion(**kwargs):
+            self.requests.append(kwargs)
+            await asyncio.sleep(self.delay)
+            return self.replies.pop(0)
+
+        async def create_embedding(**kwargs):
+            return types.SimpleNamespace(data=[types.SimpleNamespace(embedding=[0.1] * 8)])
+
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=create_completion))
+        self.embeddings = types.SimpleNamespace(create=create_embedding)
+
+
+@pytest.fixture
+def pipeline(chat_app):
+    import async_pipeline
+    return async_pipeline
+
+
+def new_conversation(chat_app):
+    conversation = Conversation(uuid.uuid4().hex, chat_app.chatContext)
+    conversation.user_type = "Survivor/Caregiver"
+    conversation.answered_questions = 1
+    return conversation
+
+
+def test_tool_calls_run_concurrently_before_one_follow_up(pipeline, monkeypatch, completion, tool_call):
+    started = {}
+
+    async def slow_tool(name, latitude, longitude):
+        started[name] = time.monotonic()
+        await asyncio.sleep(0.2)
+        return {"tool": name, "latitude": latitude}
+
+    monkeypatch.setitem(pipeline.async_functions, "get_current_weather",
+                        lambda **kwargs: slow_tool("weather", **kwargs))
+    monkeypatch.setitem(pipeline.async_functions, "GetCurrentAirQuality",
+                        lambda date, **kwargs: slow_tool("air", **kwargs))
+    client = ScriptedAsyncOpenAI(
+        completion(tool_calls=[tool_call("call_1", "get_current_weather", latitude=11.11, longitude=22.22),
+                               tool_call("call_2", "GetCurrentAirQuality", latitude=11.11, longitude=22.22,
+                                         date="2024-01-01")]),
+        completion("Sunny with good air."))
+    monkeypatch.setattr(pipeline, "aclient", client)
+
+    messages = [{"role": "user", "content": "Weather and air quality at 11.11, 22.22?"}]
+    started_at = time.monotonic()
+    answer = asyncio.run(pipeline.agenerate_relief_answer(messages, messages[-1]["content"]))
+
+    assert answer.content == "Sunny with good air."
+    assert answer.used_tools
+    assert time.monotonic() - started_at < 0.38
+    assert abs(started["weather"] - started["air"]) < 0.1
+    # One completion asked for the tools, a single follow-up saw both results
+    assert len(client.requests) == 2
+    follow_up = client.requests[1]["messages"]
+    assert [m["tool_call_id"] for m in follow_up if isinstance(m, dict) and m.get("role") == "tool"] == \
+        ["call_1", "call_2"]
+    # The caller's list is not modified
+    assert len(messages) == 1
+
+
+def test_turn_is_recorded_in_its_conversation(chat_app, pipeline, monkeypatch, completion):
+    monkeypatch.setattr(pipeline, "aclient", ScriptedAsyncOpenAI(completion("Apply at disasterassistance.gov.")))
+    conversation = new_conversation(chat_app)
+    reply = asyncio.run(pipeline.achat_turn(conversation, "How do I apply for FEMA aid?"))
+    assert "disasterassistance.gov" in reply
+    assert conversation.context[-1] == {"role": "assistant", "content": "Apply at disasterassistance.gov."}
+    assert any(m.get("content") == "How do I apply for FEMA aid?" for m in conversation.context
+               if isinstance(m, dict))
+
+
+def test_cancelled_turn_forgets_the_message(chat_app, pipeline, monkeypatch, completion):
+    monkeypatch.setattr(pipeline, "aclient", ScriptedAsyncOpenAI(completion("late"), delay=5))
+    conversation = new_conversation(chat_app)
+    before = list(conversation.context)
+
+    async def main():
+        task = asyncio.create_task(pipeline.achat_turn(conversation, "Is the water safe to drink?"))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert conversation.context == before
+
+
+def test_oversized_turn_gets_an_apology(chat_app, pipeline, monkeypatch):
+    def refuse(messages, tools=None):
+        raise PromptTooLarge("user", 5000, 4000, {})
+
+    monkeypatch.setattr(pipeline, "aclient", ScriptedAsyncOpenAI())
+    monkeypatch.setattr(chat_app.token_accountant, "fit", refuse)
+    conversation = new_conversation(chat_app)
+    before = list(conversation.context)
+    reply = asyncio.run(pipeline.achat_turn(conversation, "word " * 5000))
+    assert reply == chat_app.PROMPT_TOO_LARGE_MESSAGE
+    assert conversation.context == before
+
+
+def test_retrieval_overlaps_a_slow_tool_list(chat_app, pipeline, monkeypatch, completion):
+    ticks = []
+
+    def slow_offered_tools():
+        # A geo index reload, blocking its thread
+        time.sleep(0.2)
+        return chat_app.tools
+
+    async def slow_retrieval(user_input):
+        await asyncio.sleep(0.2)
+        return ["Shelters are open."]
+
+    async def ticker():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.02)
+
+    monkeypatch.setattr(chat_app, "offered_tools", slow_offered_tools)
+    monkeypatch.setattr(pipeline, "aquery_knowledge_base", slow_retrieval)
+    client = ScriptedAsyncOpenAI(completion("Go to the high school gym."))
+    monkeypatch.setattr(pipeline, "aclient", client)
+
+    async def main():
+        ticking = asyncio.create_task(ticker())
+        started_at = time.monotonic()
+        answer = await pipeline.agenerate_relief_answer([], "Where is the nearest shelter?")
+        elapsed = time.monotonic() - started_at
+        ticking.cancel()
+        return answer, elapsed
+
+    answer, elapsed = asyncio.run(main())
+    assert answer.content == "Go to the high school gym."
+    assert elapsed < 0.35
+    assert client.requests[0]["tools"] == chat_app.tools
+    # The event loop kept running while the tool list was built
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.1
+
+
+def test_shelter_lookup_runs_off_the_event_loop(chat_app, pipeline, monkeypatch):
+    loop_thread = threading.get_ident()
+    seen = []
+    monkeypatch.setattr(chat_app, "get_shelter_info",
+                        lambda **kwargs: seen.append(threading.get_ident()) or {"sites": []})
+    assert asyncio.run(pipeline.aget_shelter_info(zipcode="91001")) == {"sites": []}
+    assert seen and seen[0] != loop_thread
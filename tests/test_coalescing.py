@@ -0,0 +1,239 @@
+import asyncio
+import threading
+import time
+import uuid
+
+import pytest
+
+from coalescing import SingleFlight
+from tracing import record_retrieval, stage, start_turn
+
+
+def run_concurrently(n, target):
+    results = [None] * n
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, target())) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_calls_share_one_execution():
+    flights = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def work():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return "answer"
+
+    def call():
+        return flights.do("key", work)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    results = run_concurrently(4, call)
+    leader.join()
+
+    assert calls == [1]
+    assert results == [("answer", True)] * 4
+    assert flights.stats()["followers"] == 4
+
+
+def test_follower_receives_the_leaders_exception():
+    flights = SingleFlight()
+    started = threading.Event()
+
+    def work():
+        started.set()
+        time.sleep(0.05)
+        raise ValueError("boom")
+
+    errors = []
+
+    def call():
+        try:
+            flights.do("key", work)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    call()
+    leader.join()
+    assert len(errors) == 2
+
+
+def test_follower_wait_is_bounded():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def work():
+        started.set()
+        release.wait()
+        return "late"
+
+    leader = threading.Thread(target=lambda: flights.do("key", work))
+    leader.start()
+    started.wait()
+    with pytest.raises(TimeoutError):
+        flights.do("key", work, timeout=0.05)
+    release.set()
+    leader.join()
+    assert flights.stats()["timed_out"] == 1
+
+
+def test_sequential_calls_do_not_share():
+    flights = SingleFlight()
+    assert flights.do("key", lambda: 1) == (1, False)
+    assert flights.do("key", lambda: 2) == (2, False)
+
+
+def test_async_calls_share_and_cancel_only_when_all_waiters_leave():
+    async def scenario():
+        flights = SingleFlight()
+        runs = []
+
+        async def work():
+            runs.append(1)
+            await asyncio.sleep(10)
+
+        first = asyncio.ensure_future(flights.ado("key", work))
+        second = asyncio.ensure_future(flights.ado("key", work))
+        await asyncio.sleep(0.01)
+        task = flights._async_calls["key"].task
+
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert not task.cancelled()
+
+        second.cancel()
+        await asyncio.sleep(0.01)
+        assert task.cancelled()
+        return runs
+
+    assert asyncio.run(scenario()) == [1]
+
+
+def test_async_follower_times_out():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.2)
+            return "answer"
+
+        leader = asyncio.ensure_future(flights.ado("key", work))
+        await asyncio.sleep(0)
+        with pytest.raises(TimeoutError):
+            await flights.ado("key", work, timeout=0.01)
+        return await leader, flights.stats()["timed_out"]
+
+    assert asyncio.run(scenario()) == (("answer", False), 1)
+
+
+def test_identical_first_questions_coalesce_across_conversations(chat_app, monkeypatch):
+    gate = threading.Event()
+    generate = chat_app.generate_relief_answer
+    calls = []
+
+    def slow_generate(messages, user_input):
+        calls.append(user_input)
+        gate.wait(5)
+        return generate(messages, user_input)
+
+    monkeypatch.setattr(chat_app, "generate_relief_answer", slow_generate)
+    question = f"How do I apply for aid {uuid.uuid4().hex}?"
+    conversations = [chat_app.conversations.get(uuid.uuid4().hex) for _ in range(3)]
+    for conversation in conversations:
+        chat_app.ensure_greeting(conversation)
+
+    threads = [threading.Thread(target=chat_app.get_disaster_relief_response, args=(c, question))
+               for c in conversations]
+    for thread in threads:
+        thread.start()
+    while len(calls) < 1:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    gate.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [question]
+    assert all(c.answered_questions == 1 for c in conversations)
+
+    # A later question in one of them depends on its history, so it runs on its own
+    assert chat_app.stateless_messages(conversations[0], question) is None
+    assert chat_app.stateless_messages(chat_app.conversations.get(uuid.uuid4().hex), question) is not None
+
+
+def run_coalesced_turns(chat_app, monkeypatch, generate, n=3):
+    """Asks n new conversations the same first question at once; returns their traces."""
+    gate = threading.Event()
+    calls = []
+
+    def slow_generate(messages, user_input):
+        calls.append(user_input)
+        gate.wait(5)
+        return generate(messages, user_input)
+
+    monkeypatch.setattr(chat_app, "generate_relief_answer", slow_generate)
+    question = f"How do I apply for aid {uuid.uuid4().hex}?"
+    conversations = [chat_app.conversations.get(uuid.uuid4().hex) for _ in range(n)]
+    for conversation in conversations:
+        chat_app.ensure_greeting(conversation)
+
+    def turn(conversation):
+        with start_turn() as trace:
+            chat_app.get_disaster_relief_response(conversation, question)
+        return trace
+
+    traces = [None] * n
+    threads = [threading.Thread(target=lambda i=i: traces.__setitem__(i, turn(conversations[i]))) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    while len(calls) < 1:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    gate.set()
+    for thread in threads:
+        thread.join()
+    return calls, traces
+
+
+def test_followers_copy_the_leaders_trace(chat_app, monkeypatch):
+    def generate(messages, user_input):
+        record_retrieval(["kb-1", "kb-2"])
+        with stage("completion"):
+            pass
+        return chat_app.ReliefAnswer("answer", [], False)
+
+    calls, traces = run_coalesced_turns(chat_app, monkeypatch, generate)
+
+    assert len(calls) == 1
+    assert sorted(trace.values["coalesced"] for trace in traces) == [False, True, True]
+    for trace in traces:
+        assert trace.retrieval_ids == ["kb-1", "kb-2"]
+        assert "completion" in trace.timings
+
+
+def test_followers_that_rerun_tool_answers_are_counted_once(chat_app, monkeypatch):
+    def generate(messages, user_input):
+        return chat_app.ReliefAnswer("answer", [], True)
+
+    before = chat_app.relief_flights.stats()
+    calls, traces = run_coalesced_turns(chat_app, monkeypatch, generate)
+    after = chat_app.relief_flights.stats()
+
+    # Both followers ran the question themselves, so nothing was actually shared
+    assert len(calls) == 3
+    assert [trace.values["coalesced"] for trace in traces] == [False, False, False]
+    assert after["leaders"] - before["leaders"] == 1
+    assert after["followers"] == before["followers"]
+    assert after["bypassed"] - before["bypassed"] == 2
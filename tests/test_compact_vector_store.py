@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from compact_vector_store import CompactStoreWriter, CompactVectorStore, load_compact_store, quantize_vector
+
+DIM = 64
+
+
+def unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("int8", 0.01), ("float16", 0.001)])
+def test_quantize_round_trip(dtype, tolerance):
+    rng = np.random.default_rng(0)
+    vector = rng.normal(size=DIM)
+    codes, scale = quantize_vector(vector, dtype)
+    assert codes.dtype == np.dtype(dtype)
+    restored = codes.astype(np.float32) * scale
+    assert np.max(np.abs(restored - unit(vector))) < tolerance
+
+
+def test_quantize_zero_vector():
+    codes, scale = quantize_vector(np.zeros(DIM), "int8")
+    assert not codes.any()
+    assert scale == 1.0
+
+
+@pytest.fixture
+def vectors():
+    return np.random.default_rng(1).normal(size=(500, DIM)).astype(np.float32)
+
+
+def write_store(path, vectors, dtype):
+    with CompactStoreWriter(str(path), "test-model", DIM, dtype=dtype) as writer:
+        for i, vector in enumerate(vectors):
+            writer.add(f"id-{i}", vector, f"text {i}")
+    return CompactVectorStore(str(path))
+
+
+@pytest.mark.parametrize("dtype", ["int8", "float16"])
+def test_search_matches_brute_force(tmp_path, vectors, dtype):
+    store = write_store(tmp_path / "store", vectors, dtype)
+    query = np.random.default_rng(2).normal(size=DIM)
+
+    exact = np.stack([unit(v) for v in vectors]) @ unit(query)
+    results = store.search(query, top_k=5)
+
+    assert [record_id for record_id, _, _ in results] == [f"id-{i}" for i in np.argsort(-exact)[:5]]
+    for record_id, score, text in results:
+        i = int(record_id.split("-")[1])
+        assert text == f"text {i}"
+        assert score == pytest.approx(exact[i], abs=0.02)
+    store.close()
+
+
+def test_candidates_are_re_scored_at_full_precision(tmp_path, vectors):
+    store = write_store(tmp_path / "store", vectors, "int8")
+    assert store.rescore_dtype == "float32"
+    query = np.random.default_rng(3).normal(size=DIM)
+
+    exact = np.stack([unit(v) for v in vectors]) @ unit(query)
+    results = store.search(query, top_k=10, oversample=4)
+
+    assert [record_id for record_id, _, _ in results] == [f"id-{i}" for i in np.argsort(-exact)[:10]]
+    # The returned scores are the float scores, not the int8 approximations
+    for record_id, score, _ in results:
+        assert score == pytest.approx(exact[int(record_id.split("-")[1])], abs=1e-5)
+    store.close()
+
+
+def test_store_without_originals_uses_approximate_scores(tmp_path, vectors):
+    store = write_store(tmp_path / "store", vectors, "int8")
+    store.originals = None
+    query = np.random.default_rng(2).normal(size=DIM)
+    exact = np.stack([unit(v) for v in vectors]) @ unit(query)
+    results = store.search(query, top_k=3)
+    assert [record_id for record_id, _, _ in results] == [f"id-{i}" for i in np.argsort(-exact)[:3]]
+    store.close()
+
+
+def test_search_small_store_returns_everything_sorted(tmp_path, vectors):
+    store = write_store(tmp_path / "store", vectors[:3], "int8")
+    results = store.search(vectors[1], top_k=10)
+    assert len(results) == 3
+    assert results[0][0] == "id-1"
+    assert [score for _, score, _ in results] == sorted((score for _, score, _ in results), reverse=True)
+    store.close()
+
+
+def test_empty_store(tmp_path):
+    store = write_store(tmp_path / "store", [], "int8")
+    assert len(store) == 0
+    assert store.search(np.ones(DIM)) == []
+    store.close()
+
+
+def test_load_compact_store_missing(tmp_path):
+    assert load_compact_store(str(tmp_path / "missing")) is None
@@ -0,0 +1,54 @@
+import queue
+
+from conversation_store import ConversationStore, export_jsonl, iter_turns
+
+
+def test_close_commits_queued_turns(tmp_path):
+    db = str(tmp_path / "log.db")
+    store = ConversationStore(db)
+    for i in range(500):
+        store.record_turn("c1", "user", f"question {i}")
+    store.close()
+
+    turns = list(iter_turns(db))
+    assert len(turns) == 500
+    assert turns[-1]["content"] == "question 499"
+    assert store.stats()["written"] == 500
+
+
+def test_close_is_idempotent_and_later_turns_are_dropped(tmp_path):
+    store = ConversationStore(str(tmp_path / "log.db"))
+    store.close()
+    store.close()
+    assert store.record_turn("c1", "user", "late") is False
+    assert store.stats()["dropped"] == 1
+
+
+def test_full_queue_drops_and_counts(tmp_path):
+    store = ConversationStore(str(tmp_path / "log.db"), max_queue=1, put_timeout=0.01)
+    # Stop the writer from draining so the queue stays full
+    store._queue.put = lambda row, timeout=None: (_ for _ in ()).throw(queue.Full())
+    assert store.record_turn("c1", "user", "dropped") is False
+    assert store.stats()["dropped"] == 1
+    del store._queue.put
+    store.close()
+
+
+def test_load_conversation_round_trip(tmp_path):
+    store = ConversationStore(str(tmp_path / "log.db"))
+    store.record_turn("c1", "user", "where is the shelter?", user_type="Survivor/Caregiver")
+    store.record_turn("c1", "bot", "<b>Here</b>", raw_content="**Here**", tool_calls=[{"name": "x"}],
+                      prompt_tokens=[{"total": 10}])
+    store.record_turn("c2", "user", "other conversation")
+    store.flush()
+
+    turns = store.load_conversation("c1")
+    assert [turn["role"] for turn in turns] == ["user", "bot"]
+    assert turns[1]["raw_content"] == "**Here**"
+    assert turns[1]["tool_calls"] == [{"name": "x"}]
+    assert turns[1]["prompt_tokens"] == [{"total": 10}]
+
+    out = tmp_path / "export.jsonl"
+    with open(out, "w", encoding="utf-8") as file:
+        assert export_jsonl(file, store.db_path, "c2") == 1
+    store.close()
@@ -0,0 +1,50 @@
+import threading
+
+from conversations import Conversation, ConversationRegistry
+
+STATIC = [{'role': 'developer', 'content': 'static prompt'}]
+
+
+def test_conversation_starts_from_static_context():
+    conversation = Conversation("a", STATIC)
+    conversation.context.append({'role': 'user', 'content': 'hi'})
+    assert STATIC == [{'role': 'developer', 'content': 'static prompt'}]
+    assert conversation.chat_history == []
+    assert conversation.user_type is None
+    assert conversation.answered_questions == 0
+
+
+def test_registry_reuses_and_evicts_least_recently_used():
+    created = []
+
+    def create(conversation_id):
+        created.append(conversation_id)
+        return Conversation(conversation_id, STATIC)
+
+    registry = ConversationRegistry(create, max_conversations=2)
+    a = registry.get("a")
+    registry.get("b")
+    assert registry.get("a") is a
+    registry.get("c")  # evicts b, the least recently used
+
+    assert len(registry) == 2
+    registry.get("b")
+    assert created == ["a", "b", "c", "b"]
+    assert registry.stats() == {"active": 2, "created": 4, "evicted": 2}
+
+
+def test_registry_concurrent_get_returns_one_conversation():
+    barrier = threading.Barrier(8)
+
+    def create(conversation_id):
+        barrier.wait()
+        return Conversation(conversation_id, STATIC)
+
+    registry = ConversationRegistry(create)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("same"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(conversation) for conversation in results}) == 1
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+from geo_index import GeoIndex, KDTree, chord_to_km, km_to_chord, to_unit_vectors
+
+SAMPLE_DIR = os.path.join("data", "geo_sample")
+
+
+def random_points(n, seed):
+    rng = np.random.default_rng(seed)
+    return to_unit_vectors(rng.uniform(-80.0, 80.0, n), rng.uniform(-180.0, 180.0, n))
+
+
+@pytest.mark.parametrize("n_points", [1, 50, 5000])
+def test_nearest_matches_brute_force(n_points):
+    points = random_points(n_points, seed=n_points)
+    tree = KDTree(points, leaf_size=16)
+    for query in random_points(100, seed=1):
+        n = min(5, n_points)
+        d2, positions = tree.nearest(query, n)
+        expected = np.sort(np.einsum('ij,ij->i', points - query, points - query))[:n]
+        assert np.allclose(d2, expected)
+        # Positions index the reordered points
+        assert np.allclose(np.einsum('ij,ij->i', tree.points[positions] - query, tree.points[positions] - query), d2)
+
+
+def test_within_matches_brute_force():
+    points = random_points(5000, seed=3)
+    tree = KDTree(points, leaf_size=16)
+    radius = km_to_chord(800.0)
+    for query in random_points(50, seed=4):
+        found = sorted(tree.within(query, radius))
+        expected = np.nonzero(np.linalg.norm(tree.points - query, axis=1) <= radius)[0].tolist()
+        assert found == expected
+
+
+def test_empty_tree():
+    tree = KDTree(np.empty((0, 3)))
+    d2, positions = tree.nearest(np.array([1.0, 0.0, 0.0]), 3)
+    assert len(d2) == len(positions) == 0
+    assert tree.within(np.array([1.0, 0.0, 0.0]), 1.0) == []
+
+
+def test_chord_distance_round_trip():
+    assert float(chord_to_km(km_to_chord(123.4))) == pytest.approx(123.4)
+    # San Francisco to Los Angeles is about 559 km
+    sf, la = to_unit_vectors([37.7749, 34.0522], [-122.4194, -118.2437])
+    assert float(chord_to_km(np.linalg.norm(sf - la))) == pytest.approx(559, abs=5)
+
+
+def test_sample_data_loads():
+    index = GeoIndex(SAMPLE_DIR)
+    assert len(index) == 12
+    assert index.zip_location("94103") == (37.7725, -122.4147)
+    assert index.zip_location("00000") is None
+
+    latitude, longitude = index.zip_location("91001")
+    sites = index.nearest(latitude, longitude, n=3)
+    assert sites[0]["city"] == "Altadena"
+    assert [site["distance_km"] for site in sites] == sorted(site["distance_km"] for site in sites)
+    assert all(site["dataset"] == "sample_sites" for site in sites)
+
+    nearby = index.within_radius(latitude, longitude, radius_km=30)
+    assert {site["city"] for site in nearby} == {"Altadena", "Pasadena", "Los Angeles"}
+    assert index.nearest(latitude, longitude, n=5, max_km=0.1) == []
+
+
+def test_reload_picks_up_new_files(tmp_path):
+    index = GeoIndex(str(tmp_path), check_interval=0)
+    assert len(index) == 0
+    (tmp_path / "sites.csv").write_text("name,lat,lng\nHall,37.0,-122.0\nGym,37.1,-122.1\n", encoding="utf-8")
+    index.maybe_reload(force=True)
+    assert len(index) == 2
+    assert index.nearest(37.0, -122.0, n=1)[0]["name"] == "Hall"
+
+
+def test_shelter_tool_is_offered_only_with_sites(chat_app, monkeypatch, tmp_path):
+    def names(tools):
+        return {tool["function"]["name"] for tool in tools}
+
+    monkeypatch.setattr(chat_app, "geo_index", GeoIndex(str(tmp_path)))
+    assert "get_shelter_info" not in names(chat_app.offered_tools())
+    assert "get_current_weather" in names(chat_app.offered_tools())
+
+    monkeypatch.setattr(chat_app, "geo_index", GeoIndex(SAMPLE_DIR))
+    assert "get_shelter_info" in names(chat_app.offered_tools())
+    result = chat_app.get_shelter_info(zipcode="94103")
+    assert result["sites"][0]["city"] == "San Francisco"
+    assert result["sites"][0]["distance_miles"] < 1
@@ -0,0 +1,218 @@
+import numpy as np
+
+import ingest
+from ingest import (NearDuplicateFilter, minhash_signature, normalize, pack_chunks, parse_text, prepared_batches,
+                    run_ingest, sign_paragraphs, unique_chunks)
+
+BOILERPLATE = [
+    "For the latest evacuation orders, road closures and shelter locations, visit the county "
+    "emergency services website or call the public information line.",
+    "If you are in immediate danger, call 911. Do not call 911 for general information about the "
+    "incident; use the information line instead.",
+    "This bulletin is issued by the Joint Information Center on behalf of all responding agencies.",
+]
+
+
+def write_bulletins(directory, count):
+    for n in range(count):
+        news = (f"Update {n}: crews increased containment of the Ridge fire to {n * 4} percent overnight, "
+                f"and evacuation warning zone {n} has been lifted for residents of sector {n * 7}.")
+        (directory / f"bulletin_{n:02d}.txt").write_text("\n\n".join([news] + BOILERPLATE), encoding="utf-8")
+
+
+def fake_embed(texts):
+    return [[float(len(text)), 1.0] for text in texts]
+
+
+def test_shared_boilerplate_is_embedded_once(tmp_path):
+    write_bulletins(tmp_path, 20)
+    upserted = []
+    counts = run_ingest([str(tmp_path)], fake_embed, upserted.extend, "bulletins", workers=1)
+
+    texts = [vector["metadata"]["text"] for vector in upserted]
+    for paragraph in BOILERPLATE:
+        assert sum(paragraph in text for text in texts) == 1
+    for n in range(20):
+        assert sum(f"Update {n}:" in text for text in texts) == 1
+    assert counts["dropped"] == 19 * len(BOILERPLATE)
+    assert counts["upserted"] == len(upserted)
+
+
+def test_lsh_flags_near_duplicates_and_keeps_distinct_text():
+    dedupe = NearDuplicateFilter(capacity=16)
+    original = BOILERPLATE[0]
+    reworded = original.replace("public information line", "public information hotline")
+
+    assert not dedupe.is_duplicate(minhash_signature(original))
+    assert dedupe.is_duplicate(minhash_signature(original))
+    assert dedupe.is_duplicate(minhash_signature(reworded))
+    assert not dedupe.is_duplicate(minhash_signature(BOILERPLATE[1]))
+    assert (dedupe.kept, dedupe.dropped) == (2, 2)
+
+
+def test_lsh_forgets_the_oldest_signature_when_full():
+    dedupe = NearDuplicateFilter(capacity=2)
+    signatures = [minhash_signature(text) for text in BOILERPLATE]
+    for signature in signatures:
+        assert not dedupe.is_duplicate(signature)
+    # The first signature was evicted to make room for the third
+    assert not dedupe.is_duplicate(signatures[0])
+    assert dedupe.is_duplicate(signatures[2])
+
+
+def test_minhash_agreement_tracks_jaccard_similarity():
+    words = [f"word{i}" for i in range(200)]
+    a = minhash_signature(" ".join(words))
+    b = minhash_signature(" ".join(words[:100] + [f"other{i}" for i in range(100)]))
+    # 96 of the 296 distinct 5-word shingles are shared: Jaccard ~0.32
+    assert 0.15 < np.mean(a == b) < 0.5
+
+
+def test_short_paragraphs_are_never_dropped(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("Shelters\n\nRed Cross shelter at the high school gym is open.\n\nShelters\n\n", encoding="utf-8")
+    source = str(path)
+    signed = sign_paragraphs(parse_text(source))
+    dedupe = NearDuplicateFilter(capacity=8)
+    chunks = list(unique_chunks([(source, signed)], dedupe, chunk_size=500))
+    assert chunks == [(source, "Shelters\n\nRed Cross shelter at the high school gym is open.\n\nShelters")]
+
+
+def test_large_files_stream_in_paragraph_batches(tmp_path):
+    path = tmp_path / "long.txt"
+    path.write_text("\n\n".join(f"Paragraph {n} about road closure number {n} in sector {n}." for n in range(100)),
+                    encoding="utf-8")
+    batches = list(prepared_batches([str(path)], workers=1, batch_size=16))
+    assert [len(signed) for _, signed in batches] == [16] * 6 + [4]
+    assert {source for source, _ in batches} == {str(path)}
+
+    # Batches of one file are packed together, as if the file were one batch
+    streamed = list(unique_chunks(iter(batches), NearDuplicateFilter(capacity=256), chunk_size=500))
+    whole = list(unique_chunks([(str(path), [p for _, signed in batches for p in signed])],
+                               NearDuplicateFilter(capacity=256), chunk_size=500))
+    assert streamed == whole
+
+
+def test_parse_text_streams_paragraphs_across_block_boundaries(tmp_path):
+    path = tmp_path / "long.txt"
+    paragraphs = [f"Paragraph {n} " + "word " * n for n in range(50)]
+    path.write_text("\n\n".join(paragraphs), encoding="utf-8")
+    parsed = [normalize(p) for p in parse_text(str(path), block_size=7)]
+    assert [p for p in parsed if p] == [normalize(p) for p in paragraphs]
+
+
+def test_parse_text_cuts_paragraphs_without_blank_lines(tmp_path):
+    path = tmp_path / "wall.txt"
+    path.write_text("x" * 1000, encoding="utf-8")
+    parsed = list(ingest._split_paragraphs(ingest._read_blocks(str(path), 64), max_chars=100))
+    assert "".join(parsed) == "x" * 1000
+    assert max(len(p) for p in parsed) <= 100 + 64
+
+
+def test_parse_markdown_drops_code_blocks_spanning_paragraphs(tmp_path):
+    path = tmp_path / "guide.md"
+    path.write_text("# Go bag\n\nPack **water** and a [map](https://example.org/map).\n\n"
+                    "```\ncode\n\nmore code\n```\n\nCheck on neighbors.", encoding="utf-8")
+    parsed = [normalize(p) for p in parse_text(str(path), block_size=5)]
+    assert [p for p in parsed if p] == ["Go bag", "Pack water and a map (https://example.org/map).",
+                                        "Check on neighbors."]
+
+
+def test_markdown_keeps_underscores_in_urls_and_identifiers(tmp_path):
+    path = tmp_path / "links.md"
+    path.write_text("See https://www.fema.gov/disaster_assistance/apply_now and the `evac_zone_id` field.\n\n"
+                    "This is *very* **important** and _urgent_, unlike snake_case_name or 2*3*4.\n\n"
+                    "Read [the guide](https://example.org/go_bag_list).", encoding="utf-8")
+    parsed = [normalize(p) for p in parse_text(str(path))]
+    assert [p for p in parsed if p] == [
+        "See https://www.fema.gov/disaster_assistance/apply_now and the evac_zone_id field.",
+        "This is very important and urgent, unlike snake_case_name or 2*3*4.",
+        "Read the guide (https://example.org/go_bag_list).",
+    ]
+
+
+def test_parse_html_keeps_visible_blocks(tmp_path):
+    path = tmp_path / "page.html"
+    path.write_text("<html><head><style>p{}</style></head><body><nav>Menu</nav>"
+                    "<p>Shelter open</p><p>Roads closed</p><script>var x;</script></body></html>",
+                    encoding="utf-8")
+    parsed = [normalize(p) for p in parse_text(str(path), block_size=9)]
+    assert [p for p in parsed if p] == ["Shelter open", "Roads closed"]
+
+
+def test_pack_chunks_respects_chunk_size():
+    paragraphs = ["a" * 40, "b" * 40, "c" * 40, "Sentence one. " + "d" * 90 + "."]
+    chunks = pack_chunks(paragraphs, chunk_size=100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert chunks[0] == "a" * 40 + "\n\n" + "b" * 40
+
+
+class FakeIndex:
+    """Records by id, with the upsert, delete and list calls run_ingest makes."""
+
+    def __init__(self, records=()):
+        self.records = {record_id: None for record_id in records}
+
+    def upsert(self, vectors):
+        self.records.update((vector["id"], vector["metadata"]["text"]) for vector in vectors)
+
+    def delete(self, ids):
+        for record_id in ids:
+            self.records.pop(record_id, None)
+
+    def list_ids(self, prefix):
+        return [record_id for record_id in self.records if record_id.startswith(prefix)]
+
+
+def ingest_into(index, paths, manifest_path):
+    return run_ingest(paths, fake_embed, index.upsert, "dc", workers=1,
+                      manifest=ingest.IngestManifest(str(manifest_path)), delete_batch=index.delete,
+                      list_ids=index.list_ids)
+
+
+def test_reruns_replace_legacy_and_stale_records(tmp_path):
+    sources = tmp_path / "sources"
+    sources.mkdir()
+    write_bulletins(sources, 3)
+    manifest_path = tmp_path / "manifest.json"
+    # Records of the original loader, plus one from another namespace prefix
+    index = FakeIndex([f"dc_{n}" for n in range(1, 40)] + ["other_1"])
+
+    counts = ingest_into(index, [str(sources)], manifest_path)
+    assert counts["deleted"] == 39
+    assert not ingest.legacy_ids(index.records, "dc")
+    first_run = dict(index.records)
+    assert "other_1" in first_run
+
+    # An unchanged re-run changes nothing
+    assert ingest_into(index, [str(sources)], manifest_path)["deleted"] == 0
+    assert index.records == first_run
+
+    # Editing a file replaces its records; deleting one removes them
+    (sources / "bulletin_01.txt").write_text("Update 1: the Ridge fire is fully contained.", encoding="utf-8")
+    (sources / "bulletin_02.txt").unlink()
+    counts = ingest_into(index, [str(sources)], manifest_path)
+    texts = [text for text in index.records.values() if text]
+    assert counts["deleted"] > 0
+    assert any("fully contained" in text for text in texts)
+    assert not any("Update 1: crews" in text or "Update 2:" in text for text in texts)
+    assert sum("Update 0:" in text for text in texts) == 1
+
+
+def test_sources_outside_a_run_keep_their_records(tmp_path):
+    first, second = tmp_path / "first.txt", tmp_path / "second.txt"
+    first.write_text("Shelter at the high school gym is open tonight for evacuees.", encoding="utf-8")
+    second.write_text("Boil water notice for the north district until further notice.", encoding="utf-8")
+    manifest_path = tmp_path / "manifest.json"
+    index = FakeIndex()
+
+    ingest_into(index, [str(first)], manifest_path)
+    ingest_into(index, [str(second)], manifest_path)
+    assert len(index.records) == 2
+
+    first.write_text("The high school gym shelter has closed; go to the community center.", encoding="utf-8")
+    assert ingest_into(index, [str(first)], manifest_path)["deleted"] == 1
+    assert sorted(index.records.values()) == [
+        "Boil water notice for the north district until further notice.",
+        "The high school gym shelter has closed; go to the community center.",
+    ]
@@ -0,0 +1,94 @@
+import json
+import uuid
+
+import pytest
+
+from loadtest import (FakeCompletions, FakeHTTPResponse, FakeLatency, make_fake_requests_get,
+                      parse_server_timing, percentile, route_of)
+
+TOOLS = [{"type": "function", "function": {"name": "get_current_weather"}}]
+
+
+def test_fake_calls_a_tool_when_retrieval_follows_the_question():
+    messages = [
+        {"role": "developer", "content": "You are DisasterConnect."},
+        {"role": "user", "content": "What is the weather at 37.77, -122.42 right now?"},
+        {"role": "system", "content": "Relevant information: ..."},
+    ]
+    message = FakeCompletions(FakeLatency(0)).create(messages=messages, tools=TOOLS).choices[0].message
+    assert message.content is None
+    assert message.tool_calls[0].function.name == "get_current_weather"
+    assert json.loads(message.tool_calls[0].function.arguments) == {"latitude": 37.77, "longitude": -122.42}
+
+
+def test_fake_answers_once_the_tool_results_are_in():
+    messages = [
+        {"role": "user", "content": "What's the air quality at 39.14, -121.62 today?"},
+        {"role": "system", "content": "Relevant information: ..."},
+        {"role": "assistant", "content": None},
+        {"role": "tool", "tool_call_id": "call_1", "name": "GetCurrentAirQuality", "content": "{}"},
+    ]
+    message = FakeCompletions(FakeLatency(0)).create(messages=messages, tools=TOOLS).choices[0].message
+    assert message.tool_calls is None
+    assert message.content
+
+
+def test_fake_requests_get_passes_other_urls_through():
+    real_calls = []
+    real_response = object()
+
+    def real_get(url, **kwargs):
+        real_calls.append(url)
+        return real_response
+
+    fake_get = make_fake_requests_get(FakeLatency(0), real_get)
+    weather = fake_get("https://api.open-meteo.com/v1/forecast", params={"latitude": 1, "longitude": 2})
+    assert isinstance(weather, FakeHTTPResponse)
+    assert "current_weather" in weather.json()
+    assert fake_get("https://www.airnowapi.org/aq/forecast/latLong/").json()[0]["AQI"] == 77
+    assert real_calls == []
+
+    tokenizer_url = "https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken"
+    assert fake_get(tokenizer_url, timeout=5) is real_response
+    assert real_calls == [tokenizer_url]
+
+
+def test_tool_questions_reach_the_tools(chat_app, client, monkeypatch):
+    fetched = []
+
+    def real_get(url, **kwargs):
+        pytest.fail(f"unexpected request to {url}")
+
+    fake_get = make_fake_requests_get(FakeLatency(0), real_get)
+
+    def recording_get(url, **kwargs):
+        fetched.append(url)
+        return fake_get(url, **kwargs)
+
+    monkeypatch.setattr(chat_app.requests, "get", recording_get)
+    client.set_cookie("dc_conversation", uuid.uuid4().hex)
+    client.post("/", data={"user_input": "1"})
+    # Coordinates no other test uses, so the tool cache can't answer
+    response = client.post("/", data={"user_input": "What is the weather at 12.34, 56.78 right now?"})
+    assert response.status_code == 200
+    assert any("open-meteo" in url for url in fetched)
+
+
+def test_route_of():
+    assert route_of(" 2 ") == "POST / persona"
+    assert route_of("What is the weather at 37.77, -122.42 right now?") == "POST / tool question"
+    assert route_of("How do I volunteer?") == "POST / question"
+
+
+def test_parse_server_timing():
+    header = "retrieval;dur=12.5, model;dur=900, malformed"
+    assert parse_server_timing(header) == {"retrieval": 12.5, "model": 900.0}
+    assert parse_server_timing(None) == {}
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 100) == 100
+    assert percentile([3.0], 99) == 3.0
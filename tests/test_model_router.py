@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+from model_router import (DEFAULT_ROUTES, LatencyTracker, ModelRouter, load_route_overrides, previous_reply,
+                          turn_features)
+
+
+@pytest.mark.parametrize("message, intent", [
+    ("thanks!", "small_talk"),
+    ("ok got it", "relief"),
+    ("How do I apply for FEMA assistance?", "relief"),
+    ("What is the weather at 37.77, -122.42 right now?", "relief"),
+    ("Help me, I'm trapped by the flood in my house", "emergency"),
+    ("What's the air quality at 39.14, -121.62? Is there a shelter nearby?", "complex"),
+    ("How do I replace my ID? Where do I get water? Can I bring my dog?", "complex"),
+])
+def test_intents(message, intent):
+    assert turn_features(message)["intent"] == intent
+
+
+@pytest.mark.parametrize("message", ["yes", "No.", "yes please", "sure"])
+def test_yes_and_no_keep_tools(message):
+    assert ModelRouter().route(message).tools
+
+
+@pytest.mark.parametrize("message", ["ok", "sounds good", "perfect", "thanks"])
+def test_acknowledging_an_offer_keeps_tools(message):
+    router = ModelRouter()
+    offer = "I can send these shelter details to you. Would you like me to email them?"
+    assert router.route(message).name == "small_talk"
+    route = router.route(message, previous_reply=offer)
+    assert route.name == "relief"
+    assert route.tools
+    assert router.route(message, previous_reply="Stay safe, and call 911 in an emergency.").name == "small_talk"
+
+
+@pytest.mark.parametrize("reply", [
+    "Have you registered with FEMA yet?",
+    "Is everyone in your household safe? Stay away from downed power lines.",
+    "Let me know if you have other questions.",
+])
+def test_thanks_after_an_ordinary_question_is_small_talk(reply):
+    assert ModelRouter().route("thanks", previous_reply=reply).name == "small_talk"
+
+
+@pytest.mark.parametrize("reply", [
+    "Shall I look up shelters near 91001?",
+    "Do you want me to check the air quality there?",
+    "Should I email you this list?",
+])
+def test_explicit_offers_keep_tools(reply):
+    assert ModelRouter().route("ok", previous_reply=reply).name == "relief"
+
+
+def test_previous_reply_finds_the_last_assistant_text():
+    class ToolCallMessage:
+        role = "assistant"
+        content = None
+
+    messages = [
+        {"role": "developer", "content": "static"},
+        {"role": "assistant", "content": "Shall I look up shelters near you?"},
+        {"role": "user", "content": "ok"},
+        ToolCallMessage(),
+        {"role": "tool", "content": "{}"},
+    ]
+    assert previous_reply(messages) == "Shall I look up shelters near you?"
+    assert previous_reply([{"role": "user", "content": "hi"}]) is None
+
+
+def test_persona_purpose_bypasses_intent():
+    assert ModelRouter().route("yes", purpose="persona").name == "persona"
+
+
+def test_slow_model_falls_back_with_probes():
+    tracker = LatencyTracker(alpha=1.0)
+    router = ModelRouter(tracker=tracker, probe_every=5)
+    long_question = " ".join(["word"] * 80)
+    assert router.route(long_question).name == "complex"
+
+    tracker.observe(DEFAULT_ROUTES["complex"].model, DEFAULT_ROUTES["complex"].latency_budget * 2)
+    names = [router.route(long_question).name for _ in range(10)]
+    # Every fifth over-budget turn probes the slow model
+    assert names.count("complex") == 2
+    assert names.count("relief") == 8
+    assert router.stats()["fallbacks"] == {"complex": 8}
+
+    tracker.observe(DEFAULT_ROUTES["complex"].model, 1.0)
+    assert router.route(long_question).name == "complex"
+
+
+def test_route_overrides(tmp_path):
+    path = tmp_path / "routes.json"
+    path.write_text(json.dumps({"routes": {"complex": {"model": "gpt-4o-mini", "max_tokens": 500}},
+                                "force": "relief"}), encoding="utf-8")
+    routes, force = load_route_overrides(str(path))
+    assert routes["complex"].model == "gpt-4o-mini"
+    assert routes["complex"].max_tokens == 500
+    assert routes["complex"].tools
+    router = ModelRouter(routes, force)
+    assert router.route("thanks").name == "relief"
+
+    path.write_text(json.dumps({"force": "missing"}), encoding="utf-8")
+    with pytest.raises(ValueError):
+        load_route_overrides(str(path))
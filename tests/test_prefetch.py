@@ -0,0 +1,226 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import prefetch
+from prefetch import Prefetcher, ToolResultCache, cache_key, detect_location
+from resilience import request_deadline
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(prefetch.time, "monotonic", clock)
+    return clock
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = ToolResultCache({"weather": 60}, default_ttl=10)
+    calls = []
+
+    def weather(latitude, longitude):
+        calls.append((latitude, longitude))
+        return {"temperature": len(calls)}
+
+    assert cache.call("weather", {"latitude": 37.771, "longitude": -122.42}, weather) == {"temperature": 1}
+    clock.now += 59
+    # Coordinates within ~1 km share the entry
+    assert cache.call("weather", {"latitude": 37.774, "longitude": -122.419}, weather) == {"temperature": 1}
+    clock.now += 2
+    assert cache.call("weather", {"latitude": 37.771, "longitude": -122.42}, weather) == {"temperature": 2}
+
+    cache.put(cache_key("other", {}), "value")
+    clock.now += 11
+    assert cache.get(cache_key("other", {})) is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_errors_are_not_cached():
+    cache = ToolResultCache({})
+    results = iter([{"error": "down"}, {"ok": True}])
+    assert cache.call("tool", {}, lambda: next(results)) == {"error": "down"}
+    assert cache.call("tool", {}, lambda: next(results)) == {"ok": True}
+
+
+def test_unused_prefetches_count_as_wasted(clock):
+    cache = ToolResultCache({"tool": 60})
+    cache.put(cache_key("tool", {"a": 1}), "used", prefetched=True)
+    cache.put(cache_key("tool", {"a": 2}), "unused", prefetched=True)
+    assert cache.get(cache_key("tool", {"a": 1})) == "used"
+    clock.now += 61
+    assert cache.get(cache_key("tool", {"a": 1})) is None
+    assert cache.get(cache_key("tool", {"a": 2})) is None
+    stats = cache.stats()
+    assert (stats["prefetch_hits"], stats["wasted_prefetches"]) == (1, 1)
+
+
+def test_call_joins_a_running_prefetch():
+    cache = ToolResultCache({"weather": 60})
+    prefetcher = Prefetcher(cache, max_workers=1)
+    release = threading.Event()
+    calls = []
+
+    def weather(latitude, longitude):
+        calls.append(1)
+        release.wait(5)
+        return {"temperature": 18.5}
+
+    arguments = {"latitude": 37.77, "longitude": -122.42}
+    assert prefetcher.prefetch("weather", arguments, weather)
+    # A second prefetch and the model's tool call arrive while the first lookup runs
+    assert not prefetcher.prefetch("weather", arguments, weather)
+    results = []
+    caller = threading.Thread(target=lambda: results.append(cache.call("weather", arguments, weather)))
+    caller.start()
+    time.sleep(0.05)
+    assert results == []
+    release.set()
+    caller.join(5)
+
+    assert results == [{"temperature": 18.5}]
+    assert len(calls) == 1
+    stats = prefetcher.stats()
+    assert (stats["joined"], stats["prefetch_hits"], stats["completed"], stats["in_progress"]) == (1, 1, 1, 0)
+
+
+def test_concurrent_calls_share_one_lookup():
+    cache = ToolResultCache({"tool": 60})
+    started = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return "value"
+
+    threads = [threading.Thread(target=lambda: cache.call("tool", {}, slow))]
+    threads[0].start()
+    started.wait(5)
+    threads += [threading.Thread(target=lambda: cache.call("tool", {}, slow)) for _ in range(4)]
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert cache.stats()["joined"] == 4
+
+
+def test_waiters_make_their_own_call_when_the_lookup_raises():
+    cache = ToolResultCache({"tool": 60})
+    prefetcher = Prefetcher(cache, max_workers=1)
+    release = threading.Event()
+
+    def broken():
+        release.wait(5)
+        raise ConnectionError("reset")
+
+    prefetcher.prefetch("tool", {}, broken)
+    results = []
+    caller = threading.Thread(target=lambda: results.append(cache.call("tool", {}, lambda: "fresh")))
+    caller.start()
+    release.set()
+    caller.join(5)
+    assert results == ["fresh"]
+    assert prefetcher.stats()["failed"] == 1
+
+
+def test_acall_joins_a_running_prefetch():
+    cache = ToolResultCache({"tool": 60})
+    prefetcher = Prefetcher(cache, max_workers=1)
+    release = threading.Event()
+    calls = []
+
+    def lookup():
+        release.wait(5)
+        return "prefetched"
+
+    async def direct():
+        calls.append(1)
+        return "direct"
+
+    async def main():
+        prefetcher.prefetch("tool", {}, lookup)
+        waiter = asyncio.create_task(cache.acall("tool", {}, direct))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        release.set()
+        return await waiter
+
+    assert asyncio.run(main()) == "prefetched"
+    assert calls == []
+
+
+def test_cancelled_acall_does_not_cancel_the_lookup():
+    cache = ToolResultCache({"tool": 60})
+    release = threading.Event()
+    prefetcher = Prefetcher(cache, max_workers=1)
+    prefetcher.prefetch("tool", {}, lambda: release.wait(5) and "value")
+
+    async def main():
+        waiter = asyncio.create_task(cache.acall("tool", {}, lambda: None))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(main())
+    release.set()
+    assert cache.call("tool", {}, lambda: "other") == "value"
+
+
+def test_joined_waits_end_at_the_request_deadline():
+    cache = ToolResultCache({"tool": 60})
+    prefetcher = Prefetcher(cache, max_workers=1)
+    release = threading.Event()
+    prefetcher.prefetch("tool", {}, lambda: release.wait(5) and "late")
+
+    started = time.monotonic()
+    with request_deadline(0.1):
+        result = cache.call("tool", {}, lambda: "direct")
+    assert time.monotonic() - started < 1
+    assert "error" in result
+
+    async def main():
+        with request_deadline(0.1):
+            return await cache.acall("tool", {}, lambda: None)
+
+    started = time.monotonic()
+    assert "error" in asyncio.run(main())
+    assert time.monotonic() - started < 1
+    assert cache.stats()["join_timeouts"] == 2
+
+    # The prefetch itself carries on and is cached for later turns
+    release.set()
+    assert cache.call("tool", {}, lambda: "other") == "late"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("I'm at 37.7749, -122.4194", {"latitude": 37.7749, "longitude": -122.4194}),
+    ("my zip is 94103", {"zipcode": "94103"}),
+    ("Zipcode: 95969-1234", {"zipcode": "95969"}),
+    ("postal code 91001", {"zipcode": "91001"}),
+    ("FEMA says I owe 12000 dollars", None),
+    ("My claim number is 55555", None),
+    ("I live in 94103", None),
+])
+def test_detect_location(text, expected):
+    assert detect_location(text) == expected
+
+
+def test_bare_numbers_count_only_when_known():
+    known = {"94103"}.__contains__
+    assert detect_location("I live in 94103", is_known_zip=known) == {"zipcode": "94103"}
+    assert detect_location("Reference 12000, I live in 94103", is_known_zip=known) == {"zipcode": "94103"}
+    assert detect_location("I need $94103.50 back", is_known_zip=known) is None
+    assert detect_location("Claim 55555", is_known_zip=known) is None
@@ -0,0 +1,38 @@
+import types
+
+
+def test_all_tool_results_go_to_one_follow_up_completion(chat_app, monkeypatch, completion, tool_call):
+    requests = []
+    replies = [
+        completion(tool_calls=[tool_call("call_1", "get_current_weather", latitude=33.33, longitude=44.44),
+                               tool_call("call_2", "GetCurrentAirQuality", latitude=33.33, longitude=44.44,
+                                         date="2024-01-01")]),
+        completion("Warm, and the air is moderate."),
+    ]
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        return replies.pop(0)
+
+    ran = []
+    monkeypatch.setattr(chat_app, "client", types.SimpleNamespace(
+        chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)),
+        embeddings=chat_app.client.embeddings))
+    monkeypatch.setitem(chat_app.available_functions, "get_current_weather",
+                        lambda **kwargs: ran.append("weather") or {"temperature": 30})
+    monkeypatch.setitem(chat_app.available_functions, "GetCurrentAirQuality",
+                        lambda **kwargs: ran.append("air") or {"AQI": 60})
+
+    messages = [{"role": "user", "content": "Weather and air quality at 33.33, 44.44?"}]
+    answer = chat_app.generate_relief_answer(messages, messages[-1]["content"])
+
+    assert answer.content == "Warm, and the air is moderate."
+    assert answer.used_tools
+    assert ran == ["weather", "air"]
+    assert len(requests) == 2
+    follow_up = requests[1]["messages"]
+    assert [m["tool_call_id"] for m in follow_up if isinstance(m, dict) and m.get("role") == "tool"] == \
+        ["call_1", "call_2"]
+    # Retrieval block, the assistant's tool calls and both results are kept for the context
+    assert len(answer.context_messages) == 4
+    assert len(messages) == 1
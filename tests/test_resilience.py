@@ -0,0 +1,152 @@
+import threading
+import time
+import uuid
+
+import pytest
+import requests
+
+from resilience import (CircuitBreaker, RetryBudget, UpstreamUnavailable, attempt_timeout, call_upstream,
+                        get_upstream, request_deadline, resilience_stats)
+
+
+def upstream_name():
+    # Upstreams are process-wide; give every test its own
+    return "test-" + uuid.uuid4().hex
+
+
+def test_breaker_opens_after_threshold_and_recovers(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("b", failure_threshold=2, reset_timeout=10)
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    now[0] += 10
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only one trial call at a time while half-open
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.snapshot() == {"state": "closed", "failures": 0, "rejected": 2}
+
+
+def test_breaker_half_open_failure_reopens(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("b", failure_threshold=1, reset_timeout=5)
+    breaker.record_failure()
+    now[0] += 5
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_release_returns_trial_slot(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("b", failure_threshold=1, reset_timeout=5)
+    breaker.record_failure()
+    now[0] += 5
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_retry_budget_refills_from_traffic():
+    budget = RetryBudget(ratio=0.5, max_tokens=1.0)
+    assert budget.try_spend()
+    assert not budget.try_spend()
+    budget.deposit()
+    assert not budget.try_spend()
+    budget.deposit()
+    assert budget.try_spend()
+
+
+def test_call_upstream_retries_retryable_errors(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    name = upstream_name()
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise requests.ConnectionError("reset")
+        return "ok"
+
+    assert call_upstream(name, flaky) == "ok"
+    assert get_upstream(name).counters() == {"calls": 1, "retries": 2, "failures": 2}
+    assert resilience_stats()[name]["state"] == "closed"
+
+
+def test_call_upstream_does_not_retry_client_errors():
+    name = upstream_name()
+    attempts = []
+
+    def bad_request():
+        attempts.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        call_upstream(name, bad_request)
+    assert len(attempts) == 1
+    assert get_upstream(name).breaker.state == CircuitBreaker.CLOSED
+
+
+def test_call_upstream_never_retries_non_idempotent_calls():
+    name = upstream_name()
+    attempts = []
+
+    def send():
+        attempts.append(1)
+        raise requests.Timeout("slow")
+
+    with pytest.raises(UpstreamUnavailable):
+        call_upstream(name, send, idempotent=False)
+    assert len(attempts) == 1
+
+
+def test_call_upstream_fails_fast_when_open():
+    name = upstream_name()
+    breaker = get_upstream(name).breaker
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+    with pytest.raises(UpstreamUnavailable, match="circuit open"):
+        call_upstream(name, lambda: "never")
+
+
+def test_expired_deadline_stops_calls():
+    with request_deadline(0):
+        with pytest.raises(UpstreamUnavailable, match="deadline"):
+            call_upstream(upstream_name(), lambda: "never")
+
+
+def test_attempt_timeout_capped_by_deadline():
+    assert attempt_timeout(7) == 7
+    with request_deadline(2):
+        assert attempt_timeout(7) <= 2
+    with request_deadline(0):
+        assert attempt_timeout(7) == 0.05
+
+
+def test_counters_are_thread_safe():
+    name = upstream_name()
+    upstream = get_upstream(name)
+
+    def work():
+        for _ in range(2000):
+            upstream.count("calls")
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert upstream.counters()["calls"] == 16000
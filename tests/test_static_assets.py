@@ -0,0 +1,77 @@
+import json
+
+from build_assets import rewrite_css_urls
+from static_assets import AssetManifest
+
+
+def write_manifest(tmp_path, variants):
+    manifest = {
+        "images": {"logo.png": {"file": "logo.abc.png", "width": 960, "height": 480, "type": "image/png",
+                                "variants": variants}},
+        "css": {"styles.css": {"file": "styles.def.css", "gzip": True, "br": False}},
+    }
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps(manifest), encoding="utf-8")
+    return AssetManifest(str(path))
+
+
+def test_picture_offers_avif_then_webp_with_original_fallback(tmp_path):
+    manifest = write_manifest(tmp_path, [
+        {"file": "logo.320w.a.webp", "width": 320, "type": "image/webp"},
+        {"file": "logo.320w.b.avif", "width": 320, "type": "image/avif"},
+        {"file": "logo.960w.c.webp", "width": 960, "type": "image/webp"},
+        {"file": "logo.960w.d.avif", "width": 960, "type": "image/avif"},
+    ])
+    tag = manifest.image_tag("logo.png", 'Logo "x"')
+
+    assert tag.startswith("<picture>") and tag.endswith("</picture>")
+    assert tag.index('type="image/avif"') < tag.index('type="image/webp"') < tag.index("<img")
+    assert 'srcset="/images/logo.320w.b.avif 320w, /images/logo.960w.d.avif 960w"' in tag
+    assert 'srcset="/images/logo.320w.a.webp 320w, /images/logo.960w.c.webp 960w"' in tag
+    # The <img> itself only ever points at the original format
+    img = tag[tag.index("<img"):]
+    assert 'src="/images/logo.abc.png"' in img and "srcset" not in img
+    assert 'alt="Logo &quot;x&quot;"' in img
+
+
+def test_webp_only_build_has_one_source(tmp_path):
+    manifest = write_manifest(tmp_path, [{"file": "logo.320w.a.webp", "width": 320, "type": "image/webp"}])
+    tag = manifest.image_tag("logo.png", "Logo", lazy=False)
+    assert tag.count("<source") == 1
+    assert "loading=" not in tag
+
+
+def test_without_build_plain_img(tmp_path):
+    manifest = AssetManifest(str(tmp_path / "missing.json"))
+    assert manifest.image_tag("logo.png", "Logo") == \
+        '<img src="/images/logo.png" alt="Logo" class="chat-image" loading="lazy" decoding="async" />'
+    assert manifest.url("css", "styles.css") == "/css/styles.css"
+
+
+def test_hashed_files_and_largest_variant(tmp_path):
+    manifest = write_manifest(tmp_path, [
+        {"file": "logo.320w.a.webp", "width": 320, "type": "image/webp"},
+        {"file": "logo.960w.c.webp", "width": 960, "type": "image/webp"},
+    ])
+    assert manifest.is_hashed("logo.960w.c.webp")
+    assert manifest.is_hashed("styles.def.css")
+    assert not manifest.is_hashed("logo.png")
+    assert manifest.largest_variant_url("logo.png") == "/images/logo.960w.c.webp"
+
+
+def test_css_urls_point_at_hashed_images():
+    css = "a { background: url('../images/logo.png'); } b { background: url(images/other.png); }"
+    rewritten = rewrite_css_urls(css, {"logo.png": {"file": "logo.abc.png"}})
+    assert "url('/images/logo.abc.png')" in rewritten
+    assert "url(images/other.png)" in rewritten
+
+
+def test_page_renders_picture_markup(chat_app, client):
+    chat_app.asset_manifest.images = {"logo.png": {"file": "logo.abc.png", "variants": [
+        {"file": "logo.60w.a.avif", "width": 60, "type": "image/avif"}]}}
+    try:
+        page = client.get("/").data.decode()
+    finally:
+        chat_app.asset_manifest.images = {}
+    assert '<picture><source type="image/avif" srcset="/images/logo.60w.a.avif 60w" sizes="60px" />' in page
+    assert '<img src="/images/logo.abc.png" alt="DisasterConnect Logo" class="logo" /></picture>' in page
@@ -0,0 +1,159 @@
+import types
+import uuid
+
+import pytest
+
+import token_accounting
+from token_accounting import RETRIEVAL_PREFIX, PromptTooLarge, TokenAccountant
+
+STATIC = "You are DisasterConnect. " * 50
+
+
+@pytest.fixture
+def accountant(monkeypatch):
+    # One token per 4 characters, whatever tokenizer is installed
+    monkeypatch.setattr(token_accounting, "load_encoding", lambda model: None)
+    accountant = TokenAccountant("gpt-4o-mini", max_prompt_tokens=1000,
+                                 category_limits={"retrieval": 300, "tool": 300, "user": 200})
+    accountant.register_static(STATIC)
+    return accountant
+
+
+def tool_call_message(name="get_current_weather", arguments='{"latitude": 1, "longitude": 2}'):
+    call = types.SimpleNamespace(id="call_1", type="function",
+                                 function=types.SimpleNamespace(name=name, arguments=arguments))
+    return types.SimpleNamespace(role="assistant", content=None, tool_calls=[call])
+
+
+def conversation(turns, words=40):
+    messages = [{"role": "developer", "content": STATIC},
+                {"role": "system", "content": "The user is a Survivor/Caregiver."}]
+    for n in range(turns):
+        messages.append({"role": "user", "content": f"question {n} " + "word " * words})
+        messages.append({"role": "assistant", "content": f"answer {n} " + "word " * words})
+    return messages
+
+
+def test_breakdown_by_category(accountant):
+    messages = conversation(1) + [
+        {"role": "user", "content": "What is the weather?"},
+        {"role": "system", "content": RETRIEVAL_PREFIX + " shelters"},
+        tool_call_message(),
+        {"role": "tool", "tool_call_id": "call_1", "name": "get_current_weather", "content": "{}"},
+    ]
+    counts = accountant.breakdown(messages)
+    assert all(counts[c] > 0 for c in ("static", "persona", "history", "user", "retrieval", "tool"))
+    assert counts["tool_schema"] == 0
+    assert counts["total"] == sum(v for k, v in counts.items() if k != "total") + token_accounting.REPLY_PRIMING_TOKENS
+
+
+def test_prompt_within_limit_is_sent_unchanged(accountant):
+    messages = conversation(2)
+    sent, counts = accountant.fit(messages)
+    assert sent is messages
+    assert counts["total"] <= 1000
+
+
+def test_oldest_history_is_dropped_until_the_prompt_fits(accountant):
+    messages = conversation(20) + [{"role": "user", "content": "latest question"}]
+    sent, counts = accountant.fit(messages)
+    assert counts["total"] <= 1000
+    assert sent[:2] == messages[:2]
+    assert sent[-1] == {"role": "user", "content": "latest question"}
+    # What survives is the most recent history, in order
+    assert sent[2:-1] == messages[len(messages) - len(sent) + 2:-1]
+    assert accountant.stats()["trimmed_prompts"] == 1
+    assert accountant.stats()["trimmed_messages"] == len(messages) - len(sent)
+
+
+def test_tool_calls_are_dropped_with_their_results(accountant):
+    old_tool_turn = [
+        {"role": "user", "content": "weather?"},
+        {"role": "system", "content": RETRIEVAL_PREFIX + " " + "word " * 200},
+        tool_call_message(arguments='{"latitude": 1, "longitude": 2}' + " " * 400),
+        {"role": "tool", "tool_call_id": "call_1", "name": "get_current_weather", "content": "{}"},
+        {"role": "tool", "tool_call_id": "call_2", "name": "get_current_weather", "content": "{}"},
+        {"role": "assistant", "content": "It is sunny."},
+    ]
+    messages = conversation(0) + old_tool_turn + conversation(6)[2:] + [{"role": "user", "content": "now?"}]
+    sent, _ = accountant.fit(messages)
+    roles = [m["role"] if isinstance(m, dict) else m.role for m in sent]
+    # Never a tool result without the assistant message that asked for it
+    for i, role in enumerate(roles):
+        if role == "tool":
+            assert roles[i - 1] in ("assistant", "tool")
+    assert "tool" not in roles
+
+
+def test_persona_and_current_turn_are_kept(accountant):
+    retrieval = {"role": "system", "content": RETRIEVAL_PREFIX + " " + "word " * 200}
+    messages = conversation(30) + [{"role": "user", "content": "latest"}, retrieval]
+    sent, counts = accountant.fit(messages)
+    assert messages[1] in sent
+    assert sent[-2:] == [{"role": "user", "content": "latest"}, retrieval]
+    assert counts["retrieval"] > 0
+
+
+def test_only_an_oversized_current_turn_is_refused(accountant):
+    with pytest.raises(PromptTooLarge) as error:
+        accountant.fit(conversation(0) + [{"role": "user", "content": "word " * 300}])
+    assert error.value.category == "user"
+
+    too_much = {"role": "system", "content": RETRIEVAL_PREFIX + " " + "word " * 400}
+    with pytest.raises(PromptTooLarge) as error:
+        accountant.fit(conversation(10) + [{"role": "user", "content": "short"}, too_much])
+    assert error.value.category == "retrieval"
+    assert accountant.stats()["rejected"] == {"user": 1, "retrieval": 1}
+
+
+def test_total_limit_refuses_only_when_no_history_is_left(accountant):
+    accountant.max_prompt_tokens = 500
+    messages = conversation(0) + [{"role": "user", "content": "word " * 150},
+                                  {"role": "system", "content": RETRIEVAL_PREFIX + " " + "word " * 200}]
+    with pytest.raises(PromptTooLarge) as error:
+        accountant.fit(messages)
+    assert error.value.category == "total"
+
+
+def test_message_counts_are_cached_per_message(accountant, monkeypatch):
+    messages = conversation(5)
+    accountant.breakdown(messages)
+    calls = []
+    count = accountant.counter.count
+    monkeypatch.setattr(accountant.counter, "count", lambda text: calls.append(text) or count(text))
+
+    before = accountant.breakdown(messages)
+    assert calls == []
+    messages.append({"role": "user", "content": "new question"})
+    after = accountant.breakdown(messages)
+    assert calls == ["new question"]
+    assert after["user"] > 0
+    # The previous question is history now
+    assert after["history"] == before["history"] + before["user"]
+
+
+def test_bound_history_keeps_stored_context_within_the_limit(accountant):
+    messages = conversation(30)
+    bounded = accountant.bound_history(messages)
+    assert accountant.breakdown(bounded)["total"] <= 1000
+    assert bounded[:2] == messages[:2]
+    assert bounded[-2:] == messages[-2:]
+    short = conversation(1)
+    assert accountant.bound_history(short) is short
+
+
+def test_long_conversations_are_trimmed_not_refused(chat_app, client, monkeypatch):
+    static_tokens = chat_app.token_accountant.breakdown(chat_app.chatContext)["total"]
+    monkeypatch.setattr(chat_app.token_accountant, "max_prompt_tokens", static_tokens + 1500)
+    conversation_id = uuid.uuid4().hex
+    client.set_cookie("dc_conversation", conversation_id)
+    client.post("/", data={"user_input": "1"})
+    for n in range(25):
+        response = client.post("/", data={"user_input": f"Question {n}: how do I apply for FEMA aid? " + "please " * 40})
+        assert response.status_code == 200
+        assert b"too long" not in response.data
+        assert b"more information" not in response.data
+
+    context = chat_app.conversations.get(conversation_id).context
+    assert chat_app.token_accountant.breakdown(context)["total"] <= static_tokens + 1500
+    assert chat_app.token_accountant.stats()["trimmed_prompts"] > 0
@@ -0,0 +1,363 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+#***********************************
+# Prompt token accounting
+#***********************************
+# Counts the tokens of every prompt before it is sent, split by where they come
+# from: the static developer prompt and tool schemas, persona instructions, the
+# retrieval block, conversation history, tool calls/results and the user's
+# message. Counts are cached by content hash, so the static prompt is tokenized
+# once at startup and each turn only tokenizes text it hasn't seen before (the
+# new user message, retrieval block and tool results). Each message's count is
+# also kept per message object, so history carried from turn to turn isn't
+# hashed again.
+#
+# A prompt over the total limit has its oldest history dropped until it fits;
+# the static prompt, persona instructions and the current turn (the latest user
+# message and everything after it) are always kept. Only a current turn that
+# is too large on its own raises PromptTooLarge instead of being sent.
+#
+# When the tiktoken encoding can't be loaded (e.g. no network to fetch it) the
+# counts fall back to an estimate of one token per 4 characters.
+
+CATEGORIES = ("static", "tool_schema", "persona", "retrieval", "history", "tool", "user")
+
+RETRIEVAL_PREFIX = "\n\nAdditional Information:"
+
+# Per-message framing tokens and the tokens priming the reply, as counted by OpenAI
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+REPLY_PRIMING_TOKENS = 3
+
+DEFAULT_MAX_PROMPT_TOKENS = 30000
+DEFAULT_CATEGORY_LIMITS = {
+    "retrieval": 6000,
+    "tool": 8000,
+    "user": 4000,
+}
+
+
+class PromptTooLarge(Exception):
+    """Raised before sending a prompt whose current turn exceeds a token limit."""
+
+    def __init__(self, category, tokens, limit, breakdown):
+        super().__init__(f"prompt {category} tokens {tokens} exceed the limit of {limit}")
+        self.category = category
+        self.tokens = tokens
+        self.limit = limit
+        self.breakdown = breakdown
+
+
+def load_encoding(model):
+    """Returns the tiktoken encoding for a model, or None if it can't be loaded."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception as e:
+        print(f"Unable to load the tokenizer for {model}, estimating token counts: {e}")
+        return None
+    # Models newer than the installed tiktoken
+    for name in ("o200k_base", "cl100k_base"):
+        try:
+            return tiktoken.get_encoding(name)
+        except Exception:
+            continue
+    print(f"Unable to load a tokenizer for {model}, estimating token counts")
+    return None
+
+
+def _content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+
+def _field(message, name):
+    return message.get(name) if isinstance(message, dict) else getattr(message, name, None)
+
+
+class TokenCounter:
+    """
+    Token counts cached by content hash.
+
+    Static pieces registered with `pin` stay cached; everything else shares an
+    LRU of `max_entries` counts.
+    """
+
+    def __init__(self, model, max_entries=20000):
+        self.encoding = load_encoding(model)
+        self.tokenizer = self.encoding.name if self.encoding is not None else "estimate"
+        self.max_entries = max_entries
+        self._pinned = {}
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _tokenize(self, text):
+        if self.encoding is None:
+            return (len(text) + 3) // 4
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def pin(self, text):
+        """Counts a static piece once and keeps its count for the life of the process."""
+        key = _content_hash(text)
+        with self._lock:
+            if key not in self._pinned:
+                self._pinned[key] = self._tokenize(text)
+            return self._pinned[key]
+
+    def is_pinned(self, text):
+        with self._lock:
+            return _content_hash(text) in self._pinned
+
+    def count(self, text):
+        if not text:
+            return 0
+        key = _content_hash(text)
+        with self._lock:
+            if key in self._pinned:
+                self.hits += 1
+                return self._pinned[key]
+            if key in self._recent:
+                self.hits += 1
+                self._recent.move_to_end(key)
+                return self._recent[key]
+            self.misses += 1
+        tokens = self._tokenize(text)
+        with self._lock:
+            self._recent[key] = tokens
+            while len(self._recent) > self.max_entries:
+                self._recent.popitem(last=False)
+        return tokens
+
+
+def _category(message, role, position):
+    """
+    Args:
+        position (int): Index relative to the current user message (0), negative for earlier turns.
+    """
+    if role == "developer":
+        return "static"
+    if role == "system":
+        content = _field(message, "content") or ""
+        if not content.startswith(RETRIEVAL_PREFIX):
+            return "persona"
+        # Retrieval blocks and tool results of earlier turns are just history now
+        return "retrieval" if position > 0 else "history"
+    if role == "tool" or (role == "assistant" and _field(message, "tool_calls")):
+        return "tool" if position > 0 else "history"
+    if role == "user" and position == 0:
+        return "user"
+    return "history"
+
+
+def _last_user_index(messages):
+    return max((i for i, m in enumerate(messages) if _field(m, "role") == "user"), default=0)
+
+
+def _message_text(message):
+    text = _field(message, "content") or ""
+    tool_calls = _field(message, "tool_calls")
+    if tool_calls:
+        text += "".join(_field(_field(call, "function"), "name") + _field(_field(call, "function"), "arguments")
+                        for call in tool_calls)
+    return text
+
+
+class TokenAccountant:
+    """
+    Per-request prompt breakdowns, limits, history trimming and running totals.
+
+    Args:
+        model (str): Model whose tokenizer is used.
+        max_prompt_tokens (int): Hard limit on the whole prompt.
+        category_limits (dict): Hard limits on individual categories.
+        max_cached_messages (int): Messages whose counts are kept per message object.
+    """
+
+    def __init__(self, model, max_prompt_tokens=DEFAULT_MAX_PROMPT_TOKENS, category_limits=None,
+                 max_cached_messages=20000):
+        self.counter = TokenCounter(model)
+        self.max_prompt_tokens = max_prompt_tokens
+        self.category_limits = dict(DEFAULT_CATEGORY_LIMITS if category_limits is None else category_limits)
+        self.max_cached_messages = max_cached_messages
+        # id(message) -> (message, content, tokens, pinned); holding the message keeps its id unique
+        self._message_counts = OrderedDict()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.rejected = {}
+        self.trimmed_prompts = 0
+        self.trimmed_messages = 0
+        self.totals = dict.fromkeys(CATEGORIES, 0)
+        self.largest = dict.fromkeys(CATEGORIES + ("total",), 0)
+        self.reported_prompt_tokens = 0
+        self.counted_for_reported = 0
+
+    def register_static(self, text):
+        """Tokenizes a static prompt piece up front; returns its count."""
+        return self.counter.pin(text)
+
+    def register_tools(self, tools):
+        return self.counter.pin(json.dumps(tools, sort_keys=True, default=str)) if tools else 0
+
+    def _message_tokens(self, message):
+        """(tokens, pinned) for one message, cached per message object."""
+        content = _field(message, "content")
+        key = id(message)
+        with self._lock:
+            cached = self._message_counts.get(key)
+            if cached is not None and cached[0] is message and cached[1] is content:
+                self._message_counts.move_to_end(key)
+                return cached[2], cached[3]
+
+        text = _message_text(message)
+        tokens = TOKENS_PER_MESSAGE + self.counter.count(text)
+        if _field(message, "name"):
+            tokens += TOKENS_PER_NAME
+        pinned = self.counter.is_pinned(text)
+        with self._lock:
+            self._message_counts[key] = (message, content, tokens, pinned)
+            while len(self._message_counts) > self.max_cached_messages:
+                self._message_counts.popitem(last=False)
+        return tokens, pinned
+
+    def _categorized(self, messages):
+        """(tokens, category) per message."""
+        last_user = _last_user_index(messages)
+        counted = []
+        for i, message in enumerate(messages):
+            tokens, pinned = self._message_tokens(message)
+            # Registered static pieces count as static whatever role carries them
+            category = "static" if pinned else _category(message, _field(message, "role"), i - last_user)
+            counted.append((tokens, category))
+        return counted
+
+    def _totals(self, counted, tools):
+        counts = dict.fromkeys(CATEGORIES, 0)
+        for tokens, category in counted:
+            counts[category] += tokens
+        if tools:
+            # Approximation: the serialized schemas, not OpenAI's internal rendering of them
+            counts["tool_schema"] = self.counter.count(json.dumps(tools, sort_keys=True, default=str))
+        counts["total"] = sum(counts.values()) + REPLY_PRIMING_TOKENS
+        return counts
+
+    def breakdown(self, messages, tools=None):
+        """
+        Returns:
+            dict: Tokens per category plus "total".
+        """
+        return self._totals(self._categorized(messages), tools)
+
+    def _trim(self, messages, counted, excess):
+        """
+        Drops the oldest history until `excess` tokens are gone or none is left.
+
+        An assistant message with tool calls goes together with its tool results.
+
+        Returns:
+            tuple: (kept messages, their (tokens, category) entries, messages dropped).
+        """
+        last_user = _last_user_index(messages)
+        drop = set()
+        i = 0
+        while i < last_user and excess > 0:
+            if counted[i][1] != "history":
+                i += 1
+                continue
+            group = [i]
+            if _field(messages[i], "tool_calls"):
+                while group[-1] + 1 < last_user and _field(messages[group[-1] + 1], "role") == "tool":
+                    group.append(group[-1] + 1)
+            for j in group:
+                drop.add(j)
+                excess -= counted[j][0]
+            i = group[-1] + 1
+        kept = [(m, c) for i, (m, c) in enumerate(zip(messages, counted)) if i not in drop]
+        return [m for m, _ in kept], [c for _, c in kept], len(drop)
+
+    def bound_history(self, messages):
+        """
+        Drops the oldest history of a stored conversation so it fits within max_prompt_tokens.
+
+        Returns:
+            list: `messages` itself if it fits, otherwise a trimmed copy.
+        """
+        counted = self._categorized(messages)
+        excess = self._totals(counted, None)["total"] - self.max_prompt_tokens
+        if not self.max_prompt_tokens or excess <= 0:
+            return messages
+        return self._trim(messages, counted, excess)[0]
+
+    def fit(self, messages, tools=None):
+        """
+        Counts a prompt, drops the oldest history until it is within the total limit,
+        enforces the limits and updates the running totals.
+
+        Returns:
+            tuple: (messages to send, breakdown of those messages). The messages are
+            `messages` itself when nothing was dropped.
+
+        Raises:
+            PromptTooLarge: The current turn is over a limit on its own (nothing is left to drop).
+        """
+        counted = self._categorized(messages)
+        counts = self._totals(counted, tools)
+        dropped = 0
+        if self.max_prompt_tokens and counts["total"] > self.max_prompt_tokens:
+            messages, counted, dropped = self._trim(messages, counted, counts["total"] - self.max_prompt_tokens)
+            counts = self._totals(counted, tools)
+
+        limits = dict(self.category_limits, total=self.max_prompt_tokens)
+        for category, limit in limits.items():
+            if limit and counts.get(category, 0) > limit:
+                with self._lock:
+                    self.rejected[category] = self.rejected.get(category, 0) + 1
+                raise PromptTooLarge(category, counts[category], limit, counts)
+
+        with self._lock:
+            self.requests += 1
+            if dropped:
+                self.trimmed_prompts += 1
+                self.trimmed_messages += dropped
+            for category in CATEGORIES:
+                self.totals[category] += counts[category]
+            for category, tokens in counts.items():
+                self.largest[category] = max(self.largest[category], tokens)
+        return messages, counts
+
+    def record_usage(self, counts, usage):
+        """Compares a breakdown with the prompt tokens the API reported, to track counting drift."""
+        prompt_tokens = getattr(usage, "prompt_tokens", None) if usage is not None else None
+        if not isinstance(prompt_tokens, int):
+            return
+        with self._lock:
+            self.reported_prompt_tokens += prompt_tokens
+            self.counted_for_reported += counts["total"]
+
+    def stats(self):
+        with self._lock:
+            requests = self.requests
+            stats = {
+                "tokenizer": self.counter.tokenizer,
+                "requests": requests,
+                "rejected": dict(self.rejected),
+                "trimmed_prompts": self.trimmed_prompts,
+                "trimmed_messages": self.trimmed_messages,
+                "mean": {c: round(t / requests, 1) if requests else 0.0 for c, t in self.totals.items()},
+                "max": dict(self.largest),
+                "limits": dict(self.category_limits, total=self.max_prompt_tokens),
+                "count_cache_hits": self.counter.hits,
+                "count_cache_misses": self.counter.misses,
+            }
+            if self.counted_for_reported:
+                # Reported / counted: 1.0 means the local counts match the API's
+                stats["reported_to_counted"] = round(self.reported_prompt_tokens / self.counted_for_reported, 3)
+        return stats
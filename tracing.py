@@ -0,0 +1,123 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+#***********************************
+# Per-turn tracing
+#***********************************
+# A TurnTrace collects what happened during one chat turn: how long each stage
+# took, which knowledge-base records were retrieved and which tools were called.
+# Code deep in the pipeline records into the active trace without it being
+# passed around; outside of a turn the helpers do nothing.
+
+
+class TurnTrace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.retrieval_ids = []
+        self.tool_calls = []
+        self.values = {}
+
+    def add_timing(self, stage, seconds):
+        # Stages that run more than once per turn (e.g. completions) accumulate
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def merge(self, other):
+        """Adds what another trace recorded to this one."""
+        for stage, seconds in other.timings.items():
+            self.add_timing(stage, seconds)
+        self.retrieval_ids.extend(other.retrieval_ids)
+        self.tool_calls.extend(other.tool_calls)
+        for key, value in other.values.items():
+            if isinstance(value, list):
+                self.values.setdefault(key, []).extend(value)
+            else:
+                self.values[key] = value
+
+    def timings_ms(self):
+        timings = {stage: round(seconds * 1000, 2) for stage, seconds in self.timings.items()}
+        timings['total'] = round(self.total() * 1000, 2)
+        return timings
+
+
+_current_trace = ContextVar("turn_trace", default=None)
+
+
+@contextmanager
+def start_turn():
+    """Traces the enclosed block as one turn."""
+    trace = TurnTrace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def sub_turn():
+    """
+    Traces the enclosed block into a fresh TurnTrace that is also merged into the
+    active one, so what the block recorded can be handed to other turns (e.g.
+    followers of a coalesced call, see record_shared()).
+    """
+    outer = current_trace()
+    with start_turn() as trace:
+        try:
+            yield trace
+        finally:
+            if outer is not None:
+                outer.merge(trace)
+
+
+def record_shared(trace):
+    """Adds another turn's sub_turn() trace to the active turn, whose result it shared."""
+    current = current_trace()
+    if current is not None and trace is not None:
+        current.merge(trace)
+
+
+def current_trace():
+    """Returns the active TurnTrace, or None outside of a turn."""
+    return _current_trace.get()
+
+
+@contextmanager
+def stage(name):
+    """Times the enclosed block as a stage of the active turn."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = current_trace()
+        if trace is not None:
+            trace.add_timing(name, time.perf_counter() - start)
+
+
+def record_retrieval(ids):
+    trace = current_trace()
+    if trace is not None:
+        trace.retrieval_ids.extend(ids)
+
+
+def record_tool_call(name, arguments, result):
+    trace = current_trace()
+    if trace is not None:
+        trace.tool_calls.append({"name": name, "arguments": arguments, "result": result})
+
+
+def append_value(key, value):
+    """Appends to a list value of the active trace, for things recorded once per call."""
+    trace = current_trace()
+    if trace is not None:
+        trace.values.setdefault(key, []).append(value)
+
+
+def record_value(key, value):
+    trace = current_trace()
+    if trace is not None:
+        trace.values[key] = value